@@ -159,12 +159,82 @@ RCS_WEBHOOK_TOKEN = os.getenv("RCS_WEBHOOK_TOKEN")
 
 FIREBASE_API_KEY = os.getenv("FIREBASE_API_KEY")
 
+WEBHOOK_HTTP2 = os.getenv("WEBHOOK_HTTP2", "true") == "true"
+WEBHOOK_CONNECT_TIMEOUT = float(os.getenv("WEBHOOK_CONNECT_TIMEOUT", "5"))
+WEBHOOK_READ_TIMEOUT = float(os.getenv("WEBHOOK_READ_TIMEOUT", "15"))
+WEBHOOK_POOL_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_POOL_MAX_CONNECTIONS", "20"))
+WEBHOOK_POOL_MAX_KEEPALIVE = int(os.getenv("WEBHOOK_POOL_MAX_KEEPALIVE", "10"))
+WEBHOOK_POOL_KEEPALIVE_EXPIRY = float(os.getenv("WEBHOOK_POOL_KEEPALIVE_EXPIRY", "60"))
+WEBHOOK_POOL_MAX_ORIGINS = int(os.getenv("WEBHOOK_POOL_MAX_ORIGINS", "256"))
+WEBHOOK_POOL_STATS_INTERVAL = float(os.getenv("WEBHOOK_POOL_STATS_INTERVAL", "300"))
+WEBHOOK_BATCH_WINDOW = float(os.getenv("WEBHOOK_BATCH_WINDOW", "1"))
+WEBHOOK_BATCH_MAX_SIZE = int(os.getenv("WEBHOOK_BATCH_MAX_SIZE", "100"))
+WEBHOOK_BREAKER_THRESHOLD = int(os.getenv("WEBHOOK_BREAKER_THRESHOLD", "10"))
+WEBHOOK_BREAKER_COOLDOWN = float(os.getenv("WEBHOOK_BREAKER_COOLDOWN", "60"))
+WEBHOOK_COALESCE_WINDOW = float(os.getenv("WEBHOOK_COALESCE_WINDOW", "1"))
+WEBHOOK_QUEUE = os.getenv("WEBHOOK_QUEUE", "celery")
+WEBHOOK_DISPATCHER_CONCURRENCY = int(os.getenv("WEBHOOK_DISPATCHER_CONCURRENCY", "1000"))
+WEBHOOK_DISPATCHER_DB_THREADS = int(os.getenv("WEBHOOK_DISPATCHER_DB_THREADS", "16"))
+OUTBOX_RELAY_GRACE = int(os.getenv("OUTBOX_RELAY_GRACE", "30"))
+OUTBOX_RELAY_BATCH_SIZE = int(os.getenv("OUTBOX_RELAY_BATCH_SIZE", "500"))
+OUTBOX_RELAY_INTERVAL = float(os.getenv("OUTBOX_RELAY_INTERVAL", "1"))
+OUTBOX_CLAIM_TIMEOUT = int(os.getenv("OUTBOX_CLAIM_TIMEOUT", "60"))
+RCS_TOKEN_REFRESH_MARGIN = int(os.getenv("RCS_TOKEN_REFRESH_MARGIN", "300"))
+RCS_SESSION_POOL_SIZE = int(os.getenv("RCS_SESSION_POOL_SIZE", "10"))
+TOKEN_BROKER_REFRESH_MARGIN = int(os.getenv("TOKEN_BROKER_REFRESH_MARGIN", "600"))
+TOKEN_BROKER_LEASE = int(os.getenv("TOKEN_BROKER_LEASE", "30"))
+TOKEN_BROKER_POLL_INTERVAL = float(os.getenv("TOKEN_BROKER_POLL_INTERVAL", "0.2"))
+RCS_CAPABILITY_CACHE_SIZE = int(os.getenv("RCS_CAPABILITY_CACHE_SIZE", "10000"))
+RCS_CAPABILITY_CACHE_TTL = int(os.getenv("RCS_CAPABILITY_CACHE_TTL", "300"))
+RCS_CAPABILITY_POSITIVE_TTL = int(os.getenv("RCS_CAPABILITY_POSITIVE_TTL", "604800"))
+RCS_CAPABILITY_NEGATIVE_TTL = int(os.getenv("RCS_CAPABILITY_NEGATIVE_TTL", "86400"))
+RCS_CAPABILITY_REFRESH_INTERVAL = int(os.getenv("RCS_CAPABILITY_REFRESH_INTERVAL", "300"))
+RCS_CAPABILITY_BULK_CONCURRENCY = int(os.getenv("RCS_CAPABILITY_BULK_CONCURRENCY", "16"))
+RCS_CAPABILITY_BULK_RATE = float(os.getenv("RCS_CAPABILITY_BULK_RATE", "20"))
+RCS_CAPABILITY_BULK_CHUNK = int(os.getenv("RCS_CAPABILITY_BULK_CHUNK", "500"))
+WARM_CAPABILITIES_CHUNK = int(os.getenv("WARM_CAPABILITIES_CHUNK", "1000"))
+RCS_FALLBACK_TIMEOUT = int(os.getenv("RCS_FALLBACK_TIMEOUT", "3600"))
+RCS_FALLBACK_TIMER_HORIZON = int(os.getenv("RCS_FALLBACK_TIMER_HORIZON", "600"))
+RCS_EXPIRY_GRACE = int(os.getenv("RCS_EXPIRY_GRACE", "900"))
+RCS_REVOKE_BATCH_SIZE = int(os.getenv("RCS_REVOKE_BATCH_SIZE", "500"))
+RCS_REVOKE_CONCURRENCY = int(os.getenv("RCS_REVOKE_CONCURRENCY", "16"))
+RCS_REVOKE_RETRY_INTERVAL = int(os.getenv("RCS_REVOKE_RETRY_INTERVAL", "300"))
+RCS_REVOKE_TIMEOUT = int(os.getenv("RCS_REVOKE_TIMEOUT", "10"))
+TWILIO_TIMEOUT = float(os.getenv("TWILIO_TIMEOUT", "10"))
+TWILIO_POOL_SIZE = int(os.getenv("TWILIO_POOL_SIZE", "10"))
+SMS_SCHEDULE_MAX_SLEEP = float(os.getenv("SMS_SCHEDULE_MAX_SLEEP", "1"))
+SMS_SCHEDULER_INTERVAL = float(os.getenv("SMS_SCHEDULER_INTERVAL", "1"))
+SMS_SCHEDULER_BATCH_SIZE = int(os.getenv("SMS_SCHEDULER_BATCH_SIZE", "500"))
+SMS_RATE_LIMITED_BACKOFF = float(os.getenv("SMS_RATE_LIMITED_BACKOFF", "5"))
+VSMS_KEY_TTL = int(os.getenv("VSMS_KEY_TTL", "86400"))
+VSMS_BATCH_SIZE = int(os.getenv("VSMS_BATCH_SIZE", "1000"))
+VSMS_BATCH_WAIT = float(os.getenv("VSMS_BATCH_WAIT", "0.02"))
+VSMS_KEY_CACHE_SIZE = int(os.getenv("VSMS_KEY_CACHE_SIZE", "10000"))
+CACHE_STATS_INTERVAL = float(os.getenv("CACHE_STATS_INTERVAL", "300"))
+SHORT_LINK_TTL = int(os.getenv("SHORT_LINK_TTL", "2592000"))
+SHORT_LINK_TIMEOUT = float(os.getenv("SHORT_LINK_TIMEOUT", "10"))
+SHORT_LINK_CONCURRENCY = int(os.getenv("SHORT_LINK_CONCURRENCY", "8"))
+MEDIA_DOWNLOAD_TIMEOUT = float(os.getenv("MEDIA_DOWNLOAD_TIMEOUT", "60"))
+MEDIA_CHUNK_SIZE = int(os.getenv("MEDIA_CHUNK_SIZE", "65536"))
+INGRESS_JOURNAL = os.getenv("INGRESS_JOURNAL", "false") == "true"
+INGRESS_BATCH_SIZE = int(os.getenv("INGRESS_BATCH_SIZE", "100"))
+INGRESS_CLAIM_LEASE = int(os.getenv("INGRESS_CLAIM_LEASE", "60"))
+INGRESS_MAX_ATTEMPTS = int(os.getenv("INGRESS_MAX_ATTEMPTS", "10"))
+INGRESS_POLL_INTERVAL = float(os.getenv("INGRESS_POLL_INTERVAL", "0.2"))
+SMS_QUEUE = os.getenv("SMS_QUEUE", "celery")
+
 PAT_URL = os.getenv("PAT_URL")
 
 CELERY_RESULT_BACKEND = "rpc://"
 CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL")
 CELERY_TASK_SERIALIZER = "json"
 CELERY_ACCEPT_CONTENT = ["json"]
+CELERY_TASK_ROUTES = {
+    "messaging.tasks.send_message": {"queue": WEBHOOK_QUEUE},
+    "messaging.tasks.flush_webhook_batch": {"queue": WEBHOOK_QUEUE},
+    "messaging.tasks.send_webhook_event": {"queue": WEBHOOK_QUEUE},
+    "sms.tasks.send_message": {"queue": SMS_QUEUE},
+}
 
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
@@ -163,6 +163,70 @@ RCS_WEBHOOK_TOKEN = rcs_conf["client_token"]
 
 FIREBASE_API_KEY = firebase_conf["api_key"]
 
+WEBHOOK_HTTP2 = True
+WEBHOOK_CONNECT_TIMEOUT = 5
+WEBHOOK_READ_TIMEOUT = 15
+WEBHOOK_POOL_MAX_CONNECTIONS = 20
+WEBHOOK_POOL_MAX_KEEPALIVE = 10
+WEBHOOK_POOL_KEEPALIVE_EXPIRY = 60
+WEBHOOK_POOL_MAX_ORIGINS = 256
+WEBHOOK_POOL_STATS_INTERVAL = 300
+WEBHOOK_BATCH_WINDOW = 1
+WEBHOOK_BATCH_MAX_SIZE = 100
+WEBHOOK_BREAKER_THRESHOLD = 10
+WEBHOOK_BREAKER_COOLDOWN = 60
+WEBHOOK_COALESCE_WINDOW = 1
+WEBHOOK_QUEUE = "celery"
+WEBHOOK_DISPATCHER_CONCURRENCY = 100
+WEBHOOK_DISPATCHER_DB_THREADS = 4
+OUTBOX_RELAY_GRACE = 30
+OUTBOX_RELAY_BATCH_SIZE = 500
+OUTBOX_RELAY_INTERVAL = 1
+OUTBOX_CLAIM_TIMEOUT = 60
+RCS_TOKEN_REFRESH_MARGIN = 300
+RCS_SESSION_POOL_SIZE = 10
+TOKEN_BROKER_REFRESH_MARGIN = 600
+TOKEN_BROKER_LEASE = 30
+TOKEN_BROKER_POLL_INTERVAL = 0.2
+RCS_CAPABILITY_CACHE_SIZE = 10000
+RCS_CAPABILITY_CACHE_TTL = 300
+RCS_CAPABILITY_POSITIVE_TTL = 604800
+RCS_CAPABILITY_NEGATIVE_TTL = 86400
+RCS_CAPABILITY_REFRESH_INTERVAL = 300
+RCS_CAPABILITY_BULK_CONCURRENCY = 4
+RCS_CAPABILITY_BULK_RATE = 5
+RCS_CAPABILITY_BULK_CHUNK = 100
+WARM_CAPABILITIES_CHUNK = 1000
+RCS_FALLBACK_TIMEOUT = 3600
+RCS_FALLBACK_TIMER_HORIZON = 600
+RCS_EXPIRY_GRACE = 900
+RCS_REVOKE_BATCH_SIZE = 100
+RCS_REVOKE_CONCURRENCY = 4
+RCS_REVOKE_RETRY_INTERVAL = 300
+RCS_REVOKE_TIMEOUT = 10
+TWILIO_TIMEOUT = 10
+TWILIO_POOL_SIZE = 10
+SMS_SCHEDULE_MAX_SLEEP = 1
+SMS_SCHEDULER_INTERVAL = 1
+SMS_SCHEDULER_BATCH_SIZE = 500
+SMS_RATE_LIMITED_BACKOFF = 5
+VSMS_KEY_TTL = 86400
+VSMS_BATCH_SIZE = 1000
+VSMS_BATCH_WAIT = 0.02
+VSMS_KEY_CACHE_SIZE = 10000
+CACHE_STATS_INTERVAL = 300
+SHORT_LINK_TTL = 2592000
+SHORT_LINK_TIMEOUT = 10
+SHORT_LINK_CONCURRENCY = 8
+MEDIA_DOWNLOAD_TIMEOUT = 60
+MEDIA_CHUNK_SIZE = 65536
+INGRESS_JOURNAL = False
+INGRESS_BATCH_SIZE = 100
+INGRESS_CLAIM_LEASE = 60
+INGRESS_MAX_ATTEMPTS = 10
+INGRESS_POLL_INTERVAL = 0.2
+SMS_QUEUE = "celery"
+
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
         'rest_framework.renderers.JSONRenderer',
@@ -17,6 +17,7 @@ from django.contrib import admin
 from django.conf.urls.static import static
 from django.urls import path, include
 from django.conf import settings
+import messaging.views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -30,4 +31,7 @@ urlpatterns = [
 
 if settings.DEBUG:
     urlpatterns += static("static/", document_root=settings.STATIC_ROOT)
+    # Production media is served by the nginx in front of Django, configured outside this repo, which must set
+    # the same immutable Cache-Control on blobs
+    urlpatterns.append(path("media/blobs/<path:path>", messaging.views.media_blob))
     urlpatterns += static("media/", document_root=settings.MEDIA_ROOT)
@@ -1,13 +1,13 @@
 from celery import shared_task
 import messaging.models
 import messaging.tasks
-import google.oauth2.service_account
+import messaging.tokens
 import google.auth.transport.requests
 from django.conf import settings
 import secrets
 import urllib.parse
 
-credentials = google.oauth2.service_account.Credentials.from_service_account_file(
+credentials = messaging.tokens.BrokeredCredentials.from_service_account_file(
     settings.GBM_SERVICE_ACCOUNT_FILE,
     scopes=["https://www.googleapis.com/auth/businessmessages"]
 )
@@ -21,16 +21,9 @@ session = google.auth.transport.requests.AuthorizedSession(credentials)
 def send_message(message_id):
     message = messaging.models.Message.objects.get(id=message_id)
 
-    related_messages = messaging.models.Message.objects.filter(
-        direction=messaging.models.Message.DIRECTION_INCOMING,
-        platform_conversation_id=message.platform_conversation_id,
-        brand=message.brand
-    ).count()
-
-    if related_messages == 0:
-        message.state = message.STATE_FAILED
-        message.error_description = "Not a valid conversation"
-        message.save()
+    conversation = messaging.models.Conversation.for_message(message)
+    if not conversation or not conversation.inbound_count:
+        messaging.tasks.fail_message(message, "Not a valid conversation")
         return
 
     representative = {}
@@ -59,8 +52,7 @@ def send_message(message_id):
         elif message.content["state"] == "representative_left":
             body["eventType"] = "REPRESENTATIVE_LEFT"
         else:
-            message.state = message.STATE_FAILED
-            message.error_description = "Invalid message"
+            messaging.tasks.fail_message(message, "Invalid message")
             return
     else:
         url = f"https://businessmessages.googleapis.com/v1/conversations/{message.platform_conversation_id}/messages"
@@ -71,9 +63,7 @@ def send_message(message_id):
             body["richCard"] = message.content
         elif message.media_type == "select":
             if not (type(message.content) is dict and "media_type" in message.content and "options" in message.content and "content" in message.content):
-                message.state = message.STATE_FAILED
-                message.error_description = "Invalid message"
-                message.save()
+                messaging.tasks.fail_message(message, "Invalid message")
                 return
 
             if message.content["media_type"] == "text":
@@ -85,9 +75,7 @@ def send_message(message_id):
             for option in message.content["options"]:
                 suggestion = None
                 if not (type(option) is dict and "media_type" in option and "content" in option):
-                    message.state = message.STATE_FAILED
-                    message.error_description = "Invalid message"
-                    message.save()
+                    messaging.tasks.fail_message(message, "Invalid message")
                     return
 
                 if option["media_type"] == "text":
@@ -100,9 +88,7 @@ def send_message(message_id):
                 elif option["media_type"] == "url":
                     content = option["content"]
                     if not (type(content) is dict and "url" in content and "text" in content):
-                        message.state = message.STATE_FAILED
-                        message.error_description = "Invalid message"
-                        message.save()
+                        messaging.tasks.fail_message(message, "Invalid message")
                         return
                     suggestion = {
                         "action": {
@@ -116,9 +102,7 @@ def send_message(message_id):
                 elif option["media_type"] == "dial":
                     content = option["content"]
                     if not (type(content) is dict and "number" in content and "text" in content):
-                        message.state = message.STATE_FAILED
-                        message.error_description = "Invalid message"
-                        message.save()
+                        messaging.tasks.fail_message(message, "Invalid message")
                         return
                     suggestion = {
                         "action": {
@@ -132,9 +116,7 @@ def send_message(message_id):
                 elif option["media_type"] == "location":
                     content = option["content"]
                     if not (type(content) is dict and "lat_long" in content or "query" in content and "text" in content):
-                        message.state = message.STATE_FAILED
-                        message.error_description = "Invalid message"
-                        message.save()
+                        messaging.tasks.fail_message(message, "Invalid message")
                         return
                     if "query" in content:
                         query = urllib.parse.quote_plus(content["query"])
@@ -179,25 +161,20 @@ def send_message(message_id):
                         }
                     }
                 else:
-                    message.state = message.STATE_FAILED
-                    message.error_description = "Unsupported suggestion type"
-                    message.save()
+                    messaging.tasks.fail_message(message, "Unsupported suggestion type")
                     return
 
                 if suggestion:
                     body["suggestions"].append(suggestion)
         else:
-            message.state = message.STATE_FAILED
-            message.error_description = "Invalid message"
-            message.save()
+            messaging.tasks.fail_message(message, "Invalid message")
             return
 
     if url and body:
         r = session.post(url, json=body)
         if r.status_code != 200:
-            message.state = message.STATE_FAILED
-            message.error_description = r.json()["error"]["message"]
+            messaging.tasks.fail_message(message, r.json()["error"]["message"])
         else:
-            message.state = message.STATE_DISPATCHED
             message.platform_message_id = r.json()["name"]
-        message.save()
+            message.save(update_fields=["platform_message_id"])
+            message.advance_state(message.STATE_DISPATCHED)
@@ -3,14 +3,12 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST, require_safe
 from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.conf import settings
+from django.db import transaction
 from django.core.files import File
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
 import urllib.parse
 from . import models
 import os.path
-import requests
-import mimetypes
+import messaging.ingress
 import messaging.models
 import hmac
 import base64
@@ -92,6 +90,14 @@ def bm_webhook(request):
     except json.JSONDecodeError:
         return HttpResponseBadRequest()
 
+    if settings.INGRESS_JOURNAL:
+        messaging.ingress.append(messaging.models.IngressEvent.SOURCE_GBM, body_json)
+        return HttpResponse(status=200)
+
+    return process_event(body_json)
+
+
+def process_event(body_json):
     if messaging.models.Message.objects.filter(
             platform=messaging.models.Message.PLATFORM_GBM, platform_dedup_id=body_json["requestId"]
     ).first():
@@ -141,21 +147,9 @@ def bm_webhook(request):
             new_message.content = body_json["message"]["text"]
             new_message.media_type = "text"
         else:
-            img = requests.get(message_text, stream=True)
-            img.raise_for_status()
-            img_name = os.path.basename(url_parts.path)
-            img_type = img.headers.get("content-type")
-            if img_type:
-                ext = mimetypes.guess_extension(img_type, strict=False)
-            else:
-                ext = ""
-            img_path = default_storage.save(img_name + ext, ContentFile(img.content))
-            img_url = settings.MEDIA_URL + img_path
-            new_message.content = {
-                "url": img_url,
-                "media_type": img_type,
-                "title": None,
-                "text": None
+            new_message.pending_media = {
+                "url": message_text,
+                "file_name": os.path.basename(url_parts.path),
             }
             new_message.media_type = "file"
     elif "suggestionResponse" in body_json:
@@ -182,15 +176,19 @@ def bm_webhook(request):
                 platform=messaging.models.Message.PLATFORM_GBM, platform_message_id=receipt["message"]
             ).first()
             if ref_message:
-                if receipt["receiptType"] == "DELIVERED":
-                    ref_message.state = messaging.models.Message.STATE_DELIVERED
-                if receipt["receiptType"] == "READ":
-                    ref_message.state = messaging.models.Message.STATE_READ
                 new_metadata = ref_message.metadata if ref_message.metadata else {}
                 new_metadata.update(metadata)
                 ref_message.metadata = new_metadata
-                ref_message.save()
-                messaging.tasks.send_message.delay(ref_message.id)
+
+                with transaction.atomic():
+                    ref_message.save(update_fields=["metadata"])
+                    state_changed = False
+                    if receipt["receiptType"] == "DELIVERED":
+                        state_changed = ref_message.advance_state(messaging.models.Message.STATE_DELIVERED)
+                    elif receipt["receiptType"] == "READ":
+                        state_changed = ref_message.advance_state(messaging.models.Message.STATE_READ)
+                    if state_changed:
+                        messaging.tasks.queue_state_webhook(ref_message)
 
         return HttpResponse(status=200)
     elif "userStatus" in body_json:
@@ -222,7 +220,6 @@ def bm_webhook(request):
         else:
             return HttpResponse(status=200)
 
-    new_message.save()
-    messaging.tasks.process_message.delay(new_message.id)
+    messaging.tasks.save_and_route(new_message)
 
     return HttpResponse(status=200)
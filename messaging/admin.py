@@ -4,3 +4,11 @@ from . import models
 admin.site.register(models.Brand)
 admin.site.register(models.Representative)
 admin.site.register(models.Message)
+admin.site.register(models.Conversation)
+
+
+@admin.register(models.WebhookBreaker)
+class WebhookBreakerAdmin(admin.ModelAdmin):
+    list_display = ('brand', 'state', 'consecutive_failures', 'opened_at', 'last_failure_at', 'parked_events')
+    list_filter = ('state',)
+    readonly_fields = ('parked_events',)
@@ -2,7 +2,7 @@ from rest_framework import permissions
 from as207960_utils.api import auth
 
 
-def brand_keycloak(db_class, pre_filtered=False):
+def brand_keycloak(db_class, pre_filtered=False, view_listing=False):
     class BrandKeycloak(permissions.BasePermission):
         def has_permission(self, request, view):
             if not isinstance(request.auth, auth.OAuthToken):
@@ -10,6 +10,9 @@ def brand_keycloak(db_class, pre_filtered=False):
 
             if request.method == "POST":
                 return db_class.objects.get(id=view.kwargs["brand_pk"]).has_scope(request.auth.token, 'edit')
+            elif view_listing and request.method in ("GET", "HEAD"):
+                brand = db_class.objects.filter(id=view.kwargs["brand_pk"]).first()
+                return bool(brand and brand.has_scope(request.auth.token, 'view'))
             else:
                 return True
 
@@ -1,8 +1,17 @@
 from rest_framework import serializers
+from django.utils import timezone
 from .. import models
 import rest_framework_nested.relations
 import collections
 
+STATE_NAMES = {
+    models.Message.STATE_ACCEPTED: "accepted",
+    models.Message.STATE_DISPATCHED: "dispatched",
+    models.Message.STATE_DELIVERED: "delivered",
+    models.Message.STATE_READ: "read",
+    models.Message.STATE_FAILED: "failed",
+}
+
 
 class WriteOnceMixin:
     def get_fields(self):
@@ -84,7 +93,8 @@ class BrandPermissionPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
 class BrandSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.Brand
-        fields = ('url', 'id', 'name', 'webhook_url', 'messages', 'representatives')
+        fields = ('url', 'id', 'name', 'webhook_url', 'webhook_batching', 'webhook_state_deltas', 'messages',
+                  'conversations', 'representatives')
         read_only_fields = ('id', 'name',)
 
     messages = serializers.HyperlinkedIdentityField(
@@ -92,6 +102,11 @@ class BrandSerializer(serializers.ModelSerializer):
         lookup_url_kwarg='brand_pk',
         lookup_field='id'
     )
+    conversations = serializers.HyperlinkedIdentityField(
+        view_name='brand-conversations-list',
+        lookup_url_kwarg='brand_pk',
+        lookup_field='id'
+    )
     representatives = serializers.HyperlinkedIdentityField(
         view_name='brand-representatives-list',
         lookup_url_kwarg='brand_pk',
@@ -103,10 +118,11 @@ class MessageSerializer(serializers.ModelSerializer, WriteOnceMixin):
     class Meta:
         model = models.Message
         fields = ('url', 'id', 'direction', 'state', 'platform', 'platform_conversation_id', 'client_message_id',
-                  'timestamp', 'metadata', 'media_type', 'content', 'error_description', 'brand_url', 'brand',
-                  'representative', 'representative_url')
+                  'timestamp', 'metadata', 'media_type', 'content', 'error_description', 'fallback_at', 'brand_url',
+                  'brand', 'representative', 'representative_url')
         read_only_fields = ('id', 'direction', 'state', 'timestamp', 'metadata',  'error_description', 'brand')
-        write_once_fields = ('platform', 'platform_conversation_id', 'client_message_id', 'media_type', 'content')
+        write_once_fields = ('platform', 'platform_conversation_id', 'client_message_id', 'media_type', 'content',
+                             'fallback_at')
 
     url = rest_framework_nested.relations.NestedHyperlinkedIdentityField(
         view_name='brand-messages-detail',
@@ -136,6 +152,11 @@ class MessageSerializer(serializers.ModelSerializer, WriteOnceMixin):
         if 'request' in self.context:
             self.fields["representative"].auth_token = self.context['request'].auth.token
 
+    def validate_fallback_at(self, value):
+        if value is not None and value <= timezone.now():
+            raise serializers.ValidationError("Fallback time must be in the future")
+        return value
+
     def to_representation(self, instance: models.Message):
         ret = {
             "url": self.fields["url"].to_representation(instance),
@@ -148,6 +169,8 @@ class MessageSerializer(serializers.ModelSerializer, WriteOnceMixin):
             "media_type": instance.media_type,
             "content": instance.content,
             "error_description": instance.error_description,
+            "fallback_at": self.fields["fallback_at"].to_representation(instance.fallback_at)
+            if instance.fallback_at else None,
             "brand_url": self.fields["brand_url"].to_representation(instance),
             "brand": self.fields["brand"].to_representation(instance.brand),
             "representative_url": self.fields["representative_url"].to_representation(instance)
@@ -163,22 +186,59 @@ class MessageSerializer(serializers.ModelSerializer, WriteOnceMixin):
         else:
             ret["state"] = "unknown"
 
-        if instance.state == models.Message.STATE_ACCEPTED:
-            ret["state"] = "accepted"
-        elif instance.state == models.Message.STATE_DISPATCHED:
-            ret["state"] = "dispatched"
-        elif instance.state == models.Message.STATE_DELIVERED:
-            ret["state"] = "delivered"
-        elif instance.state == models.Message.STATE_READ:
-            ret["state"] = "read"
-        elif instance.state == models.Message.STATE_FAILED:
-            ret["state"] = "failed"
-        else:
-            ret["state"] = "unknown"
+        ret["state"] = STATE_NAMES.get(instance.state, "unknown")
 
         return ret
 
 
+class ConversationSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.Conversation
+        fields = ('url', 'id', 'platform', 'platform_conversation_id', 'first_inbound_at', 'last_inbound_at',
+                  'inbound_count', 'last_activity_at', 'unread_count', 'last_state', 'metadata', 'last_message')
+        read_only_fields = fields
+
+    url = rest_framework_nested.relations.NestedHyperlinkedIdentityField(
+        view_name='brand-conversations-detail',
+        parent_lookup_kwargs={'brand_pk': 'brand__pk'},
+        lookup_field="id",
+        lookup_url_kwarg="pk"
+    )
+    last_state = serializers.SerializerMethodField()
+    last_message = serializers.SerializerMethodField()
+
+    def get_last_state(self, instance: models.Conversation):
+        return STATE_NAMES.get(instance.last_message.state, "unknown") if instance.last_message else None
+
+    def get_last_message(self, instance: models.Conversation):
+        if not instance.last_message:
+            return None
+        return MessageSerializer(instance=instance.last_message, context=self.context).data
+
+
+class WarmCapabilitiesSerializer(serializers.Serializer):
+    msisdns = serializers.ListField(child=serializers.CharField(max_length=32), max_length=10000)
+
+
+class MessageStateSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.Message
+        fields = ('id', 'client_message_id', 'state', 'timestamp', 'error_description')
+        read_only_fields = fields
+
+    def to_representation(self, instance: models.Message):
+        return {
+            "event": "state_changed",
+            "id": self.fields["id"].to_representation(instance),
+            "client_message_id": instance.client_message_id,
+            "state": STATE_NAMES.get(instance.state, "unknown"),
+            "timestamp": self.fields["timestamp"].to_representation(
+                instance.state_changed_at if instance.state_changed_at else instance.timestamp
+            ),
+            "error_description": instance.error_description,
+        }
+
+
 class RepresentativeSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.Representative
@@ -8,6 +8,7 @@ router.register(r'brands', views.BrandViewSet, basename='brand')
 
 brand_router = rest_framework_nested.routers.NestedDefaultRouter(router, r'brands', lookup='brand')
 brand_router.register(r'messages', views.MessageViewSet, basename='brand-messages')
+brand_router.register(r'conversations', views.ConversationViewSet, basename='brand-conversations')
 brand_router.register(r'representatives', views.RepresentativeSet, basename='brand-representatives')
 
 
@@ -1,10 +1,16 @@
-from rest_framework import viewsets, mixins
+from rest_framework import viewsets, mixins, pagination, status
+from rest_framework.decorators import action
+from rest_framework.response import Response
 from django.core.exceptions import PermissionDenied
+from django.conf import settings
 from as207960_utils.api import auth
 import as207960_utils.api.permissions
 from django.utils import timezone
+from django.db import transaction
 from . import serializers, permissions
-from .. import models, tasks
+from .. import models, outbox, tasks
+import rcs.tasks
+import sms.tasks
 
 
 class BrandViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
@@ -18,6 +24,23 @@ class BrandViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.Ge
 
         return models.Brand.get_object_list(self.request.auth.token)
 
+    @action(detail=True, methods=['post'], url_path='warm-capabilities',
+            serializer_class=serializers.WarmCapabilitiesSerializer)
+    def warm_capabilities(self, request, pk=None):
+        brand = self.get_object()
+        if not brand.has_scope(request.auth.token, 'edit'):
+            raise PermissionDenied
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        msisdns = serializer.validated_data["msisdns"]
+        chunk_size = settings.WARM_CAPABILITIES_CHUNK
+        with transaction.atomic():
+            for i in range(0, len(msisdns), chunk_size):
+                outbox.enqueue(rcs.tasks.warm_msisdn_capabilities, brand.id, msisdns[i:i + chunk_size])
+                outbox.enqueue(sms.tasks.prefetch_vsms_keys, brand.id, msisdns[i:i + chunk_size])
+        return Response(status=status.HTTP_202_ACCEPTED)
+
 
 class MessageViewSet(
     mixins.CreateModelMixin, mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet
@@ -30,15 +53,36 @@ class MessageViewSet(
         if not isinstance(self.request.auth, auth.OAuthToken):
             raise PermissionDenied
 
-        return models.Message.objects.filter(brand=self.kwargs['brand_pk'])
+        return models.Message.objects.filter(brand=self.kwargs['brand_pk'], pending_media__isnull=True)
 
     def perform_create(self, serializer: serializers.MessageSerializer):
-        serializer.save(
-            timestamp=timezone.now(),
-            brand_id=self.kwargs['brand_pk'],
-            direction=models.Message.DIRECTION_OUTGOING
+        with transaction.atomic():
+            serializer.save(
+                timestamp=timezone.now(),
+                brand_id=self.kwargs['brand_pk'],
+                direction=models.Message.DIRECTION_OUTGOING
+            )
+            models.Conversation.record_message(serializer.instance)
+            tasks.route_message(serializer.instance)
+
+
+class ConversationPagination(pagination.CursorPagination):
+    ordering = ('-last_activity_at', '-id')
+
+
+class ConversationViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    serializer_class = serializers.ConversationSerializer
+    queryset = models.Conversation.objects.all()
+    permission_classes = [permissions.brand_keycloak(models.Brand, view_listing=True)]
+    pagination_class = ConversationPagination
+
+    def filter_queryset(self, queryset):
+        if not isinstance(self.request.auth, auth.OAuthToken):
+            raise PermissionDenied
+
+        return models.Conversation.objects.filter(brand=self.kwargs['brand_pk']).select_related(
+            'last_message', 'last_message__brand', 'last_message__representative'
         )
-        tasks.process_message.delay(serializer.instance.id)
 
 
 class RepresentativeSet(
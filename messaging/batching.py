@@ -0,0 +1,51 @@
+import concurrent.futures
+import threading
+
+
+class _Batch:
+    def __init__(self):
+        self.futures = {}
+        self.full = threading.Event()
+
+
+# Concurrent callers within max_wait of each other share one call to func, which maps a list of keys to a dict
+class Batcher:
+    def __init__(self, func, max_size: int, max_wait: float):
+        self.func = func
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def get(self, key):
+        with self._lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            future = batch.futures.get(key)
+            if future is None:
+                future = batch.futures[key] = concurrent.futures.Future()
+            if len(batch.futures) >= self.max_size:
+                self._batch = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.max_wait)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+            self._run(batch)
+
+        return future.result()
+
+    def _run(self, batch: _Batch):
+        try:
+            results = self.func(list(batch.futures.keys()))
+        except Exception as e:
+            for future in batch.futures.values():
+                future.set_exception(e)
+            return
+
+        for key, future in batch.futures.items():
+            future.set_result(results.get(key))
@@ -0,0 +1,80 @@
+import collections
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    def __init__(self, name: str, max_size: int, ttl=None, stats_interval=None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats_interval = stats_interval
+        self._last_stats_log = time.monotonic()
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        self._maybe_log_stats()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl if ttl is not None else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_set(self, key, func, ttl=None):
+        value = self.get(key)
+        if value is None:
+            value = func()
+            self.set(key, value, ttl)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / (self.hits + self.misses) if self.hits + self.misses else None,
+                "evictions": self.evictions,
+            }
+
+    def _maybe_log_stats(self):
+        if self.stats_interval is None:
+            return
+        now = time.monotonic()
+        if now - self._last_stats_log < self.stats_interval:
+            return
+        self._last_stats_log = now
+        self.log_stats()
+
+    def log_stats(self):
+        logger.info("%s cache stats: %s", self.name, self.stats())
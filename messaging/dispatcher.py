@@ -0,0 +1,182 @@
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from celery.utils.time import get_exponential_backoff_interval
+from as207960_messaging.celery import app as celery_app
+from . import tasks, webhooks
+import concurrent.futures
+import dateutil.parser
+import threading
+import asyncio
+import logging
+import signal
+import socket
+import queue
+import uuid
+import httpx
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_TASKS = {
+    tasks.send_message.name: lambda task_id, message_id, state_change=False: tasks.prepare_message_webhook(
+        message_id, state_change
+    ),
+    tasks.flush_webhook_batch.name: lambda task_id, brand_id: tasks.prepare_webhook_batch(
+        brand_id, uuid.UUID(task_id)
+    ),
+    tasks.send_webhook_event.name: lambda task_id, event_id: tasks.prepare_event_webhook(
+        event_id, uuid.UUID(task_id)
+    ),
+}
+
+
+class WebhookDispatcher:
+    def __init__(self, concurrency: int, db_threads: int):
+        self.concurrency = concurrency
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=db_threads)
+        self.pool = webhooks.AsyncWebhookClientPool()
+        self.acks = queue.Queue()
+        self.draining = threading.Event()
+        self.stopping = threading.Event()
+        self.in_flight = set()
+        self.waiting = set()
+        self.loop = None
+        self.semaphore = None
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        stopped = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(sig, stopped.set)
+
+        consumer = threading.Thread(target=self.consume, name="webhook-consumer", daemon=True)
+        consumer.start()
+        logger.info("Webhook dispatcher consuming %s with %s concurrent deliveries", settings.WEBHOOK_QUEUE,
+                    self.concurrency)
+
+        await stopped.wait()
+        self.draining.set()
+        for waiting in list(self.waiting):
+            waiting.cancel()
+        logger.info("Webhook dispatcher stopping, waiting for %s deliveries", len(self.in_flight))
+        if self.in_flight:
+            await asyncio.wait(self.in_flight)
+        self.stopping.set()
+        await self.loop.run_in_executor(None, consumer.join)
+        await self.pool.aclose()
+        self.executor.shutdown()
+
+    def consume(self):
+        conn = celery_app.connection_for_read()
+        task_queue = celery_app.amqp.queues[settings.WEBHOOK_QUEUE]
+
+        while not self.stopping.is_set():
+            try:
+                with conn.Consumer(
+                        queues=[task_queue], callbacks=[self.on_message], accept=["json"],
+                        prefetch_count=self.concurrency * 2
+                ) as consumer:
+                    while not self.stopping.is_set():
+                        self.flush_acks()
+                        if self.draining.is_set():
+                            if consumer.consuming_from(task_queue):
+                                consumer.cancel()
+                            self.stopping.wait(0.1)
+                            continue
+                        try:
+                            conn.drain_events(timeout=0.1)
+                        except socket.timeout:
+                            pass
+                    self.flush_acks()
+            except conn.connection_errors:
+                logger.exception("Lost connection to broker, reconnecting")
+                conn = conn.clone()
+                self.stopping.wait(1)
+
+        conn.release()
+
+    def flush_acks(self):
+        while True:
+            try:
+                ack = self.acks.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                ack()
+            except Exception:
+                logger.exception("Failed to acknowledge webhook task, it will be redelivered")
+
+    def on_message(self, body, message):
+        task_name = message.headers.get("task")
+        if task_name not in WEBHOOK_TASKS:
+            logger.error("Received unknown task %s on webhook queue", task_name)
+            message.reject(requeue=False)
+            return
+
+        args, kwargs, _embed = body
+        future = asyncio.run_coroutine_threadsafe(self.handle(
+            task_name, message.headers["id"], args, kwargs,
+            message.headers.get("eta"), message.headers.get("retries") or 0, message
+        ), self.loop)
+        self.loop.call_soon_threadsafe(self.track, future)
+
+    def track(self, future):
+        wrapped = asyncio.wrap_future(future)
+        self.in_flight.add(wrapped)
+        wrapped.add_done_callback(self.in_flight.discard)
+
+    async def run_sync(self, func, *args):
+        def wrapped():
+            close_old_connections()
+            return func(*args)
+
+        return await self.loop.run_in_executor(self.executor, wrapped)
+
+    async def handle(self, task_name, task_id, args, kwargs, eta, retries, message):
+        if eta:
+            delay = (dateutil.parser.parse(eta) - timezone.now()).total_seconds()
+            if delay > 0:
+                waiting = asyncio.current_task()
+                self.waiting.add(waiting)
+                try:
+                    await asyncio.sleep(delay)
+                except asyncio.CancelledError:
+                    self.acks.put(lambda: message.reject(requeue=True))
+                    return
+                finally:
+                    self.waiting.discard(waiting)
+
+        ack = lambda: message.reject(requeue=True)
+        try:
+            async with self.semaphore:
+                try:
+                    delivery = await self.run_sync(lambda: WEBHOOK_TASKS[task_name](task_id, *args, **kwargs))
+                    if delivery is not None:
+                        try:
+                            await delivery.async_send(self.pool)
+                        except httpx.HTTPError as e:
+                            if not await self.run_sync(delivery.fail, e):
+                                raise
+                        else:
+                            await self.run_sync(delivery.complete)
+                except Exception as e:
+                    countdown = get_exponential_backoff_interval(
+                        factor=1, retries=retries, maximum=60, full_jitter=True
+                    )
+                    logger.warning("Webhook task %s[%s] failed, retrying in %ss: %s", task_name, task_id, countdown, e)
+                    try:
+                        await self.run_sync(lambda: celery_app.send_task(
+                            task_name, args=args, kwargs=kwargs, task_id=task_id, countdown=countdown,
+                            retries=retries + 1
+                        ))
+                    except Exception:
+                        logger.exception("Failed to retry webhook task %s[%s], returning it to the queue",
+                                         task_name, task_id)
+                        return
+            ack = message.ack
+        finally:
+            self.acks.put(ack)
@@ -0,0 +1,73 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+import datetime
+import logging
+import uuid
+from . import models
+
+logger = logging.getLogger(__name__)
+
+PROCESSORS = {
+    models.IngressEvent.SOURCE_GBM: "gbc.views.process_event",
+    models.IngressEvent.SOURCE_RCS: "rcs.views.process_event",
+}
+
+
+def append(source: str, body):
+    models.IngressEvent.objects.create(source=source, body=body)
+
+
+def claim_batch():
+    now = timezone.now()
+    claim_id = uuid.uuid4()
+    # Events claimed by a worker that died become claimable again once the lease runs out
+    claimable = Q(parked=False) & (Q(claimed_until__isnull=True) | Q(claimed_until__lt=now))
+    candidates = list(models.IngressEvent.objects.filter(claimable).order_by(
+        'timestamp'
+    ).values_list('id', 'attempts')[:settings.INGRESS_BATCH_SIZE])
+
+    # An event that keeps failing, or keeps taking its worker down, is set aside so it can't hold up the journal
+    exhausted = {
+        event_id: attempts for event_id, attempts in candidates if attempts >= settings.INGRESS_MAX_ATTEMPTS
+    }
+    if exhausted:
+        models.IngressEvent.objects.filter(claimable, id__in=list(exhausted)).update(parked=True)
+        for event_id, attempts in exhausted.items():
+            logger.error("Parked ingress event %s after %d attempts", event_id, attempts)
+
+    event_ids = [event_id for event_id, _ in candidates if event_id not in exhausted]
+    models.IngressEvent.objects.filter(claimable, id__in=event_ids).update(
+        claim_id=claim_id,
+        claimed_until=now + datetime.timedelta(seconds=settings.INGRESS_CLAIM_LEASE),
+        attempts=F('attempts') + 1
+    )
+    return list(models.IngressEvent.objects.filter(claim_id=claim_id).order_by('timestamp'))
+
+
+def process(event: models.IngressEvent) -> bool:
+    with transaction.atomic():
+        # Deleting first locks the event, and finds nothing if the lease ran out and another worker took it over
+        deleted, _ = models.IngressEvent.objects.filter(id=event.id, claim_id=event.claim_id).delete()
+        if not deleted:
+            logger.warning("Ingress event %s was reclaimed before it was processed, skipping", event.id)
+            return False
+
+        response = import_string(PROCESSORS[event.source])(event.body)
+        if response.status_code >= 400:
+            logger.warning(
+                "Dropped ingress event %s, %s processor returned %d", event.id, event.source, response.status_code
+            )
+    return True
+
+
+def process_batch() -> int:
+    events = claim_batch()
+    for event in events:
+        try:
+            process(event)
+        except Exception:
+            logger.exception("Failed to process ingress event %s (attempt %d)", event.id, event.attempts)
+    return len(events)
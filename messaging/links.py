@@ -0,0 +1,95 @@
+from django.conf import settings
+from django.utils import timezone
+import concurrent.futures
+import threading
+import datetime
+import requests
+import hashlib
+import json
+from . import models
+
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings.SHORT_LINK_CONCURRENCY)
+
+_lock = threading.Lock()
+_in_flight = {}
+
+
+def request_short_link(brand: models.Brand, link: str, short=True, title=None, description=None, image_url=None):
+    r = requests.post(
+        "https://firebasedynamiclinks.googleapis.com/v1/shortLinks",
+        params={
+            "key": settings.FIREBASE_API_KEY
+        },
+        json={
+            "dynamicLinkInfo": {
+                "domainUriPrefix": brand.firebase_short_domain
+                if brand.firebase_short_domain else "https://l.as207960.net",
+                "link": link,
+                "socialMetaTagInfo": {
+                    "socialTitle": title,
+                    "socialDescription": description,
+                    "socialImageLink": image_url,
+                }
+            },
+            "suffix": {
+                "option": "SHORT" if short else "UNGUESSABLE"
+            }
+        },
+        timeout=settings.SHORT_LINK_TIMEOUT
+    )
+    r.raise_for_status()
+    return r.json().get("shortLink")
+
+
+def link_key(brand: models.Brand, link: str, short=True, title=None, description=None, image_url=None) -> str:
+    return hashlib.sha256(json.dumps(
+        [brand.firebase_short_domain, link, short, title, description, image_url]
+    ).encode()).hexdigest()
+
+
+def _single_flight(key: str, func):
+    with _lock:
+        future = _in_flight.get(key)
+        leader = future is None
+        if leader:
+            future = _in_flight[key] = concurrent.futures.Future()
+
+    if leader:
+        try:
+            future.set_result(func())
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with _lock:
+                _in_flight.pop(key, None)
+
+    return future.result()
+
+
+def shorten_many(brand: models.Brand, link_requests) -> list:
+    keys = [link_key(brand, **link_request) for link_request in link_requests]
+    now = timezone.now()
+    short_links = dict(models.ShortLink.objects.filter(
+        key__in=keys, expires_at__gt=now
+    ).values_list('key', 'short_link'))
+
+    futures = {
+        key: executor.submit(_single_flight, key, lambda link_request=link_request: request_short_link(
+            brand, **link_request
+        ))
+        for key, link_request in zip(keys, link_requests) if key not in short_links
+    }
+    expires_at = now + datetime.timedelta(seconds=settings.SHORT_LINK_TTL)
+    for key, future in futures.items():
+        short_links[key] = future.result()
+        if short_links[key]:
+            models.ShortLink.objects.update_or_create(key=key, defaults={
+                "short_link": short_links[key],
+                "expires_at": expires_at,
+            })
+
+    return [short_links[key] for key in keys]
+
+
+def shorten(brand: models.Brand, link: str, **kwargs) -> str:
+    return shorten_many(brand, [dict(link=link, **kwargs)])[0]
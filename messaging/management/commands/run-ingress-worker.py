@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import close_old_connections
+import messaging.ingress
+import time
+
+
+class Command(BaseCommand):
+    help = "Process webhook events appended to the ingress journal"
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            if messaging.ingress.process_batch() < settings.INGRESS_BATCH_SIZE:
+                time.sleep(settings.INGRESS_POLL_INTERVAL)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import close_old_connections
+import messaging.outbox
+import time
+
+
+class Command(BaseCommand):
+    help = "Publish outbox tasks that were not handed to the broker when their transaction committed"
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            if messaging.outbox.relay() < settings.OUTBOX_RELAY_BATCH_SIZE:
+                time.sleep(settings.OUTBOX_RELAY_INTERVAL)
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+import messaging.dispatcher
+
+
+class Command(BaseCommand):
+    help = "Deliver brand webhooks from the webhook queue using asyncio"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=settings.WEBHOOK_DISPATCHER_CONCURRENCY)
+        parser.add_argument("--db-threads", type=int, default=settings.WEBHOOK_DISPATCHER_DB_THREADS)
+
+    def handle(self, *args, **options):
+        messaging.dispatcher.WebhookDispatcher(
+            concurrency=options["concurrency"],
+            db_threads=options["db_threads"],
+        ).run()
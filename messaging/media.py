@@ -0,0 +1,62 @@
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+import tempfile
+import hashlib
+import requests
+import mimetypes
+import os.path
+
+
+BLOB_PREFIX = "blobs"
+
+
+def blob_name(digest: str, ext: str) -> str:
+    return f"{BLOB_PREFIX}/{digest[:2]}/{digest}{ext}"
+
+
+def store_file(f, digest: str, ext: str) -> str:
+    name = blob_name(digest, ext)
+    if default_storage.exists(name):
+        return name
+
+    f.seek(0)
+    path = default_storage.save(name, File(f, name=name))
+    # Another writer stored the same content first, so the storage picked a new name for ours
+    if path != name:
+        default_storage.delete(path)
+    return name
+
+
+def store_chunks(chunks, ext: str) -> str:
+    digest = hashlib.sha256()
+    with tempfile.TemporaryFile() as f:
+        for chunk in chunks:
+            digest.update(chunk)
+            f.write(chunk)
+        return store_file(f, digest.hexdigest(), ext)
+
+
+def store_bytes(data: bytes, ext: str) -> str:
+    return store_chunks([data], ext)
+
+
+def download(url: str, file_name: str, media_type=None) -> dict:
+    with requests.get(url, stream=True, timeout=settings.MEDIA_DOWNLOAD_TIMEOUT) as r:
+        r.raise_for_status()
+        if not media_type:
+            media_type = r.headers.get("content-type")
+
+        _, ext = os.path.splitext(file_name)
+        if not ext and media_type:
+            ext = mimetypes.guess_extension(media_type, strict=False) or ""
+
+        # Hashed and spooled to disk chunk by chunk so large files never sit in worker memory
+        file_path = store_chunks(r.iter_content(chunk_size=settings.MEDIA_CHUNK_SIZE), ext)
+
+    return {
+        "url": settings.MEDIA_URL + file_path,
+        "media_type": media_type,
+        "title": None,
+        "text": None
+    }
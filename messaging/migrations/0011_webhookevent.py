@@ -0,0 +1,45 @@
+# Generated by Django 3.1.6 on 2026-10-18 10:02
+
+import as207960_utils.models
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0010_brand_firebase_short_domain'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='brand',
+            name='webhook_batching',
+            field=models.BooleanField(blank=True, default=False),
+        ),
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', as207960_utils.models.TypedUUIDField(data_type='messaging_webhookevent', editable=False, primary_key=True, serialize=False)),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('batch_id', models.UUIDField(blank=True, db_index=True, null=True)),
+                ('brand', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='messaging.brand')),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='messaging.message')),
+            ],
+            options={
+                'ordering': ['timestamp'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='webhookevent',
+            index=models.Index(fields=['brand', 'batch_id', 'timestamp'], name='messaging_w_brand_i_2993c5_idx'),
+        ),
+        migrations.CreateModel(
+            name='WebhookFlush',
+            fields=[
+                ('brand', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='webhook_flush', serialize=False, to='messaging.brand')),
+                ('pending', models.BooleanField(default=False)),
+            ],
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.1.6 on 2026-10-18 11:24
+
+import as207960_utils.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0011_webhookevent'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='webhookevent',
+            name='messaging_w_brand_i_2993c5_idx',
+        ),
+        migrations.AddField(
+            model_name='webhookevent',
+            name='parked',
+            field=models.BooleanField(blank=True, default=False),
+        ),
+        migrations.AddIndex(
+            model_name='webhookevent',
+            index=models.Index(fields=['brand', 'parked', 'batch_id', 'timestamp'], name='messaging_w_brand_i_f659bd_idx'),
+        ),
+        migrations.CreateModel(
+            name='WebhookBreaker',
+            fields=[
+                ('id', as207960_utils.models.TypedUUIDField(data_type='messaging_webhookbreaker', editable=False, primary_key=True, serialize=False)),
+                ('state', models.CharField(choices=[('C', 'Closed'), ('O', 'Open'), ('H', 'Half open')], default='C', max_length=1)),
+                ('consecutive_failures', models.PositiveIntegerField(default=0)),
+                ('opened_at', models.DateTimeField(blank=True, null=True)),
+                ('last_failure_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('brand', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='webhook_breaker', to='messaging.brand')),
+            ],
+        ),
+    ]
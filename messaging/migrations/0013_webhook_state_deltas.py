@@ -0,0 +1,28 @@
+# Generated by Django 3.1.6 on 2026-10-18 12:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0012_webhookbreaker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='brand',
+            name='webhook_state_deltas',
+            field=models.BooleanField(blank=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='webhookevent',
+            name='event_type',
+            field=models.CharField(choices=[('M', 'Message'), ('S', 'State change')], default='M', max_length=1),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='state_changed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.1.6 on 2026-10-18 13:41
+
+import as207960_utils.models
+import django.core.serializers.json
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0013_webhook_state_deltas'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxTask',
+            fields=[
+                ('id', as207960_utils.models.TypedUUIDField(data_type='messaging_outboxtask', editable=False, primary_key=True, serialize=False)),
+                ('task_name', models.CharField(max_length=255)),
+                ('args', models.JSONField(default=list, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('kwargs', models.JSONField(default=dict, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('options', models.JSONField(default=dict)),
+                ('timestamp', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('claim_id', models.UUIDField(blank=True, null=True)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['timestamp'],
+            },
+        ),
+    ]
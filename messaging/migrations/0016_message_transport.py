@@ -0,0 +1,48 @@
+# Generated by Django 3.1.6 on 2026-10-18 15:40
+
+from django.conf import settings
+from django.db import migrations, models
+import datetime
+
+
+def backfill_fallback_at(apps, schema_editor):
+    Message = apps.get_model('messaging', 'Message')
+
+    batch = []
+    for message in Message.objects.filter(
+            platform="msisdn-messaging", state="E", metadata__contains={"msisdn.transport": "rcs"}
+    ).exclude(media_type="chat_state").only('id', 'timestamp').iterator():
+        message.fallback_at = message.timestamp + datetime.timedelta(seconds=settings.RCS_FALLBACK_TIMEOUT)
+        batch.append(message)
+
+        if len(batch) >= 500:
+            Message.objects.bulk_update(batch, ['fallback_at'])
+            batch = []
+
+    if batch:
+        Message.objects.bulk_update(batch, ['fallback_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0015_accesstoken'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='fallback_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='fallback_armed',
+            field=models.BooleanField(blank=True, default=False),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['state', 'fallback_at'], name='messaging_m_state_e88d4d_idx'),
+        ),
+        migrations.RunPython(backfill_fallback_at, migrations.RunPython.noop),
+    ]
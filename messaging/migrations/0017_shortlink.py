@@ -0,0 +1,21 @@
+# Generated by Django 3.1.6 on 2026-10-18 17:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0016_message_transport'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShortLink',
+            fields=[
+                ('key', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('short_link', models.URLField(max_length=255)),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.1.6 on 2026-10-18 18:20
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min
+import as207960_utils.models
+import django.db.models.deletion
+
+
+def backfill_conversations(apps, schema_editor):
+    Message = apps.get_model('messaging', 'Message')
+    Conversation = apps.get_model('messaging', 'Conversation')
+
+    batch = []
+    for row in Message.objects.filter(direction="I").order_by().values(
+            'brand_id', 'platform', 'platform_conversation_id'
+    ).annotate(
+        first_inbound_at=Min('timestamp'), last_inbound_at=Max('timestamp'), inbound_count=Count('id')
+    ).iterator():
+        batch.append(Conversation(**row))
+
+        if len(batch) >= 500:
+            Conversation.objects.bulk_create(batch)
+            batch = []
+
+    if batch:
+        Conversation.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0017_shortlink'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', as207960_utils.models.TypedUUIDField(data_type='messaging_conversation', editable=False, primary_key=True, serialize=False)),
+                ('platform', models.CharField(choices=[('google-business-messaging', 'Google Business Messaging'), ('msisdn-messaging', 'MSISDN Messaging')], max_length=255)),
+                ('platform_conversation_id', models.CharField(max_length=255)),
+                ('first_inbound_at', models.DateTimeField()),
+                ('last_inbound_at', models.DateTimeField()),
+                ('inbound_count', models.PositiveIntegerField(default=0)),
+                ('brand', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='messaging.brand')),
+            ],
+            options={
+                'ordering': ['-last_inbound_at'],
+                'unique_together': {('brand', 'platform', 'platform_conversation_id')},
+            },
+        ),
+        migrations.RunPython(backfill_conversations, migrations.RunPython.noop),
+    ]
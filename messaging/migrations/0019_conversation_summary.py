@@ -0,0 +1,103 @@
+# Generated by Django 3.1.6 on 2026-10-18 19:05
+
+from django.db import migrations, models
+from django.db.models import Count, Exists, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def backfill_summaries(apps, schema_editor):
+    Message = apps.get_model('messaging', 'Message')
+    Conversation = apps.get_model('messaging', 'Conversation')
+    now = django.utils.timezone.now()
+
+    def same_conversation(model):
+        return model.objects.filter(
+            brand_id=OuterRef('brand_id'), platform=OuterRef('platform'),
+            platform_conversation_id=OuterRef('platform_conversation_id')
+        ).order_by()
+
+    # 0018 only created conversations with inbound messages
+    batch = []
+    for key in Message.objects.filter(~Exists(same_conversation(Conversation))).order_by().values(
+            'brand_id', 'platform', 'platform_conversation_id'
+    ).distinct().iterator():
+        batch.append(Conversation(**key, last_activity_at=now))
+
+        if len(batch) >= 500:
+            Conversation.objects.bulk_create(batch)
+            batch = []
+
+    if batch:
+        Conversation.objects.bulk_create(batch)
+
+    messages = same_conversation(Message).exclude(media_type="chat_state")
+    latest = messages.order_by('-timestamp')
+    incoming = messages.filter(direction="I")
+    # Inbound messages with no outgoing message at or after them
+    unread = incoming.filter(~Exists(same_conversation(Message).exclude(media_type="chat_state").filter(
+        direction="O", timestamp__gte=OuterRef('timestamp')
+    ))).values('brand_id').annotate(count=Count('id')).values('count')
+
+    Conversation.objects.update(
+        last_message=Subquery(latest.values('id')[:1]),
+        last_activity_at=Coalesce(
+            Subquery(latest.values('timestamp')[:1]), F('last_inbound_at'), Value(now),
+            output_field=models.DateTimeField()
+        ),
+        unread_count=Coalesce(Subquery(unread), Value(0), output_field=models.PositiveIntegerField()),
+    )
+    Conversation.objects.filter(Exists(incoming)).update(
+        metadata=Subquery(incoming.order_by('-timestamp').values('metadata')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0018_conversation'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='conversation',
+            name='first_inbound_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='conversation',
+            name='last_inbound_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='messaging.message'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='metadata',
+            field=models.JSONField(default=dict),
+        ),
+        migrations.AlterModelOptions(
+            name='conversation',
+            options={'ordering': ['-last_activity_at', '-id']},
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['brand', '-last_activity_at', '-id'], name='messaging_c_brand_i_d2e748_idx'),
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.6 on 2026-10-18 19:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0019_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='pending_media',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
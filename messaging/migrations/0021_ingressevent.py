@@ -0,0 +1,31 @@
+# Generated by Django 3.1.6 on 2026-10-18 20:30
+
+from django.db import migrations, models
+import as207960_utils.models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0020_message_pending_media'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngressEvent',
+            fields=[
+                ('id', as207960_utils.models.TypedUUIDField(data_type='messaging_ingressevent', editable=False, primary_key=True, serialize=False)),
+                ('source', models.CharField(choices=[('gbm', 'Google Business Messaging'), ('rcs', 'RCS')], max_length=16)),
+                ('body', models.JSONField()),
+                ('timestamp', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('claim_id', models.UUIDField(blank=True, db_index=True, null=True)),
+                ('claimed_until', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('parked', models.BooleanField(blank=True, default=False)),
+            ],
+            options={
+                'ordering': ['timestamp'],
+            },
+        ),
+    ]
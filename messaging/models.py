@@ -1,11 +1,15 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+from django.db.models.functions import Coalesce, Greatest, Least
+from django.utils import timezone
 import as207960_utils.models
 import django_keycloak_auth.clients
-from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import UploadedFile
 from PIL import Image
 import io
 import uuid
+from . import media
 
 
 class Brand(models.Model):
@@ -17,6 +21,8 @@ class Brand(models.Model):
     authorization_url = models.URLField(blank=True, null=True)
     client_id = models.CharField(max_length=255, blank=True, null=True)
     firebase_short_domain = models.CharField(max_length=255, blank=True, null=True)
+    webhook_batching = models.BooleanField(default=False, blank=True)
+    webhook_state_deltas = models.BooleanField(default=False, blank=True)
 
     def __str__(self):
         return self.name
@@ -70,7 +76,8 @@ class Representative(models.Model):
                 background.paste(img, img.split()[-1])
                 img = background
             img.save(output, format='JPEG', quality=50, optimise=True)
-            self.avatar.save("%s.jpg" % self.avatar.name.split('.')[0], ContentFile(output.getvalue()), save=False)
+            # Assigning the stored name gives a committed file, so pre_save doesn't write the original upload too
+            self.avatar = media.store_bytes(output.getvalue(), ".jpg")
         super().save(*args, **kwargs)
 
 
@@ -101,6 +108,13 @@ class Message(models.Model):
         (STATE_READ, "Read"),
         (STATE_FAILED, "Failed"),
     )
+    STATE_ORDER = {
+        STATE_ACCEPTED: 0,
+        STATE_DISPATCHED: 1,
+        STATE_DELIVERED: 2,
+        STATE_FAILED: 2,
+        STATE_READ: 3,
+    }
 
     id = as207960_utils.models.TypedUUIDField("messaging_message", primary_key=True, editable=False)
     direction = models.CharField(max_length=1, choices=DIRECTIONS)
@@ -117,6 +131,204 @@ class Message(models.Model):
     media_type = models.CharField(max_length=255)
     content = models.JSONField(blank=True, null=True)
     error_description = models.TextField(blank=True, null=True)
+    fallback_at = models.DateTimeField(blank=True, null=True)
+    fallback_armed = models.BooleanField(blank=True, default=False)
+    pending_media = models.JSONField(blank=True, null=True)
+    state_changed_at = models.DateTimeField(blank=True, null=True)
 
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['state', 'fallback_at']),
+        ]
+
+    def advance_state(self, state, **fields) -> bool:
+        earlier_states = [s for s, order in self.STATE_ORDER.items() if order < self.STATE_ORDER[state]]
+        fields.setdefault("state_changed_at", timezone.now())
+        if not Message.objects.filter(id=self.id, state__in=earlier_states).update(state=state, **fields):
+            return False
+
+        self.state = state
+        for field, value in fields.items():
+            setattr(self, field, value)
+        return True
+
+
+class Conversation(models.Model):
+    id = as207960_utils.models.TypedUUIDField("messaging_conversation", primary_key=True, editable=False)
+    brand = models.ForeignKey(Brand, on_delete=models.CASCADE)
+    platform = models.CharField(max_length=255, choices=Message.PLATFORMS)
+    platform_conversation_id = models.CharField(max_length=255)
+    first_inbound_at = models.DateTimeField(blank=True, null=True)
+    last_inbound_at = models.DateTimeField(blank=True, null=True)
+    inbound_count = models.PositiveIntegerField(default=0)
+    last_message = models.ForeignKey(Message, on_delete=models.SET_NULL, blank=True, null=True, related_name='+')
+    last_activity_at = models.DateTimeField()
+    unread_count = models.PositiveIntegerField(default=0)
+    metadata = models.JSONField(default=dict)
+
+    class Meta:
+        ordering = ['-last_activity_at', '-id']
+        unique_together = (
+            ('brand', 'platform', 'platform_conversation_id'),
+        )
+        indexes = [
+            models.Index(fields=['brand', '-last_activity_at', '-id']),
+        ]
+
+    @classmethod
+    def for_message(cls, message: Message):
+        return cls.objects.filter(
+            brand_id=message.brand_id, platform=message.platform,
+            platform_conversation_id=message.platform_conversation_id
+        ).first()
+
+    @classmethod
+    def record_message(cls, message: Message):
+        conversation = cls.for_message(message)
+        if not conversation:
+            try:
+                with transaction.atomic():
+                    conversation = cls.objects.create(
+                        brand_id=message.brand_id, platform=message.platform,
+                        platform_conversation_id=message.platform_conversation_id,
+                        last_activity_at=message.timestamp,
+                    )
+            except IntegrityError:
+                conversation = cls.objects.get(
+                    brand_id=message.brand_id, platform=message.platform,
+                    platform_conversation_id=message.platform_conversation_id,
+                )
+        conversation_filter = cls.objects.filter(id=conversation.id)
+
+        # Chat states count towards the conversation being open, but aren't part of the summary
+        is_content = message.media_type != "chat_state"
+        if message.direction == Message.DIRECTION_INCOMING:
+            update = {
+                "first_inbound_at": Coalesce(Least(F('first_inbound_at'), message.timestamp), message.timestamp),
+                "last_inbound_at": Coalesce(Greatest(F('last_inbound_at'), message.timestamp), message.timestamp),
+                "inbound_count": F('inbound_count') + 1,
+            }
+            if is_content:
+                update["unread_count"] = F('unread_count') + 1
+            conversation_filter.update(**update)
+        elif is_content:
+            conversation_filter.update(unread_count=0)
+
+        # Messages with media still downloading are summarised once ingest_media has stored it
+        if is_content and not message.pending_media:
+            cls.record_latest(message)
+
+    @classmethod
+    def record_latest(cls, message: Message):
+        # Only the newest message replaces the summary, so a late delivery can't roll back the metadata
+        latest = {"last_message": message, "last_activity_at": message.timestamp}
+        if message.direction == Message.DIRECTION_INCOMING:
+            latest["metadata"] = message.metadata
+        cls.objects.filter(
+            brand_id=message.brand_id, platform=message.platform,
+            platform_conversation_id=message.platform_conversation_id,
+            last_activity_at__lte=message.timestamp
+        ).update(**latest)
+
+
+class WebhookEvent(models.Model):
+    TYPE_MESSAGE = "M"
+    TYPE_STATE = "S"
+    TYPES = (
+        (TYPE_MESSAGE, "Message"),
+        (TYPE_STATE, "State change"),
+    )
+
+    id = as207960_utils.models.TypedUUIDField("messaging_webhookevent", primary_key=True, editable=False)
+    brand = models.ForeignKey(Brand, on_delete=models.CASCADE)
+    message = models.ForeignKey(Message, on_delete=models.CASCADE)
+    event_type = models.CharField(max_length=1, choices=TYPES, default=TYPE_MESSAGE)
+    timestamp = models.DateTimeField(default=timezone.now)
+    batch_id = models.UUIDField(blank=True, null=True, db_index=True)
+    parked = models.BooleanField(default=False, blank=True)
+
+    class Meta:
+        ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['brand', 'parked', 'batch_id', 'timestamp']),
+        ]
+
+
+class WebhookBreaker(models.Model):
+    STATE_CLOSED = "C"
+    STATE_OPEN = "O"
+    STATE_HALF_OPEN = "H"
+    STATES = (
+        (STATE_CLOSED, "Closed"),
+        (STATE_OPEN, "Open"),
+        (STATE_HALF_OPEN, "Half open"),
+    )
+
+    id = as207960_utils.models.TypedUUIDField("messaging_webhookbreaker", primary_key=True, editable=False)
+    brand = models.OneToOneField(Brand, on_delete=models.CASCADE, related_name='webhook_breaker')
+    state = models.CharField(max_length=1, choices=STATES, default=STATE_CLOSED)
+    consecutive_failures = models.PositiveIntegerField(default=0)
+    opened_at = models.DateTimeField(blank=True, null=True)
+    last_failure_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True, null=True)
+
+    def __str__(self):
+        return self.brand.name
+
+    @property
+    def parked_events(self):
+        return WebhookEvent.objects.filter(brand_id=self.brand_id, parked=True).count()
+
+
+class WebhookFlush(models.Model):
+    brand = models.OneToOneField(Brand, on_delete=models.CASCADE, primary_key=True, related_name='webhook_flush')
+    pending = models.BooleanField(default=False)
+
+
+class OutboxTask(models.Model):
+    id = as207960_utils.models.TypedUUIDField("messaging_outboxtask", primary_key=True, editable=False)
+    task_name = models.CharField(max_length=255)
+    args = models.JSONField(default=list, encoder=DjangoJSONEncoder)
+    kwargs = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    options = models.JSONField(default=dict)
+    timestamp = models.DateTimeField(default=timezone.now, db_index=True)
+    claim_id = models.UUIDField(blank=True, null=True)
+    claimed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['timestamp']
+
+
+class AccessToken(models.Model):
+    key = models.CharField(max_length=64, primary_key=True)
+    token = models.TextField(blank=True, null=True)
+    expiry = models.DateTimeField(blank=True, null=True)
+    lease_until = models.DateTimeField(blank=True, null=True)
+
+
+class ShortLink(models.Model):
+    key = models.CharField(max_length=64, primary_key=True)
+    short_link = models.URLField(max_length=255)
+    expires_at = models.DateTimeField()
+
+
+class IngressEvent(models.Model):
+    SOURCE_GBM = "gbm"
+    SOURCE_RCS = "rcs"
+    SOURCES = (
+        (SOURCE_GBM, "Google Business Messaging"),
+        (SOURCE_RCS, "RCS"),
+    )
+
+    id = as207960_utils.models.TypedUUIDField("messaging_ingressevent", primary_key=True, editable=False)
+    source = models.CharField(max_length=16, choices=SOURCES)
+    body = models.JSONField()
+    timestamp = models.DateTimeField(default=timezone.now, db_index=True)
+    claim_id = models.UUIDField(blank=True, null=True, db_index=True)
+    claimed_until = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    parked = models.BooleanField(default=False, blank=True)
+
+    class Meta:
+        ordering = ['timestamp']
@@ -0,0 +1,87 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from as207960_messaging.celery import app as celery_app
+from . import models
+import datetime
+import threading
+import logging
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+# Entry IDs enqueued on this thread's connection and not yet handed to the broker
+_pending = threading.local()
+
+
+def _publish_pending():
+    entry_ids = getattr(_pending, "entry_ids", [])
+    _pending.entry_ids = []
+    if not entry_ids:
+        return
+
+    try:
+        publish(entry_ids)
+    except Exception:
+        logger.exception("Failed to publish outbox tasks, leaving them for the relay")
+
+
+def enqueue(task, *args, countdown=None, **kwargs):
+    entry = models.OutboxTask(
+        task_name=task.name, args=list(args), kwargs=kwargs,
+        options={"countdown": countdown} if countdown else {}
+    )
+    entry.save()
+
+    # The first callback to run after commit publishes everything enqueued in the transaction over one broker
+    # session, the rest find nothing left. IDs left behind by a rollback no longer have a row and are skipped.
+    if not hasattr(_pending, "entry_ids"):
+        _pending.entry_ids = []
+    _pending.entry_ids.append(entry.id)
+    transaction.on_commit(_publish_pending)
+
+
+def unclaimed() -> Q:
+    return Q(claimed_at__isnull=True) | Q(
+        claimed_at__lt=timezone.now() - datetime.timedelta(seconds=settings.OUTBOX_CLAIM_TIMEOUT)
+    )
+
+
+def claim(entry_ids):
+    # Taken by one conditional update, so of the on-commit publisher and any relays only one sends each entry
+    claim_id = uuid.uuid4()
+    models.OutboxTask.objects.filter(id__in=entry_ids).filter(unclaimed()).update(
+        claim_id=claim_id, claimed_at=timezone.now()
+    )
+    return list(models.OutboxTask.objects.filter(claim_id=claim_id).order_by('timestamp'))
+
+
+def publish(entry_ids):
+    entries = claim(entry_ids)
+    if not entries:
+        return 0
+
+    published = []
+    try:
+        with celery_app.producer_or_acquire() as producer:
+            for entry in entries:
+                celery_app.send_task(
+                    entry.task_name, args=entry.args, kwargs=entry.kwargs, producer=producer, **entry.options
+                )
+                published.append(entry.id)
+    finally:
+        models.OutboxTask.objects.filter(id__in=published).delete()
+        models.OutboxTask.objects.filter(id__in=[entry.id for entry in entries]).exclude(id__in=published).update(
+            claim_id=None, claimed_at=None
+        )
+    return len(published)
+
+
+def relay():
+    cutoff = timezone.now() - datetime.timedelta(seconds=settings.OUTBOX_RELAY_GRACE)
+    entry_ids = list(models.OutboxTask.objects.filter(timestamp__lt=cutoff).filter(
+        unclaimed()
+    ).order_by('timestamp').values_list('id', flat=True)[:settings.OUTBOX_RELAY_BATCH_SIZE])
+    return publish(entry_ids)
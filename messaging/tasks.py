@@ -1,36 +1,40 @@
 from celery import shared_task
-from . import models
+from . import media, models, outbox, webhooks
 from .api import serializers
 from django.conf import settings
 from django.shortcuts import reverse
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
 import gbc.tasks
 import rcs.tasks
 import collections
 import json
-import hmac
 import requests
 import dateutil.parser
 import base64
+import uuid
+import httpx
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 def make_calendar_fallback(message, content):
+    # Fails the message and returns None if the event is invalid
     if not (
             "start_time" in content and "end_time" in content and
             "title" in content and "description" in content and
             "text" in content
     ):
-        message.state = message.STATE_FAILED
-        message.error_description = "Invalid message"
-        message.save()
+        fail_message(message, "Invalid message")
         return
 
     try:
         start_time = dateutil.parser.parse(content["start_time"])
         end_time = dateutil.parser.parse(content["end_time"])
     except dateutil.parser.ParserError:
-        message.state = message.STATE_FAILED
-        message.error_description = "Invalid message"
-        message.save()
+        fail_message(message, "Invalid message")
         return
     calendar_data = base64.urlsafe_b64encode(json.dumps({
         "start": int(start_time.timestamp()),
@@ -41,43 +45,49 @@ def make_calendar_fallback(message, content):
     return settings.EXTERNAL_URL_BASE + reverse('messaging:calendar_event', args=(calendar_data,))
 
 
-def shorten_link(brand: models.Brand, link: str, short=True, title=None, description=None, image_url=None):
-    r = requests.post(
-        "https://firebasedynamiclinks.googleapis.com/v1/shortLinks",
-        params={
-            "key": settings.FIREBASE_API_KEY
-        },
-        json={
-            "dynamicLinkInfo": {
-                "domainUriPrefix": brand.firebase_short_domain
-                if brand.firebase_short_domain else "https://l.as207960.net",
-                "link": link,
-                "socialMetaTagInfo": {
-                    "socialTitle": title,
-                    "socialDescription": description,
-                    "socialImageLink": image_url,
-                }
-            },
-            "suffix": {
-                "option": "SHORT" if short else "UNGUESSABLE"
-            }
-        }
-    )
-    r.raise_for_status()
-    return r.json().get("shortLink")
-
-
-@shared_task(ignore_result=True)
-def process_message(message_id):
-    message = models.Message.objects.get(id=message_id)
-
+def message_route(message: models.Message):
     if message.direction == message.DIRECTION_OUTGOING:
         if message.platform == message.PLATFORM_GBM:
-            gbc.tasks.send_message.delay(message.id)
+            return gbc.tasks.send_message
         elif message.platform == message.PLATFORM_MSISDN:
-            rcs.tasks.send_message.delay(message.id)
+            return rcs.tasks.send_message
     elif message.direction == message.DIRECTION_INCOMING:
-        send_message.delay(message.id)
+        return send_message
+    return None
+
+
+def route_message(message: models.Message):
+    if (task := message_route(message)) is not None:
+        outbox.enqueue(task, message.id)
+
+
+def save_and_route(message: models.Message):
+    with transaction.atomic():
+        message.save()
+        if message.direction == message.DIRECTION_INCOMING:
+            models.Conversation.record_message(message)
+        if message.pending_media:
+            outbox.enqueue(ingest_media, message.id)
+        else:
+            route_message(message)
+
+
+def save_and_notify(message: models.Message, update_fields):
+    with transaction.atomic():
+        message.save(update_fields=update_fields)
+        outbox.enqueue(send_message, message.id)
+
+
+def fail_message(message: models.Message, error_description: str):
+    with transaction.atomic():
+        if message.advance_state(message.STATE_FAILED, error_description=error_description):
+            queue_state_webhook(message)
+
+
+# Kept so tasks queued before routing moved to ingest time still drain
+@shared_task(ignore_result=True)
+def process_message(message_id):
+    route_message(models.Message.objects.get(id=message_id))
 
 
 class FakeRequest:
@@ -92,31 +102,319 @@ class FakeRequest:
         return settings.EXTERNAL_URL_BASE + url
 
 
+def serialize_message(message: models.Message):
+    return serializers.MessageSerializer(instance=message, context={
+        "view": collections.namedtuple("View", ['kwargs'])(kwargs={
+            "brand_pk": message.brand_id
+        }),
+        "request": FakeRequest()
+    }).data
+
+
+def serialize_event(message: models.Message, event_type: str):
+    if event_type == models.WebhookEvent.TYPE_STATE and message.brand.webhook_state_deltas:
+        return serializers.MessageStateSerializer(instance=message).data
+    return serialize_message(message)
+
+
+def get_webhook_breaker(brand: models.Brand):
+    try:
+        return brand.webhook_breaker
+    except models.WebhookBreaker.DoesNotExist:
+        return None
+
+
+def webhook_breaker_closed(brand: models.Brand):
+    breaker = get_webhook_breaker(brand)
+    return breaker is None or breaker.state == breaker.STATE_CLOSED
+
+
+def record_webhook_success(brand: models.Brand):
+    breaker = get_webhook_breaker(brand)
+    if breaker and breaker.consecutive_failures:
+        models.WebhookBreaker.objects.filter(
+            id=breaker.id, state=models.WebhookBreaker.STATE_CLOSED
+        ).update(consecutive_failures=0)
+
+
+def record_webhook_failure(brand: models.Brand, error) -> bool:
+    breaker, _ = models.WebhookBreaker.objects.get_or_create(brand=brand)
+    models.WebhookBreaker.objects.filter(id=breaker.id).update(
+        consecutive_failures=F('consecutive_failures') + 1,
+        last_failure_at=timezone.now(),
+        last_error=str(error),
+    )
+    breaker.refresh_from_db()
+
+    if breaker.state == breaker.STATE_CLOSED:
+        if breaker.consecutive_failures < settings.WEBHOOK_BREAKER_THRESHOLD:
+            return False
+
+        if models.WebhookBreaker.objects.filter(id=breaker.id, state=breaker.STATE_CLOSED).update(
+                state=breaker.STATE_OPEN, opened_at=timezone.now()
+        ):
+            logger.warning("Opening webhook circuit for brand %s after %s failures", brand.id,
+                           breaker.consecutive_failures)
+            outbox.enqueue(drain_webhook_backlog, brand.id, countdown=settings.WEBHOOK_BREAKER_COOLDOWN)
+
+    return True
+
+
+def park_webhook_event(message: models.Message, event_type: str):
+    models.WebhookEvent(brand_id=message.brand_id, message=message, event_type=event_type, parked=True).save()
+
+
+def schedule_webhook_flush(brand_id, countdown=None):
+    # At most one flush is outstanding per brand, prepare_webhook_batch clears the marker when it runs
+    _, created = models.WebhookFlush.objects.get_or_create(brand_id=brand_id, defaults={"pending": True})
+    if created or models.WebhookFlush.objects.filter(brand_id=brand_id, pending=False).update(pending=True):
+        outbox.enqueue(flush_webhook_batch, brand_id, countdown=countdown)
+
+
+def queue_webhook_event(message: models.Message, event_type: str):
+    with transaction.atomic():
+        models.WebhookEvent(brand=message.brand, message=message, event_type=event_type).save()
+        schedule_webhook_flush(message.brand_id, countdown=settings.WEBHOOK_BATCH_WINDOW)
+
+
+def message_webhook_failed(message: models.Message, event_type: str, error) -> bool:
+    if record_webhook_failure(message.brand, error):
+        park_webhook_event(message, event_type)
+        return True
+    return False
+
+
+def prepare_message_webhook(message_id, state_change=False):
+    message = models.Message.objects.select_related('brand', 'brand__webhook_breaker').get(id=message_id)
+    event_type = models.WebhookEvent.TYPE_STATE if state_change else models.WebhookEvent.TYPE_MESSAGE
+
+    if not message.brand.webhook_url:
+        return None
+
+    if not webhook_breaker_closed(message.brand):
+        park_webhook_event(message, event_type)
+        return None
+
+    if message.brand.webhook_batching:
+        queue_webhook_event(message, event_type)
+        return None
+
+    return webhooks.WebhookDelivery(
+        message.brand, serialize_event(message, event_type),
+        on_complete=lambda: record_webhook_success(message.brand),
+        on_failure=lambda error: message_webhook_failed(message, event_type, error)
+    )
+
+
+def finish_webhook_batch(brand: models.Brand, batch_id: uuid.UUID):
+    models.WebhookEvent.objects.filter(batch_id=batch_id).delete()
+    record_webhook_success(brand)
+
+    pending_events = models.WebhookEvent.objects.filter(
+        brand=brand, parked=False, batch_id__isnull=True
+    )[:settings.WEBHOOK_BATCH_MAX_SIZE].count()
+    if pending_events:
+        schedule_webhook_flush(
+            brand.id, countdown=None if pending_events >= settings.WEBHOOK_BATCH_MAX_SIZE
+            else settings.WEBHOOK_BATCH_WINDOW
+        )
+
+
+def park_webhook_batch(batch_id: uuid.UUID):
+    models.WebhookEvent.objects.filter(batch_id=batch_id).update(parked=True, batch_id=None)
+
+
+def webhook_batch_failed(brand: models.Brand, batch_id: uuid.UUID, error) -> bool:
+    if record_webhook_failure(brand, error):
+        park_webhook_batch(batch_id)
+        return True
+    return False
+
+
+def prepare_webhook_batch(brand_id, batch_id: uuid.UUID):
+    # Cleared before the batch is claimed, in whichever worker runs the flush, so events queued from here on
+    # schedule the next one
+    models.WebhookFlush.objects.filter(brand_id=brand_id).update(pending=False)
+    brand = models.Brand.objects.select_related('webhook_breaker').get(id=brand_id)
+
+    batch_events = models.WebhookEvent.objects.filter(batch_id=batch_id)
+    if not batch_events.exists():
+        event_ids = list(models.WebhookEvent.objects.filter(
+            brand=brand, parked=False, batch_id__isnull=True
+        ).order_by('timestamp').values_list('id', flat=True)[:settings.WEBHOOK_BATCH_MAX_SIZE])
+        models.WebhookEvent.objects.filter(id__in=event_ids, batch_id__isnull=True).update(batch_id=batch_id)
+
+    if not webhook_breaker_closed(brand):
+        park_webhook_batch(batch_id)
+        return None
+
+    batch_events = list(batch_events.order_by('timestamp').select_related('message', 'message__brand'))
+    if not (batch_events and brand.webhook_url):
+        finish_webhook_batch(brand, batch_id)
+        return None
+
+    return webhooks.WebhookDelivery(
+        brand, [serialize_event(event.message, event.event_type) for event in batch_events],
+        on_complete=lambda: finish_webhook_batch(brand, batch_id),
+        on_failure=lambda error: webhook_batch_failed(brand, batch_id, error)
+    )
+
+
+def queue_state_webhook(message: models.Message):
+    if settings.WEBHOOK_COALESCE_WINDOW <= 0:
+        outbox.enqueue(send_message, message.id, state_change=True)
+        return
+
+    # An undelivered state event serialises the message when it is sent, so it already carries this update
+    if models.WebhookEvent.objects.filter(
+            message=message, event_type=models.WebhookEvent.TYPE_STATE, parked=False, batch_id__isnull=True
+    ).exists():
+        return
+
+    if message.brand.webhook_batching:
+        queue_webhook_event(message, models.WebhookEvent.TYPE_STATE)
+        return
+
+    event = models.WebhookEvent(brand=message.brand, message=message, event_type=models.WebhookEvent.TYPE_STATE)
+    event.save()
+    outbox.enqueue(send_webhook_event, event.id, countdown=settings.WEBHOOK_COALESCE_WINDOW)
+
+
+def finish_webhook_event(event: models.WebhookEvent):
+    event.delete()
+    record_webhook_success(event.brand)
+
+
+def prepare_event_webhook(event_id, batch_id: uuid.UUID):
+    models.WebhookEvent.objects.filter(id=event_id, parked=False, batch_id__isnull=True).update(batch_id=batch_id)
+    event = models.WebhookEvent.objects.select_related(
+        'message', 'brand', 'brand__webhook_breaker'
+    ).filter(id=event_id, batch_id=batch_id).first()
+
+    if not event:
+        return None
+
+    if not event.brand.webhook_url:
+        event.delete()
+        return None
+
+    if not webhook_breaker_closed(event.brand):
+        park_webhook_batch(batch_id)
+        return None
+
+    return webhooks.WebhookDelivery(
+        event.brand, serialize_event(event.message, event.event_type),
+        on_complete=lambda: finish_webhook_event(event),
+        on_failure=lambda error: webhook_batch_failed(event.brand, batch_id, error)
+    )
+
+
 @shared_task(
     autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=None, default_retry_delay=3,
     ignore_result=True
 )
-def send_message(message_id):
+def send_message(message_id, state_change=False):
+    if (delivery := prepare_message_webhook(message_id, state_change)) is not None:
+        delivery.send()
+
+
+@shared_task(
+    bind=True, autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=None,
+    default_retry_delay=3, ignore_result=True
+)
+def flush_webhook_batch(self, brand_id):
+    # The task ID is stable across retries, so a retried flush re-sends the batch it already claimed
+    if (delivery := prepare_webhook_batch(brand_id, uuid.UUID(self.request.id))) is not None:
+        delivery.send()
+
+
+@shared_task(
+    bind=True, autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=None,
+    default_retry_delay=3, ignore_result=True
+)
+def send_webhook_event(self, event_id):
+    if (delivery := prepare_event_webhook(event_id, uuid.UUID(self.request.id))) is not None:
+        delivery.send()
+
+
+@shared_task(
+    autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=None, default_retry_delay=3,
+    ignore_result=True
+)
+def drain_webhook_backlog(brand_id):
+    brand = models.Brand.objects.get(id=brand_id)
+    breaker = models.WebhookBreaker.objects.get(brand=brand)
+    if breaker.state == breaker.STATE_CLOSED:
+        return
+    models.WebhookBreaker.objects.filter(id=breaker.id).update(state=breaker.STATE_HALF_OPEN)
+
+    parked_events = list(models.WebhookEvent.objects.filter(
+        brand=brand, parked=True
+    ).order_by('timestamp').select_related('message', 'message__brand')[:settings.WEBHOOK_BATCH_MAX_SIZE])
+
+    if not parked_events:
+        models.WebhookBreaker.objects.filter(id=breaker.id).update(
+            state=breaker.STATE_CLOSED, consecutive_failures=0, opened_at=None
+        )
+        # Events parked between the empty read and closing the breaker would otherwise be stranded
+        if models.WebhookEvent.objects.filter(brand=brand, parked=True).exists() and \
+                models.WebhookBreaker.objects.filter(id=breaker.id, state=breaker.STATE_CLOSED).update(
+                    state=breaker.STATE_HALF_OPEN
+                ):
+            outbox.enqueue(drain_webhook_backlog, brand.id)
+        else:
+            logger.info("Closed webhook circuit for brand %s", brand.id)
+        return
+
+    if brand.webhook_batching:
+        deliveries = [(parked_events, [serialize_event(event.message, event.event_type) for event in parked_events])]
+    else:
+        deliveries = [([event], serialize_event(event.message, event.event_type)) for event in parked_events]
+
+    for events, data in deliveries:
+        try:
+            webhooks.WebhookDelivery(brand, data).send()
+        except httpx.HTTPError as e:
+            models.WebhookBreaker.objects.filter(id=breaker.id).update(
+                state=breaker.STATE_OPEN, opened_at=timezone.now(), last_failure_at=timezone.now(),
+                last_error=str(e), consecutive_failures=F('consecutive_failures') + 1,
+            )
+            outbox.enqueue(drain_webhook_backlog, brand.id, countdown=settings.WEBHOOK_BREAKER_COOLDOWN)
+            return
+        models.WebhookEvent.objects.filter(id__in=[event.id for event in events]).delete()
+
+    outbox.enqueue(drain_webhook_backlog, brand.id)
+
+
+@shared_task(
+    autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=None, default_retry_delay=3,
+    ignore_result=True
+)
+def ingest_media(message_id):
     message = models.Message.objects.get(id=message_id)
+    if not message.pending_media:
+        return
 
-    if message.brand.webhook_url:
-        representative = serializers.MessageSerializer(instance=message, context={
-            "view": collections.namedtuple("View", ['kwargs'])(kwargs={
-                "brand_pk": message.brand.id
-            }),
-            "request": FakeRequest()
-        })
-
-        post_data = json.dumps(representative.data).encode()
-        post_hmac = hmac.new(message.brand.webhook_signing_secret.encode(), digestmod="sha512")
-        post_hmac.update(post_data)
-        post_sig = post_hmac.hexdigest()
-
-        r = requests.post(message.brand.webhook_url, headers={
-            "X-AS207960-Signature-SHA512": post_sig,
-            "Content-Type": "application/json",
-            "User-Agent": "AS207960 Messaging Service"
-        }, data=post_data)
-        r.raise_for_status()
-        message.status = message.STATE_DISPATCHED
-        message.save()
+    try:
+        content = media.download(**message.pending_media)
+    except requests.exceptions.HTTPError as e:
+        # The platform's file link has expired or been removed, retrying won't bring it back
+        if e.response is None or not (400 <= e.response.status_code < 500):
+            raise
+        content = {
+            "url": None,
+            "media_type": message.pending_media.get("media_type"),
+            "title": None,
+            "text": None
+        }
+        message.error_description = "Media unavailable"
+
+    with transaction.atomic():
+        if not models.Message.objects.filter(id=message.id, pending_media__isnull=False).update(
+                content=content, pending_media=None, error_description=message.error_description
+        ):
+            return
+        message.content = content
+        message.pending_media = None
+        models.Conversation.record_latest(message)
+        route_message(message)
@@ -0,0 +1,29 @@
+from django.utils import timezone
+from . import models
+
+
+def make_brand(**kwargs):
+    # bulk_create skips Brand.save, which would register the brand with Keycloak
+    fields = {
+        "name": "Test",
+        "webhook_url": "https://example.com/webhook",
+    }
+    fields.update(kwargs)
+    return models.Brand.objects.bulk_create([models.Brand(**fields)])[0]
+
+
+def make_message(brand, **kwargs):
+    fields = {
+        "direction": models.Message.DIRECTION_OUTGOING,
+        "brand": brand,
+        "platform": models.Message.PLATFORM_MSISDN,
+        "platform_conversation_id": "+447700900000",
+        "platform_dedup_id": "",
+        "timestamp": timezone.now(),
+        "media_type": "text",
+        "content": "Hello",
+    }
+    fields.update(kwargs)
+    message = models.Message(**fields)
+    message.save()
+    return message
@@ -1,3 +1,922 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.http import HttpResponse
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import transaction
+from django.utils import timezone
+from unittest import mock
+from rest_framework.test import APIRequestFactory, force_authenticate
+from as207960_utils.api import auth
+from PIL import Image
+import asyncio
+import datetime
+import dateutil.parser
+import hashlib
+import httpx
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+import rcs.tasks
+import sms.tasks
+from . import batching, caching, dispatcher, ingress, links, models, outbox, tasks, tokens, webhooks
+from .api import views
+from .testing import make_brand, make_message
 
-# Create your tests here.
+
+class AdvanceStateTestCase(TestCase):
+    def setUp(self):
+        self.brand = make_brand()
+
+    def test_advances_forwards(self):
+        message = make_message(self.brand)
+        self.assertTrue(message.advance_state(models.Message.STATE_DISPATCHED))
+        self.assertTrue(message.advance_state(models.Message.STATE_DELIVERED))
+        message.refresh_from_db()
+        self.assertEqual(message.state, models.Message.STATE_DELIVERED)
+        self.assertIsNotNone(message.state_changed_at)
+
+    def test_never_regresses(self):
+        message = make_message(self.brand, state=models.Message.STATE_READ)
+        stale = models.Message.objects.get(id=message.id)
+        stale.state = models.Message.STATE_DISPATCHED
+
+        self.assertFalse(stale.advance_state(models.Message.STATE_DELIVERED))
+        self.assertFalse(stale.advance_state(models.Message.STATE_FAILED, error_description="Failed"))
+        message.refresh_from_db()
+        self.assertEqual(message.state, models.Message.STATE_READ)
+        self.assertIsNone(message.error_description)
+
+    def test_same_state_is_not_a_change(self):
+        message = make_message(self.brand, state=models.Message.STATE_DELIVERED)
+        self.assertFalse(message.advance_state(models.Message.STATE_DELIVERED))
+
+    def test_failure_after_delivery_is_ignored(self):
+        message = make_message(self.brand, state=models.Message.STATE_DELIVERED)
+        self.assertFalse(message.advance_state(models.Message.STATE_FAILED, error_description="Failed"))
+        message.refresh_from_db()
+        self.assertEqual(message.state, models.Message.STATE_DELIVERED)
+
+    def test_delivery_after_failure_is_ignored(self):
+        message = make_message(self.brand, state=models.Message.STATE_FAILED, error_description="Failed")
+        self.assertFalse(message.advance_state(models.Message.STATE_DELIVERED))
+        message.refresh_from_db()
+        self.assertEqual(message.state, models.Message.STATE_FAILED)
+        self.assertEqual(message.error_description, "Failed")
+
+    def test_sets_extra_fields(self):
+        message = make_message(self.brand)
+        self.assertTrue(message.advance_state(models.Message.STATE_FAILED, error_description="Invalid message"))
+        message.refresh_from_db()
+        self.assertEqual(message.state, models.Message.STATE_FAILED)
+        self.assertEqual(message.error_description, "Invalid message")
+
+
+@override_settings(WEBHOOK_COALESCE_WINDOW=1)
+class FailMessageTestCase(TestCase):
+    def setUp(self):
+        self.brand = make_brand()
+
+    def scheduled(self, task):
+        return list(models.OutboxTask.objects.filter(task_name=task.name))
+
+    def test_failure_queues_a_state_event(self):
+        message = make_message(self.brand, state=models.Message.STATE_DISPATCHED)
+        tasks.fail_message(message, "Message sending failed")
+
+        message.refresh_from_db()
+        self.assertEqual(message.state, models.Message.STATE_FAILED)
+        self.assertEqual(message.error_description, "Message sending failed")
+        event = models.WebhookEvent.objects.get(message=message)
+        self.assertEqual(event.event_type, models.WebhookEvent.TYPE_STATE)
+        self.assertEqual(self.scheduled(tasks.send_webhook_event)[0].args, [str(event.id)])
+        self.assertEqual(self.scheduled(tasks.send_message), [])
+
+    def test_failure_after_delivery_is_ignored(self):
+        message = make_message(self.brand, state=models.Message.STATE_DELIVERED)
+        tasks.fail_message(message, "Message sending failed")
+
+        message.refresh_from_db()
+        self.assertEqual(message.state, models.Message.STATE_DELIVERED)
+        self.assertFalse(models.WebhookEvent.objects.exists())
+
+    def test_coalesced_state_events_send_the_latest_state(self):
+        models.Brand.objects.filter(id=self.brand.id).update(webhook_state_deltas=True)
+        message = make_message(self.brand, state=models.Message.STATE_ACCEPTED)
+
+        for state in (models.Message.STATE_DISPATCHED, models.Message.STATE_DELIVERED):
+            self.assertTrue(message.advance_state(state))
+            tasks.queue_state_webhook(message)
+
+        event = models.WebhookEvent.objects.get(message=message)
+        self.assertEqual(len(self.scheduled(tasks.send_webhook_event)), 1)
+
+        delivery = tasks.prepare_event_webhook(event.id, uuid.uuid4())
+        payload = json.loads(delivery.content)
+        self.assertEqual(payload["event"], "state_changed")
+        self.assertEqual(payload["state"], "delivered")
+
+    def test_invalid_calendar_event_fails_the_message(self):
+        message = make_message(self.brand, state=models.Message.STATE_ACCEPTED)
+        self.assertIsNone(tasks.make_calendar_fallback(message, {"title": "Meeting"}))
+
+        message.refresh_from_db()
+        self.assertEqual(message.state, models.Message.STATE_FAILED)
+        self.assertEqual(message.error_description, "Invalid message")
+        self.assertEqual(len(self.scheduled(tasks.send_webhook_event)), 1)
+
+    def test_calendar_fallback_links_to_the_event(self):
+        message = make_message(self.brand)
+        fallback_url = tasks.make_calendar_fallback(message, {
+            "start_time": "2026-10-19T09:00:00Z", "end_time": "2026-10-19T10:00:00Z",
+            "title": "Meeting", "description": "Catch up", "text": "Add to calendar",
+        })
+
+        self.assertIn("/calendar_event/", fallback_url)
+        message.refresh_from_db()
+        self.assertEqual(message.state, models.Message.STATE_ACCEPTED)
+
+
+class ConversationViewSetTestCase(TestCase):
+    def setUp(self):
+        self.brand = make_brand()
+        models.Conversation.record_message(make_message(self.brand, direction=models.Message.DIRECTION_INCOMING))
+        patcher = mock.patch.object(models.Brand, "has_scope", autospec=True, side_effect=self.has_scope)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.allowed_brands = set()
+
+    def has_scope(self, brand, access_token, action='view'):
+        return action == 'view' and brand.id in self.allowed_brands
+
+    def list(self, brand_pk):
+        request = APIRequestFactory().get(f"/api/brands/{brand_pk}/conversations/")
+        force_authenticate(request, token=mock.Mock(spec=auth.OAuthToken, token="token"))
+        return views.ConversationViewSet.as_view({'get': 'list'})(request, brand_pk=brand_pk)
+
+    def test_lists_conversations_of_a_viewable_brand(self):
+        self.allowed_brands.add(self.brand.id)
+        response = self.list(self.brand.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data["results"]), 1)
+
+    def test_other_brands_conversations_are_forbidden(self):
+        response = self.list(self.brand.id)
+        self.assertEqual(response.status_code, 403)
+
+    def test_unknown_brand_is_forbidden(self):
+        self.assertEqual(self.list(uuid.uuid4()).status_code, 403)
+
+
+@override_settings(WARM_CAPABILITIES_CHUNK=2)
+class WarmCapabilitiesTestCase(TestCase):
+    def setUp(self):
+        self.brand = make_brand()
+        self.scopes = set()
+        for name, kwargs in (
+                ("has_scope", {"autospec": True, "side_effect": self.has_scope}),
+                ("get_object_list", {"return_value": models.Brand.objects.all()}),
+        ):
+            patcher = mock.patch.object(models.Brand, name, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def has_scope(self, brand, access_token, action='view'):
+        return action in self.scopes
+
+    def warm(self, msisdns):
+        request = APIRequestFactory().post(
+            f"/api/brands/{self.brand.id}/warm-capabilities/", {"msisdns": msisdns}, format="json"
+        )
+        force_authenticate(request, token=mock.Mock(spec=auth.OAuthToken, token="token"))
+        return views.BrandViewSet.as_view({'post': 'warm_capabilities'})(request, pk=self.brand.id)
+
+    def scheduled(self, task):
+        return [entry.args for entry in models.OutboxTask.objects.filter(task_name=task.name).order_by('timestamp')]
+
+    def test_view_only_token_is_forbidden(self):
+        self.scopes.add('view')
+        self.assertEqual(self.warm(["+447700900001"]).status_code, 403)
+        self.assertFalse(models.OutboxTask.objects.exists())
+
+    def test_numbers_are_queued_in_chunks(self):
+        self.scopes.update(('view', 'edit'))
+        numbers = ["+447700900001", "+447700900002", "+447700900003"]
+        self.assertEqual(self.warm(numbers).status_code, 202)
+
+        brand_id = str(self.brand.id)
+        chunks = [[brand_id, numbers[:2]], [brand_id, numbers[2:]]]
+        self.assertEqual(self.scheduled(rcs.tasks.warm_msisdn_capabilities), chunks)
+        self.assertEqual(self.scheduled(sms.tasks.prefetch_vsms_keys), chunks)
+
+
+class RepresentativeAvatarTestCase(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.media_root = media_root.name
+
+    def upload(self):
+        image = io.BytesIO()
+        Image.new("RGBA", (512, 256), (255, 0, 0, 128)).save(image, format="PNG")
+        return SimpleUploadedFile("avatar.png", image.getvalue(), content_type="image/png")
+
+    def stored_files(self):
+        return [
+            os.path.relpath(os.path.join(path, name), self.media_root)
+            for path, _, names in os.walk(self.media_root) for name in names
+        ]
+
+    def test_only_the_thumbnail_is_stored(self):
+        representative = models.Representative(brand=make_brand(), is_bot=False, avatar=self.upload())
+        representative.save()
+
+        with default_storage.open(representative.avatar.name) as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        self.assertEqual(representative.avatar.name, f"blobs/{digest[:2]}/{digest}.jpg")
+        self.assertEqual(self.stored_files(), [representative.avatar.name])
+        self.assertEqual(Image.open(io.BytesIO(content)).size, (256, 128))
+
+    def test_identical_avatars_share_a_blob(self):
+        brand = make_brand()
+        first = models.Representative(brand=brand, is_bot=False, avatar=self.upload())
+        first.save()
+        second = models.Representative(brand=brand, is_bot=False, avatar=self.upload())
+        second.save()
+
+        self.assertEqual(first.avatar.name, second.avatar.name)
+        self.assertEqual(len(self.stored_files()), 1)
+
+
+@override_settings(TOKEN_BROKER_LEASE=30)
+class AcquireLeaseTestCase(TestCase):
+    def test_first_caller_takes_the_lease(self):
+        now = timezone.now()
+        self.assertTrue(tokens.acquire_lease("key", now))
+        self.assertFalse(tokens.acquire_lease("key", now))
+
+    def test_expired_lease_is_taken_over(self):
+        now = timezone.now()
+        self.assertTrue(tokens.acquire_lease("key", now))
+        self.assertTrue(tokens.acquire_lease("key", now + datetime.timedelta(seconds=31)))
+
+    def test_losing_the_insert_race_keeps_the_transaction_usable(self):
+        now = timezone.now()
+        with transaction.atomic():
+            # Another caller's row appears between the update and the insert
+            no_lease = models.AccessToken.objects.none()
+            with mock.patch.object(models.AccessToken.objects, "filter", return_value=no_lease):
+                models.AccessToken.objects.create(key="key", lease_until=now + datetime.timedelta(seconds=30))
+                self.assertFalse(tokens.acquire_lease("key", now))
+            self.assertEqual(models.AccessToken.objects.count(), 1)
+
+
+@override_settings(TOKEN_BROKER_LEASE=30, TOKEN_BROKER_REFRESH_MARGIN=600)
+class GetTokenTestCase(TestCase):
+    def setUp(self):
+        self.source = mock.Mock()
+        self.source.token = "minted"
+        self.source.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+    def test_token_is_stored_encrypted(self):
+        token, _ = tokens.get_token("key", self.source, None)
+        self.assertEqual(token, "minted")
+        stored = models.AccessToken.objects.get(key="key")
+        self.assertNotIn("minted", stored.token)
+        self.assertEqual(tokens.decrypt_token(stored), "minted")
+
+    def test_fresh_token_is_shared(self):
+        tokens.get_token("key", self.source, None)
+        self.source.token = "other"
+        self.assertEqual(tokens.get_token("key", self.source, None)[0], "minted")
+        self.assertEqual(self.source.refresh.call_count, 1)
+
+    def test_rejected_token_is_minted_again(self):
+        tokens.get_token("key", self.source, None)
+        self.source.token = "other"
+        self.assertEqual(tokens.get_token("key", self.source, None, rejected="minted")[0], "other")
+        self.assertEqual(self.source.refresh.call_count, 2)
+
+
+class RecordMessageTestCase(TestCase):
+    def setUp(self):
+        self.brand = make_brand()
+        self.now = timezone.now()
+
+    def record(self, direction, minutes, **kwargs):
+        message = make_message(
+            self.brand, direction=direction, timestamp=self.now + datetime.timedelta(minutes=minutes), **kwargs
+        )
+        models.Conversation.record_message(message)
+        return message
+
+    def conversation(self):
+        return models.Conversation.objects.get(brand=self.brand)
+
+    def test_incoming_messages_update_the_summary(self):
+        self.record(models.Message.DIRECTION_INCOMING, 0, metadata={"n": 1})
+        last = self.record(models.Message.DIRECTION_INCOMING, 1, metadata={"n": 2})
+
+        conversation = self.conversation()
+        self.assertEqual(conversation.inbound_count, 2)
+        self.assertEqual(conversation.unread_count, 2)
+        self.assertEqual(conversation.first_inbound_at, self.now)
+        self.assertEqual(conversation.last_inbound_at, last.timestamp)
+        self.assertEqual(conversation.last_message_id, last.id)
+        self.assertEqual(conversation.metadata, {"n": 2})
+
+    def test_losing_the_create_race_keeps_the_transaction_usable(self):
+        with transaction.atomic():
+            # Another first message creates the conversation between the lookup and the insert
+            self.record(models.Message.DIRECTION_INCOMING, 0)
+            with mock.patch.object(models.Conversation, "for_message", return_value=None):
+                self.record(models.Message.DIRECTION_INCOMING, 1)
+            self.assertEqual(self.conversation().inbound_count, 2)
+
+    def test_late_message_does_not_replace_the_summary(self):
+        last = self.record(models.Message.DIRECTION_INCOMING, 1, metadata={"n": 2})
+        self.record(models.Message.DIRECTION_INCOMING, 0, metadata={"n": 1})
+
+        conversation = self.conversation()
+        self.assertEqual(conversation.first_inbound_at, self.now)
+        self.assertEqual(conversation.last_inbound_at, last.timestamp)
+        self.assertEqual(conversation.last_message_id, last.id)
+        self.assertEqual(conversation.metadata, {"n": 2})
+
+    def test_outgoing_message_marks_read(self):
+        self.record(models.Message.DIRECTION_INCOMING, 0)
+        reply = self.record(models.Message.DIRECTION_OUTGOING, 1)
+
+        conversation = self.conversation()
+        self.assertEqual(conversation.unread_count, 0)
+        self.assertEqual(conversation.inbound_count, 1)
+        self.assertEqual(conversation.last_message_id, reply.id)
+
+    def test_chat_state_only_counts_as_inbound(self):
+        message = self.record(models.Message.DIRECTION_INCOMING, 0)
+        self.record(models.Message.DIRECTION_INCOMING, 1, media_type="chat_state", content="composing")
+
+        conversation = self.conversation()
+        self.assertEqual(conversation.inbound_count, 2)
+        self.assertEqual(conversation.unread_count, 1)
+        self.assertEqual(conversation.last_message_id, message.id)
+
+    def test_pending_media_is_summarised_once_ingested(self):
+        message = self.record(models.Message.DIRECTION_INCOMING, 0)
+        pending = self.record(
+            models.Message.DIRECTION_INCOMING, 1, media_type="file", content=None,
+            pending_media={"url": "https://example.com/image.png", "file_name": "image.png"}
+        )
+
+        conversation = self.conversation()
+        self.assertEqual(conversation.inbound_count, 2)
+        self.assertEqual(conversation.last_message_id, message.id)
+
+        pending.pending_media = None
+        models.Conversation.record_latest(pending)
+        self.assertEqual(self.conversation().last_message_id, pending.id)
+
+
+class StateWebhookTestCase(TestCase):
+    def setUp(self):
+        self.posted = []
+        patcher = mock.patch.object(webhooks.pool, "post", side_effect=self.post)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, url, headers, content):
+        self.posted.append(json.loads(content))
+        return httpx.Response(200, request=httpx.Request("POST", url))
+
+    def test_state_change_is_sent_compactly(self):
+        state_changed_at = timezone.now()
+        message = make_message(
+            make_brand(webhook_state_deltas=True), state=models.Message.STATE_DELIVERED,
+            timestamp=state_changed_at - datetime.timedelta(minutes=5), state_changed_at=state_changed_at
+        )
+        tasks.send_message(message.id, state_change=True)
+
+        event, = self.posted
+        self.assertEqual(
+            set(event), {"event", "id", "client_message_id", "state", "timestamp", "error_description"}
+        )
+        self.assertEqual(event["state"], "delivered")
+        self.assertEqual(dateutil.parser.isoparse(event["timestamp"]), state_changed_at)
+
+    def test_brands_without_state_deltas_get_the_full_message(self):
+        message = make_message(make_brand(), state=models.Message.STATE_DELIVERED)
+        tasks.send_message(message.id, state_change=True)
+
+        event, = self.posted
+        self.assertNotEqual(event.get("event"), "state_changed")
+        self.assertEqual(event["content"], "Hello")
+
+
+@override_settings(WEBHOOK_POOL_MAX_ORIGINS=2)
+class WebhookClientPoolTestCase(SimpleTestCase):
+    def setUp(self):
+        self.pool = webhooks.WebhookClientPool()
+        self.pool.client_class = lambda **kwargs: httpx.Client(transport=httpx.MockTransport(self.handle))
+        self.addCleanup(self.pool.close)
+
+    def handle(self, request):
+        if request.url.host == "down.example.com":
+            raise httpx.ConnectError("Connection refused", request=request)
+        return httpx.Response(500 if request.url.path == "/error" else 200)
+
+    def test_clients_are_reused_per_origin(self):
+        first = self.pool.get_client("https://a.example.com")
+        self.pool.post("https://a.example.com/webhook")
+        self.pool.post("https://A.example.com/other")
+        self.assertIs(self.pool.get_client("https://a.example.com"), first)
+        self.assertIsNot(self.pool.get_client("https://b.example.com"), first)
+
+        stats = self.pool.stats()
+        self.assertEqual(stats["https://a.example.com"]["clients_created"], 1)
+        self.assertEqual(stats["https://a.example.com"]["requests"], 2)
+
+    def test_least_recently_used_origin_is_evicted(self):
+        first = self.pool.get_client("https://a.example.com")
+        self.pool.get_client("https://b.example.com")
+        self.pool.get_client("https://c.example.com")
+        self.assertIsNot(self.pool.get_client("https://a.example.com"), first)
+        self.assertEqual(self.pool.stats()["https://a.example.com"]["clients_created"], 2)
+
+    def test_errors_are_counted(self):
+        self.pool.post("https://a.example.com/error")
+        with self.assertRaises(httpx.ConnectError):
+            self.pool.post("https://down.example.com/webhook")
+
+        stats = self.pool.stats()
+        self.assertEqual(stats["https://a.example.com"]["status_errors"], 1)
+        self.assertEqual(stats["https://down.example.com"]["errors"], 1)
+
+    def test_concurrent_requests_are_all_counted(self):
+        def post():
+            for _ in range(50):
+                self.pool.post("https://a.example.com/webhook")
+
+        threads = [threading.Thread(target=post) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.pool.stats()["https://a.example.com"]["requests"], 400)
+
+
+class BatcherTestCase(SimpleTestCase):
+    def setUp(self):
+        self.calls = []
+
+    def fetch(self, keys):
+        self.calls.append(keys)
+        if "bad" in keys:
+            raise ValueError("Lookup failed")
+        return {key: key.upper() for key in keys}
+
+    def get_concurrently(self, batcher, keys):
+        results = {}
+
+        def get(key):
+            results[key] = batcher.get(key)
+
+        threads = [threading.Thread(target=get, args=(key,)) for key in keys]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_full_batch_is_sent_without_waiting(self):
+        batcher = batching.Batcher(self.fetch, max_size=2, max_wait=30)
+        results = self.get_concurrently(batcher, ["a", "b"])
+
+        self.assertEqual(results, {"a": "A", "b": "B"})
+        self.assertEqual(len(self.calls), 1)
+        self.assertCountEqual(self.calls[0], ["a", "b"])
+
+    def test_partial_batch_is_sent_after_the_wait(self):
+        batcher = batching.Batcher(self.fetch, max_size=100, max_wait=0.01)
+        self.assertEqual(batcher.get("a"), "A")
+        self.assertEqual(self.calls, [["a"]])
+
+    def test_duplicate_keys_share_a_lookup(self):
+        batcher = batching.Batcher(self.fetch, max_size=3, max_wait=0.5)
+        results = self.get_concurrently(batcher, ["a", "a", "b"])
+
+        self.assertEqual(results, {"a": "A", "b": "B"})
+        self.assertEqual(len(self.calls), 1)
+        self.assertCountEqual(self.calls[0], ["a", "b"])
+
+    def test_failed_batch_does_not_affect_the_next(self):
+        batcher = batching.Batcher(self.fetch, max_size=1, max_wait=0.01)
+        with self.assertRaises(ValueError):
+            batcher.get("bad")
+        self.assertEqual(batcher.get("a"), "A")
+        self.assertEqual(self.calls, [["bad"], ["a"]])
+
+
+class LRUCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.cache = caching.LRUCache("Test", 2, ttl=60)
+        patcher = mock.patch.object(caching.time, "monotonic", return_value=1000)
+        self.monotonic = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_hits_are_counted(self):
+        self.cache.set("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertIsNone(self.cache.get("b"))
+
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["hit_rate"]), (1, 1, 0.5))
+
+    def test_entries_expire(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2, ttl=120)
+        self.monotonic.return_value = 1061
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(self.cache.get("b"), 2)
+        self.assertEqual(self.cache.stats()["size"], 1)
+
+    def test_invalidate_removes_the_entry(self):
+        self.cache.set("a", 1)
+        self.cache.invalidate("a")
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_get_or_set_only_computes_misses(self):
+        func = mock.Mock(return_value=1)
+        self.assertEqual(self.cache.get_or_set("a", func), 1)
+        self.assertEqual(self.cache.get_or_set("a", func), 1)
+        func.assert_called_once_with()
+
+
+@override_settings(SHORT_LINK_TTL=3600)
+class ShortenLinkTestCase(TestCase):
+    def setUp(self):
+        self.brand = make_brand()
+        patcher = mock.patch.object(
+            links, "request_short_link", side_effect=lambda brand, link, **kwargs: f"https://l.example.com/{link[-1]}"
+        )
+        self.request_short_link = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_short_links_are_stored(self):
+        self.assertEqual(links.shorten(self.brand, "https://example.com/a"), "https://l.example.com/a")
+        self.assertEqual(links.shorten(self.brand, "https://example.com/a"), "https://l.example.com/a")
+        self.request_short_link.assert_called_once()
+
+    def test_expired_short_link_is_requested_again(self):
+        models.ShortLink.objects.create(
+            key=links.link_key(self.brand, "https://example.com/a"), short_link="https://l.example.com/old",
+            expires_at=timezone.now() - datetime.timedelta(seconds=1)
+        )
+        self.assertEqual(links.shorten(self.brand, "https://example.com/a"), "https://l.example.com/a")
+        self.assertEqual(models.ShortLink.objects.get().short_link, "https://l.example.com/a")
+
+    def test_social_meta_is_part_of_the_key(self):
+        links.shorten(self.brand, "https://example.com/a")
+        links.shorten(self.brand, "https://example.com/a", title="Title")
+        self.assertEqual(self.request_short_link.call_count, 2)
+
+    def test_only_misses_are_requested(self):
+        links.shorten(self.brand, "https://example.com/a")
+        self.assertEqual(links.shorten_many(self.brand, [
+            {"link": "https://example.com/a"}, {"link": "https://example.com/b"}, {"link": "https://example.com/b"},
+        ]), ["https://l.example.com/a", "https://l.example.com/b", "https://l.example.com/b"])
+        self.assertEqual(self.request_short_link.call_count, 2)
+
+    def test_concurrent_misses_share_a_request(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def request():
+            started.set()
+            release.wait(5)
+            return "https://l.example.com/a"
+
+        func = mock.Mock(side_effect=request)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(links._single_flight("key", func))) for _ in range(2)]
+        threads[0].start()
+        started.wait(5)
+        threads[1].start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        func.assert_called_once_with()
+        self.assertEqual(results, ["https://l.example.com/a"] * 2)
+        self.assertEqual(links._in_flight, {})
+
+@override_settings(
+    WEBHOOK_BATCH_WINDOW=1, WEBHOOK_BATCH_MAX_SIZE=100, WEBHOOK_BREAKER_THRESHOLD=1, WEBHOOK_BREAKER_COOLDOWN=60
+)
+class WebhookBatchTestCase(TestCase):
+    def setUp(self):
+        self.brand = make_brand(webhook_batching=True)
+        self.posted = []
+        self.fail_posts = False
+        patcher = mock.patch.object(webhooks.pool, "post", side_effect=self.post)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, url, headers, content):
+        if self.fail_posts:
+            raise httpx.ConnectError("Connection refused")
+        self.posted.append(json.loads(content))
+        return httpx.Response(200, request=httpx.Request("POST", url))
+
+    def queue(self, count=1):
+        for _ in range(count):
+            self.assertIsNone(tasks.prepare_message_webhook(make_message(self.brand).id))
+
+    def scheduled(self, task):
+        return list(models.OutboxTask.objects.filter(task_name=task.name))
+
+    def flush_with_celery(self):
+        tasks.flush_webhook_batch.apply(args=(self.brand.id,), task_id=str(uuid.uuid4())).get()
+
+    def flush_with_dispatcher(self):
+        # What the dispatcher does around its own async POST
+        delivery = dispatcher.WEBHOOK_TASKS[tasks.flush_webhook_batch.name](str(uuid.uuid4()), self.brand.id)
+        if delivery is not None:
+            self.posted.append(json.loads(delivery.content))
+            delivery.complete()
+
+    def test_events_are_batched_into_one_flush(self):
+        self.queue(2)
+
+        flushes = self.scheduled(tasks.flush_webhook_batch)
+        self.assertEqual(len(flushes), 1)
+        self.assertEqual(flushes[0].options, {"countdown": 1})
+
+        self.flush_with_celery()
+        self.assertEqual([len(batch) for batch in self.posted], [2])
+        self.assertFalse(models.WebhookEvent.objects.exists())
+
+    def assert_consecutive_flushes(self, flush):
+        self.queue()
+        flush()
+        self.queue()
+        self.assertEqual(len(self.scheduled(tasks.flush_webhook_batch)), 2)
+        flush()
+
+        self.assertEqual([len(batch) for batch in self.posted], [1, 1])
+        self.assertFalse(models.WebhookEvent.objects.exists())
+        self.assertFalse(models.WebhookFlush.objects.get(brand=self.brand).pending)
+
+    def test_consecutive_flushes_with_celery(self):
+        self.assert_consecutive_flushes(self.flush_with_celery)
+
+    def test_consecutive_flushes_with_dispatcher(self):
+        self.assert_consecutive_flushes(self.flush_with_dispatcher)
+
+    @override_settings(WEBHOOK_BATCH_MAX_SIZE=1)
+    def test_full_batch_flushes_again_immediately(self):
+        self.queue(2)
+        self.flush_with_dispatcher()
+
+        self.assertEqual([len(batch) for batch in self.posted], [1])
+        flushes = self.scheduled(tasks.flush_webhook_batch)
+        self.assertEqual(len(flushes), 2)
+        self.assertEqual(flushes[-1].options, {})
+
+    def test_failed_batch_is_parked_and_opens_breaker(self):
+        self.queue()
+        self.fail_posts = True
+        self.flush_with_celery()
+
+        self.assertTrue(models.WebhookEvent.objects.get().parked)
+        breaker = models.WebhookBreaker.objects.get(brand=self.brand)
+        self.assertEqual(breaker.state, breaker.STATE_OPEN)
+        self.assertEqual(len(self.scheduled(tasks.drain_webhook_backlog)), 1)
+
+        self.queue()
+        self.assertEqual(models.WebhookEvent.objects.filter(parked=True).count(), 2)
+
+
+class DispatcherRetryTestCase(SimpleTestCase):
+    def setUp(self):
+        self.dispatcher = dispatcher.WebhookDispatcher(concurrency=1, db_threads=1)
+        self.addCleanup(self.dispatcher.executor.shutdown)
+        self.message = mock.Mock()
+        patcher = mock.patch.dict(dispatcher.WEBHOOK_TASKS, {"failing": mock.Mock(side_effect=ValueError("Failed"))})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def handle(self):
+        async def main():
+            self.dispatcher.loop = asyncio.get_running_loop()
+            self.dispatcher.semaphore = asyncio.Semaphore(1)
+            await self.dispatcher.handle("failing", str(uuid.uuid4()), ["a"], {}, None, 0, self.message)
+
+        asyncio.run(main())
+        self.dispatcher.flush_acks()
+
+    def test_retried_task_is_acknowledged(self):
+        with mock.patch.object(dispatcher.celery_app, "send_task") as send_task, \
+                self.assertLogs(dispatcher.logger, "WARNING"):
+            self.handle()
+
+        self.assertEqual(send_task.call_args[1]["retries"], 1)
+        self.message.ack.assert_called_once_with()
+        self.message.reject.assert_not_called()
+
+    def test_task_is_requeued_if_the_retry_cannot_be_published(self):
+        with mock.patch.object(dispatcher.celery_app, "send_task", side_effect=ConnectionError("Broker down")), \
+                self.assertLogs(dispatcher.logger, "ERROR"):
+            self.handle()
+
+        self.message.ack.assert_not_called()
+        self.message.reject.assert_called_once_with(requeue=True)
+
+
+class FakeTask:
+    name = "messaging.tests.fake_task"
+
+
+class OutboxTestCase(TransactionTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(outbox, "celery_app")
+        self.celery_app = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sent_args(self):
+        return [call.kwargs["args"] for call in self.celery_app.send_task.call_args_list]
+
+    def test_publishes_only_after_commit(self):
+        with transaction.atomic():
+            outbox.enqueue(FakeTask, 1)
+            outbox.enqueue(FakeTask, 2)
+            self.assertFalse(self.celery_app.send_task.called)
+            self.assertEqual(models.OutboxTask.objects.count(), 2)
+
+        self.assertEqual(self.sent_args(), [[1], [2]])
+        self.assertEqual(self.celery_app.producer_or_acquire.call_count, 1)
+        self.assertFalse(models.OutboxTask.objects.exists())
+
+    def test_rollback_publishes_nothing(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                outbox.enqueue(FakeTask, 1)
+                raise ValueError
+
+        self.assertFalse(self.celery_app.send_task.called)
+        self.assertFalse(models.OutboxTask.objects.exists())
+
+    def test_rollback_does_not_block_later_transactions(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                outbox.enqueue(FakeTask, 1)
+                raise ValueError
+
+        with transaction.atomic():
+            outbox.enqueue(FakeTask, 2)
+
+        self.assertEqual(self.sent_args(), [[2]])
+
+    def test_autocommit_publishes_immediately(self):
+        outbox.enqueue(FakeTask, 1, countdown=5)
+        self.assertEqual(self.sent_args(), [[1]])
+        self.assertEqual(self.celery_app.send_task.call_args.kwargs["countdown"], 5)
+
+    def test_ids_are_published_as_strings(self):
+        message_id = uuid.uuid4()
+        outbox.enqueue(FakeTask, message_id, brand_id=message_id)
+        self.assertEqual(self.sent_args(), [[str(message_id)]])
+        self.assertEqual(self.celery_app.send_task.call_args.kwargs["kwargs"], {"brand_id": str(message_id)})
+
+    def test_failed_publish_is_left_for_relay(self):
+        self.celery_app.send_task.side_effect = ConnectionError
+        outbox.enqueue(FakeTask, 1)
+        self.assertEqual(models.OutboxTask.objects.count(), 1)
+
+        self.celery_app.send_task.side_effect = None
+        models.OutboxTask.objects.update(timestamp=timezone.now() - datetime.timedelta(hours=1))
+        self.assertEqual(outbox.relay(), 1)
+        self.assertFalse(models.OutboxTask.objects.exists())
+
+    def test_racing_publishers_send_each_entry_once(self):
+        with transaction.atomic():
+            outbox.enqueue(FakeTask, 1)
+            entry_ids = list(models.OutboxTask.objects.values_list('id', flat=True))
+            # A relay picks the entries up while the on-commit publisher is sending them
+            self.celery_app.send_task.side_effect = lambda *args, **kwargs: self.assertEqual(
+                outbox.publish(entry_ids), 0
+            )
+
+        self.assertEqual(self.sent_args(), [[1]])
+        self.assertFalse(models.OutboxTask.objects.exists())
+
+    def test_relay_skips_claimed_entries(self):
+        models.OutboxTask.objects.create(
+            task_name=FakeTask.name, timestamp=timezone.now() - datetime.timedelta(hours=1),
+            claim_id=uuid.uuid4(), claimed_at=timezone.now()
+        )
+        self.assertEqual(outbox.relay(), 0)
+
+        models.OutboxTask.objects.update(claimed_at=timezone.now() - datetime.timedelta(hours=1))
+        self.assertEqual(outbox.relay(), 1)
+
+
+processed_events = []
+
+
+def fake_processor(body):
+    if body.get("fail"):
+        raise ValueError
+    processed_events.append(body)
+    return HttpResponse(status=body.get("status", 200))
+
+
+@override_settings(INGRESS_BATCH_SIZE=10, INGRESS_CLAIM_LEASE=60, INGRESS_MAX_ATTEMPTS=3)
+class IngressTestCase(TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(ingress.PROCESSORS, {
+            models.IngressEvent.SOURCE_GBM: "messaging.tests.fake_processor",
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        processed_events.clear()
+
+    def append(self, body, **kwargs):
+        return models.IngressEvent.objects.create(source=models.IngressEvent.SOURCE_GBM, body=body, **kwargs)
+
+    def test_claims_in_order(self):
+        first = self.append({"n": 1}, timestamp=timezone.now() - datetime.timedelta(seconds=1))
+        second = self.append({"n": 2})
+
+        events = ingress.claim_batch()
+        self.assertEqual([event.id for event in events], [first.id, second.id])
+        self.assertEqual(len({event.claim_id for event in events}), 1)
+        self.assertEqual([event.attempts for event in events], [1, 1])
+
+    def test_claimed_events_are_not_claimed_again(self):
+        self.append({})
+        self.assertEqual(len(ingress.claim_batch()), 1)
+        self.assertEqual(ingress.claim_batch(), [])
+
+    def test_expired_lease_is_reclaimed(self):
+        self.append({})
+        ingress.claim_batch()
+        models.IngressEvent.objects.update(claimed_until=timezone.now() - datetime.timedelta(seconds=1))
+
+        events = ingress.claim_batch()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].attempts, 2)
+
+    def test_exhausted_events_are_parked(self):
+        self.append({}, attempts=3)
+        with self.assertLogs(ingress.logger, "ERROR"):
+            self.assertEqual(ingress.claim_batch(), [])
+
+        self.assertTrue(models.IngressEvent.objects.get().parked)
+        self.assertEqual(ingress.claim_batch(), [])
+
+    def test_process_deletes_the_event(self):
+        self.append({"n": 1})
+        self.assertEqual(ingress.process_batch(), 1)
+        self.assertEqual(processed_events, [{"n": 1}])
+        self.assertFalse(models.IngressEvent.objects.exists())
+
+    def test_failed_event_is_kept(self):
+        self.append({"fail": True})
+        with self.assertLogs(ingress.logger, "ERROR"):
+            ingress.process_batch()
+        self.assertEqual(models.IngressEvent.objects.get().attempts, 1)
+
+    def test_reclaimed_event_is_skipped(self):
+        self.append({"n": 1})
+        stale = ingress.claim_batch()[0]
+        models.IngressEvent.objects.update(claim_id=uuid.uuid4())
+
+        with self.assertLogs(ingress.logger, "WARNING"):
+            self.assertFalse(ingress.process(stale))
+        self.assertEqual(processed_events, [])
+        self.assertTrue(models.IngressEvent.objects.exists())
+
+    def test_rejected_event_is_logged(self):
+        self.append({"status": 404})
+        with self.assertLogs(ingress.logger, "WARNING"):
+            ingress.process_batch()
+        self.assertFalse(models.IngressEvent.objects.exists())
@@ -0,0 +1,115 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+import google.oauth2.service_account
+import google.auth.credentials
+import cryptography.fernet
+import cryptography.hazmat.primitives.kdf.hkdf
+import cryptography.hazmat.primitives.hashes
+import base64
+import datetime
+import functools
+import hashlib
+import time
+import json
+from . import models
+
+
+def broker_key(info: dict, scopes) -> str:
+    return hashlib.sha256(json.dumps(
+        [info["client_email"], info.get("private_key_id"), sorted(scopes)]
+    ).encode()).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def token_cipher() -> cryptography.fernet.Fernet:
+    return cryptography.fernet.Fernet(base64.urlsafe_b64encode(cryptography.hazmat.primitives.kdf.hkdf.HKDF(
+        algorithm=cryptography.hazmat.primitives.hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"messaging-access-token",
+    ).derive(settings.SECRET_KEY.encode())))
+
+
+def encrypt_token(value: str) -> str:
+    return token_cipher().encrypt(value.encode()).decode()
+
+
+def decrypt_token(token: models.AccessToken):
+    if not token.token:
+        return None
+    try:
+        return token_cipher().decrypt(token.token.encode()).decode()
+    except cryptography.fernet.InvalidToken:
+        # Written under another SECRET_KEY, so treated like no token at all
+        return None
+
+
+def token_fresh(token: models.AccessToken, now: datetime.datetime) -> bool:
+    return bool(token.token and token.expiry and
+                token.expiry - now > datetime.timedelta(seconds=settings.TOKEN_BROKER_REFRESH_MARGIN))
+
+
+def acquire_lease(key: str, now: datetime.datetime) -> bool:
+    lease_until = now + datetime.timedelta(seconds=settings.TOKEN_BROKER_LEASE)
+    if models.AccessToken.objects.filter(key=key).filter(
+            Q(lease_until__isnull=True) | Q(lease_until__lt=now)
+    ).update(lease_until=lease_until):
+        return True
+    try:
+        with transaction.atomic():
+            models.AccessToken.objects.create(key=key, lease_until=lease_until)
+    except IntegrityError:
+        return False
+    return True
+
+
+def get_token(key: str, source: google.oauth2.service_account.Credentials, request, rejected=None):
+    deadline = time.monotonic() + settings.TOKEN_BROKER_LEASE
+    while True:
+        now = timezone.now()
+        token = models.AccessToken.objects.filter(key=key).first()
+        value = decrypt_token(token) if token else None
+        if value == rejected:
+            value = None
+        if value and token_fresh(token, now):
+            return value, token.expiry
+
+        if acquire_lease(key, now):
+            try:
+                source.refresh(request)
+            except Exception:
+                models.AccessToken.objects.filter(key=key).update(lease_until=None)
+                raise
+            expiry = timezone.make_aware(source.expiry, datetime.timezone.utc)
+            models.AccessToken.objects.filter(key=key).update(
+                token=encrypt_token(source.token), expiry=expiry, lease_until=None
+            )
+            return source.token, expiry
+
+        # Someone else is refreshing, an old token that hasn't actually expired yet is still usable meanwhile
+        if value and token.expiry and token.expiry > now:
+            return value, token.expiry
+
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Timed out waiting for token refresh of {key}")
+        time.sleep(settings.TOKEN_BROKER_POLL_INTERVAL)
+
+
+class BrokeredCredentials(google.auth.credentials.Credentials):
+    def __init__(self, info: dict, scopes):
+        super().__init__()
+        self.source = google.oauth2.service_account.Credentials.from_service_account_info(info, scopes=scopes)
+        self.broker_key = broker_key(info, scopes)
+
+    @classmethod
+    def from_service_account_file(cls, filename: str, scopes):
+        with open(filename) as f:
+            return cls(json.load(f), scopes)
+
+    def refresh(self, request):
+        # Being asked to refresh the token we still hold means Google rejected it
+        token, expiry = get_token(self.broker_key, self.source, request, rejected=self.token)
+        self.token = token
+        self.expiry = timezone.make_naive(expiry, datetime.timezone.utc)
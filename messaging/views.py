@@ -1,4 +1,6 @@
 from django.http import HttpResponse, HttpResponseBadRequest
+from django.conf import settings
+from django.views.static import serve
 import gbc.models
 from django.shortcuts import redirect
 import urllib.parse
@@ -7,6 +9,8 @@ import binascii
 import base64
 import datetime
 import ics
+import os.path
+from . import media
 
 
 def oauth_redirect(request):
@@ -58,3 +62,10 @@ def calendar_event(request, event_data):
     cal.events.add(event)
 
     return HttpResponse(str(cal), status=200, content_type="text/calendar")
+
+
+def media_blob(request, path):
+    response = serve(request, path, document_root=os.path.join(settings.MEDIA_ROOT, media.BLOB_PREFIX))
+    # Blob names are content hashes, so a name never refers to different content
+    response["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
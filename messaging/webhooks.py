@@ -0,0 +1,206 @@
+from django.conf import settings
+import collections
+import threading
+import asyncio
+import logging
+import urllib.parse
+import time
+import hmac
+import json
+import httpx
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = "AS207960 Messaging Service"
+
+
+def client_kwargs():
+    return {
+        "http2": settings.WEBHOOK_HTTP2,
+        "timeout": httpx.Timeout(
+            settings.WEBHOOK_READ_TIMEOUT,
+            connect=settings.WEBHOOK_CONNECT_TIMEOUT,
+            pool=settings.WEBHOOK_CONNECT_TIMEOUT,
+        ),
+        "limits": httpx.Limits(
+            max_connections=settings.WEBHOOK_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.WEBHOOK_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=settings.WEBHOOK_POOL_KEEPALIVE_EXPIRY,
+        ),
+        "headers": {
+            "User-Agent": USER_AGENT,
+        },
+    }
+
+
+def url_origin(url: str) -> str:
+    url_parts = urllib.parse.urlsplit(url)
+    return f"{url_parts.scheme}://{url_parts.netloc}".lower()
+
+
+def sign_payload(signing_secret: str, post_data: bytes) -> dict:
+    post_hmac = hmac.new(signing_secret.encode(), digestmod="sha512")
+    post_hmac.update(post_data)
+    return {
+        "X-AS207960-Signature-SHA512": post_hmac.hexdigest(),
+        "Content-Type": "application/json",
+    }
+
+
+class WebhookDelivery:
+    def __init__(self, brand, data, on_complete=None, on_failure=None):
+        self.url = brand.webhook_url
+        self.content = json.dumps(data).encode()
+        self.headers = sign_payload(brand.webhook_signing_secret, self.content)
+        self.on_complete = on_complete
+        self.on_failure = on_failure
+
+    def send(self):
+        try:
+            r = pool.post(self.url, headers=self.headers, content=self.content)
+            r.raise_for_status()
+        except httpx.HTTPError as e:
+            if self.fail(e):
+                return
+            raise
+        self.complete()
+
+    async def async_send(self, async_pool: "AsyncWebhookClientPool"):
+        r = await async_pool.post(self.url, headers=self.headers, content=self.content)
+        r.raise_for_status()
+
+    def complete(self):
+        if self.on_complete:
+            self.on_complete()
+
+    def fail(self, error) -> bool:
+        return bool(self.on_failure and self.on_failure(error))
+
+
+class OriginStats:
+    __slots__ = ("requests", "errors", "status_errors", "total_time", "http2_requests", "created")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.status_errors = 0
+        self.total_time = 0.0
+        self.http2_requests = 0
+        self.created = 0
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "status_errors": self.status_errors,
+            "http2_requests": self.http2_requests,
+            "clients_created": self.created,
+            "mean_time": self.total_time / self.requests if self.requests else None,
+        }
+
+
+class WebhookClientPool:
+    client_class = httpx.Client
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = collections.OrderedDict()
+        self._stats = collections.defaultdict(OriginStats)
+        self._last_stats_log = time.monotonic()
+
+    def get_client(self, origin: str):
+        with self._lock:
+            client = self._clients.get(origin)
+            if client is not None:
+                self._clients.move_to_end(origin)
+                return client
+
+            client = self.client_class(**client_kwargs())
+            self._clients[origin] = client
+            self._stats[origin].created += 1
+
+            while len(self._clients) > settings.WEBHOOK_POOL_MAX_ORIGINS:
+                _, old_client = self._clients.popitem(last=False)
+                self._close_client(old_client)
+
+            return client
+
+    def _close_client(self, client):
+        client.close()
+
+    def _record(self, origin: str, start: float, r=None, failed=False):
+        elapsed = time.monotonic() - start
+        # Requests finish on several threads at once, so the shared counters are only touched under the lock
+        with self._lock:
+            stats = self._stats[origin]
+            stats.requests += 1
+            stats.total_time += elapsed
+            if failed:
+                stats.errors += 1
+            elif r is not None:
+                if r.http_version == "HTTP/2":
+                    stats.http2_requests += 1
+                if r.is_error:
+                    stats.status_errors += 1
+            log_stats = self._stats_due()
+        if log_stats:
+            logger.info("Webhook pool stats: %s open clients, %s", len(self._clients), self.stats())
+
+    def post(self, url: str, **kwargs) -> httpx.Response:
+        origin = url_origin(url)
+        client = self.get_client(origin)
+        start = time.monotonic()
+        try:
+            r = client.post(url, **kwargs)
+        except httpx.HTTPError:
+            self._record(origin, start, failed=True)
+            raise
+        self._record(origin, start, r)
+        return r
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                origin: stats.as_dict() for origin, stats in self._stats.items()
+            }
+
+    def _stats_due(self) -> bool:
+        now = time.monotonic()
+        if now - self._last_stats_log < settings.WEBHOOK_POOL_STATS_INTERVAL:
+            return False
+        self._last_stats_log = now
+        return True
+
+    def close(self):
+        with self._lock:
+            for client in self._clients.values():
+                self._close_client(client)
+            self._clients.clear()
+
+
+class AsyncWebhookClientPool(WebhookClientPool):
+    client_class = httpx.AsyncClient
+
+    def _close_client(self, client):
+        asyncio.ensure_future(client.aclose())
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        origin = url_origin(url)
+        client = self.get_client(origin)
+        start = time.monotonic()
+        try:
+            r = await client.post(url, **kwargs)
+        except httpx.HTTPError:
+            self._record(origin, start, failed=True)
+            raise
+        self._record(origin, start, r)
+        return r
+
+    async def aclose(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        await asyncio.gather(*(client.aclose() for client in clients))
+
+
+pool = WebhookClientPool()
@@ -0,0 +1,183 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+import messaging.caching
+import concurrent.futures
+import datetime
+import requests
+import logging
+import phonenumbers
+import time
+import uuid
+from . import models, sessions
+
+logger = logging.getLogger(__name__)
+
+cache = messaging.caching.LRUCache(
+    "RCS capability", settings.RCS_CAPABILITY_CACHE_SIZE, ttl=settings.RCS_CAPABILITY_CACHE_TTL,
+    stats_interval=settings.CACHE_STATS_INTERVAL
+)
+refreshing = messaging.caching.LRUCache(
+    "RCS capability refresh", settings.RCS_CAPABILITY_CACHE_SIZE, ttl=settings.RCS_CAPABILITY_REFRESH_INTERVAL
+)
+
+
+def update_msisdn_features(features, msisdn: models.MSISDN):
+    msisdn.supports_revocation = "REVOCATION" in features
+    msisdn.supports_rich_card_standalone = "RICHCARD_STANDALONE" in features
+    msisdn.supports_rich_card_carousel = "RICHCARD_CAROUSEL" in features
+    msisdn.supports_action_calendar = "ACTION_CREATE_CALENDAR_EVENT" in features
+    msisdn.supports_action_dial = "ACTION_DIAL" in features
+    msisdn.supports_action_url = "ACTION_OPEN_URL" in features
+    msisdn.supports_action_share_location = "ACTION_SHARE_LOCATION" in features
+    msisdn.supports_action_view_location = "ACTION_VIEW_LOCATION" in features
+    msisdn.supports_payments_v1 = "PAYMENTS_V1" in features
+    msisdn.last_checked = timezone.now()
+    msisdn.save()
+    cache.invalidate((msisdn.agent_id, msisdn.msisdn.as_e164))
+
+
+def is_stale(msisdn: models.MSISDN) -> bool:
+    if msisdn.last_checked is None:
+        return True
+    ttl = settings.RCS_CAPABILITY_POSITIVE_TTL if msisdn.supports_rcs else settings.RCS_CAPABILITY_NEGATIVE_TTL
+    return timezone.now() - msisdn.last_checked > datetime.timedelta(seconds=ttl)
+
+
+def stale_filter() -> Q:
+    now = timezone.now()
+    return Q(last_checked__isnull=True) | Q(
+        supports_rcs=True, last_checked__lt=now - datetime.timedelta(seconds=settings.RCS_CAPABILITY_POSITIVE_TTL)
+    ) | Q(
+        supports_rcs=False, last_checked__lt=now - datetime.timedelta(seconds=settings.RCS_CAPABILITY_NEGATIVE_TTL)
+    )
+
+
+def request_capabilities(session, agent: models.Agent, number: str, request_id):
+    base_url = f"https://{agent.region}-rcsbusinessmessaging.googleapis.com"
+    r = session.get(f"{base_url}/v1/phones/{number}/capabilities?requestId={request_id}")
+    if r.status_code in (404, 403):
+        return False, []
+    r.raise_for_status()
+    return True, r.json().get("features", [])
+
+
+def store_capabilities(agent: models.Agent, number: str, supports_rcs: bool, features) -> models.MSISDN:
+    msisdn = models.MSISDN.objects.filter(agent=agent, msisdn=number).first()
+    if not msisdn:
+        msisdn = models.MSISDN(agent=agent, msisdn=number)
+    msisdn.supports_rcs = supports_rcs
+    update_msisdn_features(features, msisdn)
+    return msisdn
+
+
+def fetch(session, agent: models.Agent, number: str, request_id) -> models.MSISDN:
+    supports_rcs, features = request_capabilities(session, agent, number, request_id)
+    return store_capabilities(agent, number, supports_rcs, features)
+
+
+def lookup(session, agent: models.Agent, number: str, request_id) -> models.MSISDN:
+    # Cached under the same E.164 key that update_msisdn_features invalidates
+    number = phonenumbers.format_number(phonenumbers.parse(number), phonenumbers.PhoneNumberFormat.E164)
+    key = (agent.id, number)
+    msisdn = cache.get(key)
+    if msisdn is None:
+        msisdn = models.MSISDN.objects.filter(agent=agent, msisdn=number).first()
+        if not msisdn:
+            msisdn = fetch(session, agent, number, request_id)
+        cache.set(key, msisdn)
+    return msisdn
+
+
+def claim_refresh(msisdn: models.MSISDN) -> bool:
+    if not is_stale(msisdn):
+        return False
+    key = (msisdn.agent_id, msisdn.msisdn.as_e164)
+    if refreshing.get(key):
+        return False
+    refreshing.set(key, True)
+    return True
+
+
+def reserve_check_slots(agent: models.Agent, count: int):
+    now = timezone.now()
+    if settings.RCS_CAPABILITY_BULK_RATE <= 0:
+        return [now] * count
+
+    interval = datetime.timedelta(seconds=1 / settings.RCS_CAPABILITY_BULK_RATE)
+    with transaction.atomic():
+        schedule, _ = models.CapabilityCheckSchedule.objects.select_for_update().get_or_create(agent=agent)
+        now = timezone.now()
+        start = max(schedule.next_check_at, now) if schedule.next_check_at else now
+        schedule.next_check_at = start + interval * count
+        schedule.save(update_fields=["next_check_at"])
+
+    return [start + interval * i for i in range(count)]
+
+
+def refresh_numbers(executor, session, agent: models.Agent, numbers):
+    def check(number, check_at):
+        delay = (check_at - timezone.now()).total_seconds()
+        if delay > 0:
+            time.sleep(delay)
+        return request_capabilities(session, agent, number, uuid.uuid4())
+
+    refreshed = 0
+    failed = 0
+    futures = {
+        executor.submit(check, number, check_at): number
+        for number, check_at in zip(numbers, reserve_check_slots(agent, len(numbers)))
+    }
+    for future in concurrent.futures.as_completed(futures):
+        number = futures[future]
+        try:
+            supports_rcs, features = future.result()
+        except requests.RequestException as e:
+            logger.warning("Failed to check RCS capabilities of %s: %s", number, e)
+            failed += 1
+            continue
+        store_capabilities(agent, number, supports_rcs, features)
+        refreshed += 1
+    return refreshed, failed
+
+
+def bulk_refresh(agent: models.Agent, numbers=None, force=False, limit=None) -> int:
+    session = sessions.get_session(agent)
+    chunk_size = settings.RCS_CAPABILITY_BULK_CHUNK
+    started = timezone.now()
+    refreshed = 0
+    failed = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=settings.RCS_CAPABILITY_BULK_CONCURRENCY) as executor:
+        if numbers is not None:
+            if not force:
+                fresh = set(str(number) for number in models.MSISDN.objects.filter(
+                    agent=agent, msisdn__in=numbers
+                ).exclude(stale_filter()).values_list('msisdn', flat=True))
+                numbers = [number for number in numbers if number not in fresh]
+            if limit is not None:
+                numbers = numbers[:limit]
+            for i in range(0, len(numbers), chunk_size):
+                chunk_refreshed, _ = refresh_numbers(executor, session, agent, numbers[i:i + chunk_size])
+                refreshed += chunk_refreshed
+            return refreshed
+
+        # Refreshed numbers move past `started` and drop out of the query, failed ones stay at the front
+        while limit is None or refreshed + failed < limit:
+            msisdns = models.MSISDN.objects.filter(agent=agent).filter(
+                Q(last_checked__isnull=True) | Q(last_checked__lt=started)
+            )
+            if not force:
+                msisdns = msisdns.filter(stale_filter())
+            size = chunk_size if limit is None else min(chunk_size, limit - refreshed - failed)
+            chunk = [str(number) for number in msisdns.order_by(
+                F('last_checked').asc(nulls_first=True), 'id'
+            ).values_list('msisdn', flat=True)[failed:failed + size]]
+            if not chunk:
+                break
+            chunk_refreshed, chunk_failed = refresh_numbers(executor, session, agent, chunk)
+            refreshed += chunk_refreshed
+            failed += chunk_failed
+
+    return refreshed
@@ -1,27 +1,21 @@
 from django.core.management.base import BaseCommand
 import rcs.models
-import rcs.tasks
-import google.oauth2.service_account
-import google.auth.transport.requests
-import json
-import uuid
+import rcs.capabilities
 
 
 class Command(BaseCommand):
-    def handle(self, *args, **options):
-        for agent_obj in rcs.models.Agent.objects.all():
-            base_url = f"https://{agent_obj.region}-rcsbusinessmessaging.googleapis.com"
+    help = "Refresh the RCS capabilities of every MSISDN past its TTL"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--agent", type=str, help="Only refresh MSISDNs of this agent")
+        parser.add_argument("--limit", type=int, help="Maximum MSISDNs to refresh per agent")
+        parser.add_argument("--force", action="store_true", help="Refresh MSISDNs that are still fresh too")
 
-            credentials = google.oauth2.service_account.Credentials.from_service_account_info(
-                json.loads(agent_obj.service_account_key),
-                scopes=rcs.tasks.SCOPES
-            )
-            session = google.auth.transport.requests.AuthorizedSession(credentials)
+    def handle(self, *args, **options):
+        agents = rcs.models.Agent.objects.all()
+        if options["agent"]:
+            agents = agents.filter(id=options["agent"])
 
-            for msisdn in agent_obj.msisdn_set.all():
-                session.post(
-                    f"{base_url}/v1/phones/{msisdn.msisdn.as_e164}/capability:requestCapabilityCallback",
-                    json={
-                        "requestId": str(uuid.uuid4())
-                    }
-                )
+        for agent_obj in agents:
+            refreshed = rcs.capabilities.bulk_refresh(agent_obj, force=options["force"], limit=options["limit"])
+            self.stdout.write(f"Refreshed {refreshed} MSISDNs for {agent_obj}")
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.6 on 2026-10-19 10:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rcs', '0008_msisdn_last_checked'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CapabilityCheckSchedule',
+            fields=[
+                ('agent', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='capability_check_schedule', serialize=False, to='rcs.agent')),
+                ('next_check_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
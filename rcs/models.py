@@ -39,6 +39,7 @@ class MSISDN(models.Model):
     supports_action_share_location = models.BooleanField(default=False, blank=True)
     supports_action_view_location = models.BooleanField(default=False, blank=True)
     supports_payments_v1 = models.BooleanField(default=False, blank=True)
+    last_checked = models.DateTimeField(blank=True, null=True)
 
     class Meta:
         verbose_name = "MSISDN"
@@ -46,3 +47,10 @@ class MSISDN(models.Model):
 
     def __str__(self):
         return self.msisdn.as_e164
+
+
+class CapabilityCheckSchedule(models.Model):
+    agent = models.OneToOneField(
+        Agent, on_delete=models.CASCADE, primary_key=True, related_name='capability_check_schedule'
+    )
+    next_check_at = models.DateTimeField(blank=True, null=True)
@@ -0,0 +1,119 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+import messaging.models
+import messaging.outbox
+import sms.tasks
+import concurrent.futures
+import datetime
+import requests
+import logging
+from . import models, sessions
+
+logger = logging.getLogger(__name__)
+
+
+def revoke(session, agent: models.Agent, message: messaging.models.Message) -> bool:
+    base_url = f"https://{agent.region}-rcsbusinessmessaging.googleapis.com"
+    r = session.delete(
+        f"{base_url}/v1/phones/{message.platform_conversation_id}/agentMessages/{message.id}",
+        timeout=settings.RCS_REVOKE_TIMEOUT
+    )
+    # Google no longer holds the message, it was delivered after all
+    if r.status_code == 404:
+        return False
+    r.raise_for_status()
+    return True
+
+
+def claim(message: messaging.models.Message, now: datetime.datetime) -> bool:
+    return bool(messaging.models.Message.objects.filter(
+        id=message.id, state=messaging.models.Message.STATE_DISPATCHED,
+        fallback_at=message.fallback_at, fallback_at__lte=now,
+    ).update(fallback_at=None, fallback_armed=False))
+
+
+def release(message_id, retry_at: datetime.datetime) -> bool:
+    return bool(messaging.models.Message.objects.filter(
+        id=message_id, state=messaging.models.Message.STATE_DISPATCHED, fallback_at__isnull=True,
+    ).update(fallback_at=retry_at, fallback_armed=False))
+
+
+def fall_back(message: messaging.models.Message) -> bool:
+    now = timezone.now()
+    if message.state != message.STATE_DISPATCHED or not message.fallback_at or message.fallback_at > now:
+        return False
+
+    try:
+        agent_obj = message.brand.rcs_agent
+    except models.Agent.DoesNotExist:
+        agent_obj = None
+
+    if not claim(message, now):
+        return False
+
+    if agent_obj is None:
+        with transaction.atomic():
+            messaging.outbox.enqueue(sms.tasks.send_message, message.id)
+        return True
+
+    try:
+        revoked = revoke(sessions.get_session(agent_obj), agent_obj, message)
+    except requests.RequestException as e:
+        logger.warning("Failed to revoke message %s: %s", message.id, e)
+        release(message.id, now + datetime.timedelta(seconds=settings.RCS_REVOKE_RETRY_INTERVAL))
+        return False
+
+    if revoked:
+        with transaction.atomic():
+            messaging.outbox.enqueue(sms.tasks.send_message, message.id)
+    return revoked
+
+
+def expired_messages(now: datetime.datetime):
+    return list(messaging.models.Message.objects.filter(
+        state=messaging.models.Message.STATE_DISPATCHED,
+        fallback_at__lte=now,
+    ).select_related('brand', 'brand__rcs_agent').order_by('fallback_at')[:settings.RCS_REVOKE_BATCH_SIZE])
+
+
+def sweep() -> int:
+    now = timezone.now()
+    fallen_back = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=settings.RCS_REVOKE_CONCURRENCY) as executor:
+        while messages := expired_messages(now):
+            futures = {}
+            revoked = []
+            for message in messages:
+                try:
+                    agent_obj = message.brand.rcs_agent
+                except models.Agent.DoesNotExist:
+                    agent_obj = None
+                if not claim(message, now):
+                    continue
+                if agent_obj is None:
+                    revoked.append(message.id)
+                    continue
+                futures[executor.submit(revoke, sessions.get_session(agent_obj), agent_obj, message)] = message
+
+            retry = []
+            for future in concurrent.futures.as_completed(futures):
+                message = futures[future]
+                try:
+                    if future.result():
+                        revoked.append(message.id)
+                except requests.RequestException as e:
+                    logger.warning("Failed to revoke message %s: %s", message.id, e)
+                    retry.append(message.id)
+
+            retry_at = now + datetime.timedelta(seconds=settings.RCS_REVOKE_RETRY_INTERVAL)
+            with transaction.atomic():
+                for message_id in retry:
+                    release(message_id, retry_at)
+                for message_id in revoked:
+                    messaging.outbox.enqueue(sms.tasks.send_message, message_id)
+
+            fallen_back += len(revoked)
+
+    return fallen_back
@@ -0,0 +1,89 @@
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+import messaging.tokens
+import google.auth.transport.requests
+import google.auth.exceptions
+import requests.adapters
+import threading
+import datetime
+import hashlib
+import logging
+import json
+from . import models
+
+SCOPES = ["https://www.googleapis.com/auth/rcsbusinessmessaging"]
+
+logger = logging.getLogger(__name__)
+
+
+def key_fingerprint(service_account_key: str) -> str:
+    return hashlib.sha256(service_account_key.encode()).hexdigest()
+
+
+class AgentSession:
+    def __init__(self, agent: models.Agent, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.credentials = messaging.tokens.BrokeredCredentials(json.loads(agent.service_account_key), SCOPES)
+        self.auth_request = google.auth.transport.requests.Request()
+        self.session = google.auth.transport.requests.AuthorizedSession(
+            self.credentials, auth_request=self.auth_request
+        )
+        self.session.mount("https://", requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=settings.RCS_SESSION_POOL_SIZE
+        ))
+        self.lock = threading.Lock()
+
+    def needs_refresh(self) -> bool:
+        if not self.credentials.token or not self.credentials.expiry:
+            return True
+        remaining = self.credentials.expiry - datetime.datetime.utcnow()
+        return remaining < datetime.timedelta(seconds=settings.RCS_TOKEN_REFRESH_MARGIN)
+
+    def refresh(self):
+        if not self.needs_refresh():
+            return
+
+        with self.lock:
+            if not self.needs_refresh():
+                return
+            try:
+                self.credentials.refresh(self.auth_request)
+            except (google.auth.exceptions.RefreshError, google.auth.exceptions.TransportError, TimeoutError):
+                if not self.credentials.valid:
+                    raise
+                logger.warning("Failed to refresh RBM token early, using the current one", exc_info=True)
+
+    def close(self):
+        self.session.close()
+
+
+_lock = threading.Lock()
+_sessions = {}
+
+
+def get_session(agent: models.Agent) -> google.auth.transport.requests.AuthorizedSession:
+    fingerprint = key_fingerprint(agent.service_account_key)
+    with _lock:
+        agent_session = _sessions.get(agent.id)
+        if agent_session is None or agent_session.fingerprint != fingerprint:
+            if agent_session is not None:
+                agent_session.close()
+            agent_session = AgentSession(agent, fingerprint)
+            _sessions[agent.id] = agent_session
+
+    agent_session.refresh()
+    return agent_session.session
+
+
+def invalidate(agent_id):
+    with _lock:
+        agent_session = _sessions.pop(agent_id, None)
+    if agent_session is not None:
+        agent_session.close()
+
+
+@receiver(post_save, sender=models.Agent)
+@receiver(post_delete, sender=models.Agent)
+def agent_changed(sender, instance: models.Agent, **kwargs):
+    invalidate(instance.id)
@@ -1,27 +1,22 @@
 from celery import shared_task
 import messaging.models
 import messaging.tasks
+import messaging.outbox
 import sms.tasks
-import google.oauth2.service_account
-import google.auth.transport.requests
 from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 import urllib.parse
-import json
 import dateutil.parser
 import datetime
 import phonenumbers
 import uuid
-from . import models
-
-SCOPES = ["https://www.googleapis.com/auth/rcsbusinessmessaging"]
+from . import capabilities, models, revocation, sessions
 
 
 def map_file(message, content):
     if not ("url" in content):
-        message.state = message.STATE_FAILED
-        message.error_description = "Invalid message"
-        message.save()
-        messaging.tasks.send_message.delay(message.id)
+        messaging.tasks.fail_message(message, "Invalid message")
         return
 
     return {
@@ -30,19 +25,6 @@ def map_file(message, content):
     }
 
 
-def update_msisdn_features(features, msisdn: models.MSISDN):
-    msisdn.supports_revocation = "REVOCATION" in features
-    msisdn.supports_rich_card_standalone = "RICHCARD_STANDALONE" in features
-    msisdn.supports_rich_card_carousel = "RICHCARD_CAROUSEL" in features
-    msisdn.supports_action_calendar = "ACTION_CREATE_CALENDAR_EVENT" in features
-    msisdn.supports_action_dial = "ACTION_DIAL" in features
-    msisdn.supports_action_url = "ACTION_OPEN_URL" in features
-    msisdn.supports_action_share_location = "ACTION_SHARE_LOCATION" in features
-    msisdn.supports_action_view_location = "ACTION_VIEW_LOCATION" in features
-    msisdn.supports_payments_v1 = "PAYMENTS_V1" in features
-    msisdn.save()
-
-
 @shared_task(
     autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=None, default_retry_delay=3,
     ignore_result=True
@@ -62,11 +44,7 @@ def attempt_update_msisdn(brand_id, msisdn):
 
     base_url = f"https://{agent_obj.region}-rcsbusinessmessaging.googleapis.com"
 
-    credentials = google.oauth2.service_account.Credentials.from_service_account_info(
-        json.loads(agent_obj.service_account_key),
-        scopes=SCOPES
-    )
-    session = google.auth.transport.requests.AuthorizedSession(credentials)
+    session = sessions.get_session(agent_obj)
     msisdn = phonenumbers.format_number(number, phonenumbers.PhoneNumberFormat.E164)
 
     session.post(
@@ -77,6 +55,79 @@ def attempt_update_msisdn(brand_id, msisdn):
     )
 
 
+@shared_task(
+    autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=None, default_retry_delay=3,
+    ignore_result=True
+)
+def refresh_msisdn_capabilities(agent_id, msisdn):
+    agent_obj = models.Agent.objects.get(id=agent_id)
+    msisdn_obj = models.MSISDN.objects.filter(agent=agent_obj, msisdn=msisdn).first()
+    if msisdn_obj and not capabilities.is_stale(msisdn_obj):
+        return
+
+    capabilities.fetch(sessions.get_session(agent_obj), agent_obj, msisdn, uuid.uuid4())
+
+
+@shared_task(
+    autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=None, default_retry_delay=3,
+    ignore_result=True
+)
+def warm_msisdn_capabilities(brand_id, msisdns):
+    agent_obj = models.Agent.objects.filter(brand_id=brand_id).first()
+    if not agent_obj:
+        return
+
+    numbers = []
+    for msisdn in msisdns:
+        try:
+            number = phonenumbers.parse(msisdn)
+        except phonenumbers.phonenumberutil.NumberParseException:
+            continue
+        numbers.append(phonenumbers.format_number(number, phonenumbers.PhoneNumberFormat.E164))
+
+    capabilities.bulk_refresh(agent_obj, numbers)
+
+
+@shared_task(
+    autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=None, default_retry_delay=3,
+    ignore_result=True
+)
+def fallback_message(message_id):
+    message = messaging.models.Message.objects.select_related('brand').get(id=message_id)
+    revocation.fall_back(message)
+
+
+def schedule_fallback(message_id, fallback_at: datetime.datetime):
+    delay = (fallback_at - timezone.now()).total_seconds()
+    # Timers further out are armed by the revoke sweep once they come within the horizon, so no task waits
+    # unacknowledged in a worker for a long ETA
+    if delay > settings.RCS_FALLBACK_TIMER_HORIZON:
+        return False
+    # Arm each fallback_at only once, whether from dispatch or the sweep
+    if not messaging.models.Message.objects.filter(
+            id=message_id, fallback_at=fallback_at, fallback_armed=False
+    ).update(fallback_armed=True):
+        return False
+    messaging.outbox.enqueue(fallback_message, message_id, countdown=max(delay, 0))
+    return True
+
+
+def arm_fallback_timers() -> int:
+    now = timezone.now()
+    due = list(messaging.models.Message.objects.filter(
+        state=messaging.models.Message.STATE_DISPATCHED,
+        fallback_at__gt=now,
+        fallback_at__lte=now + datetime.timedelta(seconds=settings.RCS_FALLBACK_TIMER_HORIZON),
+        fallback_armed=False,
+    ).values_list('id', 'fallback_at'))
+    armed = 0
+    with transaction.atomic():
+        for message_id, fallback_at in due:
+            if schedule_fallback(message_id, fallback_at):
+                armed += 1
+    return armed
+
+
 @shared_task(
     autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=None, default_retry_delay=3,
     ignore_result=True
@@ -88,65 +139,44 @@ def send_message(message_id):
         if message.content["msisdn.desired_transport"] == "rcs":
             pass
         elif message.content["msisdn.desired_transport"] == "sms":
-            sms.tasks.send_message.delay(message.id)
+            messaging.outbox.enqueue(sms.tasks.send_message, message.id)
             return
         else:
-            message.state = message.STATE_FAILED
-            message.error_description = "Unknown transport"
-            message.save()
-            messaging.tasks.send_message.delay(message.id)
+            messaging.tasks.fail_message(message, "Unknown transport")
             return
 
     try:
         phonenumbers.parse(message.platform_conversation_id)
     except phonenumbers.phonenumberutil.NumberParseException:
-        message.state = message.STATE_FAILED
-        message.error_description = "Invalid MSISDN"
-        message.save()
-        messaging.tasks.send_message.delay(message.id)
+        messaging.tasks.fail_message(message, "Invalid MSISDN")
         return
 
     try:
         agent_obj = message.brand.rcs_agent
     except models.Agent.DoesNotExist:
-        sms.tasks.send_message.delay(message.id)
+        messaging.outbox.enqueue(sms.tasks.send_message, message.id)
         return
 
     base_url = f"https://{agent_obj.region}-rcsbusinessmessaging.googleapis.com"
 
-    credentials = google.oauth2.service_account.Credentials.from_service_account_info(
-        json.loads(agent_obj.service_account_key),
-        scopes=SCOPES
-    )
-    session = google.auth.transport.requests.AuthorizedSession(credentials)
-
-    msisdn = models.MSISDN.objects.filter(agent=agent_obj, msisdn=message.platform_conversation_id).first()
-    if not msisdn:
-        r = session.get(f"{base_url}/v1/phones/{message.platform_conversation_id}/capabilities?requestId={message.id}")
-        if r.status_code in (404, 403):
-            msisdn = models.MSISDN(agent=agent_obj, msisdn=message.platform_conversation_id, supports_rcs=False)
-            msisdn.save()
-        else:
-            r.raise_for_status()
-            msisdn = models.MSISDN(agent=agent_obj, msisdn=message.platform_conversation_id, supports_rcs=True)
-            update_msisdn_features(r.json().get("features", []), msisdn)
+    session = sessions.get_session(agent_obj)
+
+    msisdn = capabilities.lookup(session, agent_obj, message.platform_conversation_id, message.id)
+    if capabilities.claim_refresh(msisdn):
+        messaging.outbox.enqueue(refresh_msisdn_capabilities, agent_obj.id, message.platform_conversation_id)
 
     if not msisdn.supports_rcs:
         try:
             _sms_agent_obj = message.brand.sms_agent
         except message.brand.DoesNotExist:
-            message.state = message.STATE_FAILED
-            message.error_description = "MSISDN does not support RCS"
-            message.save()
-            messaging.tasks.send_message.delay(message.id)
+            messaging.tasks.fail_message(message, "MSISDN does not support RCS")
             return
 
-        sms.tasks.send_message.delay(message.id)
+        messaging.outbox.enqueue(sms.tasks.send_message, message.id)
         return
 
     message.metadata["msisdn.transport"] = "rcs"
-    message.save()
-    messaging.tasks.send_message.delay(message.id)
+    messaging.tasks.save_and_notify(message, ["metadata"])
     body = {}
 
     if message.media_type == "chat_state":
@@ -162,10 +192,7 @@ def send_message(message_id):
         elif message.content["state"] == "representative_left":
             return
         else:
-            message.state = message.STATE_FAILED
-            message.error_description = "Invalid message"
-            message.save()
-            messaging.tasks.send_message.delay(message.id)
+            messaging.tasks.fail_message(message, "Invalid message")
             return
     else:
         body["contentMessage"] = {}
@@ -181,10 +208,7 @@ def send_message(message_id):
                 return
         elif message.media_type == "select":
             if not ("media_type" in message.content and "options" in message.content and "content" in message.content):
-                message.state = message.STATE_FAILED
-                message.error_description = "Invalid message"
-                message.save()
-                messaging.tasks.send_message.delay(message.id)
+                messaging.tasks.fail_message(message, "Invalid message")
                 return
 
             if message.content["media_type"] == "text":
@@ -200,10 +224,7 @@ def send_message(message_id):
             body["contentMessage"]["suggestions"] = []
             for option in message.content["options"]:
                 if not ("media_type" in option and "content" in option):
-                    message.state = message.STATE_FAILED
-                    message.error_description = "Invalid message"
-                    message.save()
-                    messaging.tasks.send_message.delay(message.id)
+                    messaging.tasks.fail_message(message, "Invalid message")
                     return
 
                 if option["media_type"] == "text":
@@ -216,10 +237,7 @@ def send_message(message_id):
                 elif option["media_type"] == "url":
                     content = option["content"]
                     if not ("url" in content and "text" in content):
-                        message.state = message.STATE_FAILED
-                        message.error_description = "Invalid message"
-                        message.save()
-                        messaging.tasks.send_message.delay(message.id)
+                        messaging.tasks.fail_message(message, "Invalid message")
                         return
                     suggestion = {
                         "action": {
@@ -233,10 +251,7 @@ def send_message(message_id):
                 elif option["media_type"] == "dial":
                     content = option["content"]
                     if not ("number" in content and "text" in content):
-                        message.state = message.STATE_FAILED
-                        message.error_description = "Invalid message"
-                        message.save()
-                        messaging.tasks.send_message.delay(message.id)
+                        messaging.tasks.fail_message(message, "Invalid message")
                         return
                     suggestion = {
                         "action": {
@@ -251,10 +266,7 @@ def send_message(message_id):
                 elif option["media_type"] == "location":
                     content = option["content"]
                     if not ("lat_long" in content or "query" in content):
-                        message.state = message.STATE_FAILED
-                        message.error_description = "Invalid message"
-                        message.save()
-                        messaging.tasks.send_message.delay(message.id)
+                        messaging.tasks.fail_message(message, "Invalid message")
                         return
                     if "query" in content:
                         query = urllib.parse.quote_plus(content["query"])
@@ -288,13 +300,11 @@ def send_message(message_id):
                             "start_time" in content and "end_time" in content and
                             "title" in content and "description" in content
                     ):
-                        message.state = message.STATE_FAILED
-                        message.error_description = "Invalid message"
-                        message.save()
-                        messaging.tasks.send_message.delay(message.id)
+                        messaging.tasks.fail_message(message, "Invalid message")
                         return
 
-                    fallback_url = messaging.tasks.make_calendar_fallback(message, content)
+                    if (fallback_url := messaging.tasks.make_calendar_fallback(message, content)) is None:
+                        return
 
                     start_time = dateutil.parser.parse(content["start_time"])
                     end_time = dateutil.parser.parse(content["end_time"])
@@ -325,28 +335,38 @@ def send_message(message_id):
                 #         }
                 #     }
                 else:
-                    message.state = message.STATE_FAILED
-                    message.error_description = "Invalid message"
-                    message.save()
-                    messaging.tasks.send_message.delay(message.id)
+                    messaging.tasks.fail_message(message, "Invalid message")
                     return
 
                 body["contentMessage"]["suggestions"].append(suggestion)
 
         else:
-            message.state = message.STATE_FAILED
-            message.error_description = "Invalid message"
-            message.save()
-            messaging.tasks.send_message.delay(message.id)
+            messaging.tasks.fail_message(message, "Invalid message")
             return
 
+    fallback_at = None
+    if "contentMessage" in body:
+        fallback_at = max(
+            message.fallback_at or message.timestamp + datetime.timedelta(seconds=settings.RCS_FALLBACK_TIMEOUT),
+            timezone.now()
+        )
+        # Google only drops the message after our own revocation would have run, so a 404 on revoke still means
+        # it was delivered
+        body["expireTime"] = (fallback_at + datetime.timedelta(seconds=settings.RCS_EXPIRY_GRACE)) \
+            .astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
     if url and body:
         r = session.post(url, json=body)
-        if r.status_code != 200:
-            message.state = message.STATE_FAILED
-            message.error_description = r.json()["error"]["message"]
-        else:
-            message.state = message.STATE_DISPATCHED
-            message.platform_message_id = r.json()["name"]
-        message.save()
-        messaging.tasks.send_message.delay(message.id)
+        with transaction.atomic():
+            if r.status_code != 200:
+                state_changed = message.advance_state(
+                    message.STATE_FAILED, error_description=r.json()["error"]["message"]
+                )
+            else:
+                message.platform_message_id = r.json()["name"]
+                message.save(update_fields=["platform_message_id"])
+                state_changed = message.advance_state(message.STATE_DISPATCHED, fallback_at=fallback_at)
+                if state_changed and fallback_at:
+                    schedule_fallback(message.id, fallback_at)
+            if state_changed:
+                messaging.tasks.queue_state_webhook(message)
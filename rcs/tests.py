@@ -1,3 +1,214 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from unittest import mock
+import messaging.models
+import sms.tasks
+from messaging.testing import make_brand, make_message
+import cryptography.hazmat.primitives.asymmetric.rsa
+import cryptography.hazmat.primitives.serialization
+import datetime
+import json
+import requests
+import requests.adapters
+from . import capabilities, models, revocation, sessions, tasks
 
-# Create your tests here.
+
+class CapabilityLookupTestCase(TestCase):
+    def setUp(self):
+        self.agent = models.Agent.objects.create(
+            brand=make_brand(), service_account_key="{}", subscription_name="test"
+        )
+        self.msisdn = models.MSISDN.objects.create(agent=self.agent, msisdn="+447700900001")
+        self.addCleanup(capabilities.cache.clear)
+
+    def test_any_number_format_shares_a_cache_entry(self):
+        self.assertFalse(capabilities.lookup(None, self.agent, "+44 7700 900001", "request").supports_rcs)
+
+        self.msisdn.supports_rcs = True
+        capabilities.update_msisdn_features(["REVOCATION"], self.msisdn)
+
+        msisdn = capabilities.lookup(None, self.agent, "+44 7700 900001", "request")
+        self.assertTrue(msisdn.supports_rcs)
+        self.assertTrue(msisdn.supports_revocation)
+        self.assertIs(capabilities.lookup(None, self.agent, "+447700900001", "request"), msisdn)
+
+
+class FallbackTestCase(TestCase):
+    def setUp(self):
+        brand = make_brand()
+        models.Agent.objects.create(brand=brand, service_account_key="{}", subscription_name="test")
+        self.message = make_message(
+            brand, state=messaging.models.Message.STATE_DISPATCHED,
+            fallback_at=timezone.now() - datetime.timedelta(seconds=1)
+        )
+        self.addCleanup(mock.patch.stopall)
+        mock.patch.object(revocation.sessions, "get_session").start()
+
+    def scheduled(self, task):
+        return list(messaging.models.OutboxTask.objects.filter(task_name=task.name))
+
+    def load(self):
+        return messaging.models.Message.objects.select_related('brand').get(id=self.message.id)
+
+    def test_only_one_timer_falls_back(self):
+        first, second = self.load(), self.load()
+        with mock.patch.object(revocation, "revoke", side_effect=[True, False]) as revoke:
+            self.assertTrue(revocation.fall_back(first))
+            self.assertFalse(revocation.fall_back(second))
+
+        self.assertEqual(revoke.call_count, 1)
+        self.assertEqual(len(self.scheduled(sms.tasks.send_message)), 1)
+
+    def test_sweep_skips_messages_claimed_by_a_timer(self):
+        with mock.patch.object(revocation, "revoke", return_value=True):
+            self.assertTrue(revocation.fall_back(self.load()))
+            self.assertEqual(revocation.sweep(), 0)
+
+        self.assertEqual(len(self.scheduled(sms.tasks.send_message)), 1)
+
+    def test_transport_error_restores_the_fallback(self):
+        with mock.patch.object(revocation, "revoke", side_effect=requests.ConnectionError):
+            self.assertFalse(revocation.fall_back(self.load()))
+
+        message = self.load()
+        self.assertGreater(message.fallback_at, timezone.now())
+        self.assertFalse(message.fallback_armed)
+        self.assertEqual(self.scheduled(sms.tasks.send_message), [])
+
+    def test_message_without_agent_falls_back_directly(self):
+        models.Agent.objects.all().delete()
+        with mock.patch.object(revocation, "revoke") as revoke:
+            self.assertTrue(revocation.fall_back(self.load()))
+
+        revoke.assert_not_called()
+        self.assertIsNone(self.load().fallback_at)
+        self.assertEqual(len(self.scheduled(sms.tasks.send_message)), 1)
+
+    def test_sweep_falls_back_without_agent(self):
+        models.Agent.objects.all().delete()
+        self.assertEqual(revocation.sweep(), 1)
+        self.assertEqual(len(self.scheduled(sms.tasks.send_message)), 1)
+
+    def test_timer_is_armed_once(self):
+        fallback_at = timezone.now() + datetime.timedelta(seconds=60)
+        messaging.models.Message.objects.filter(id=self.message.id).update(fallback_at=fallback_at)
+
+        self.assertTrue(tasks.schedule_fallback(self.message.id, fallback_at))
+        self.assertEqual(tasks.arm_fallback_timers(), 0)
+        self.assertEqual(len(self.scheduled(tasks.fallback_message)), 1)
+
+
+@override_settings(RCS_CAPABILITY_BULK_RATE=10, RCS_CAPABILITY_BULK_CHUNK=2, RCS_CAPABILITY_BULK_CONCURRENCY=2)
+class BulkRefreshTestCase(TestCase):
+    def setUp(self):
+        self.agent = models.Agent.objects.create(
+            brand=make_brand(), service_account_key="{}", subscription_name="test"
+        )
+        self.addCleanup(mock.patch.stopall)
+        self.addCleanup(capabilities.cache.clear)
+        mock.patch.object(capabilities.sessions, "get_session").start()
+        mock.patch.object(capabilities.time, "sleep").start()
+        self.request = mock.patch.object(
+            capabilities, "request_capabilities", return_value=(True, ["REVOCATION"])
+        ).start()
+
+    def test_fresh_numbers_are_skipped(self):
+        models.MSISDN.objects.create(
+            agent=self.agent, msisdn="+447700900001", supports_rcs=True, last_checked=timezone.now()
+        )
+        refreshed = capabilities.bulk_refresh(self.agent, ["+447700900001", "+447700900002", "+447700900003"])
+
+        self.assertEqual(refreshed, 2)
+        self.assertEqual(
+            sorted(call.args[2] for call in self.request.call_args_list), ["+447700900002", "+447700900003"]
+        )
+        self.assertTrue(models.MSISDN.objects.get(msisdn="+447700900002").supports_revocation)
+
+    def test_checks_share_the_agent_rate_limit(self):
+        first = capabilities.reserve_check_slots(self.agent, 3)
+        second = capabilities.reserve_check_slots(self.agent, 2)
+
+        interval = datetime.timedelta(seconds=0.1)
+        self.assertEqual(first[1] - first[0], interval)
+        self.assertEqual(second[0], first[2] + interval)
+        schedule = models.CapabilityCheckSchedule.objects.get(agent=self.agent)
+        self.assertEqual(schedule.next_check_at, second[1] + interval)
+
+
+def make_service_account_key():
+    private_key = cryptography.hazmat.primitives.asymmetric.rsa.generate_private_key(
+        public_exponent=65537, key_size=2048
+    )
+    return json.dumps({
+        "type": "service_account",
+        "client_email": "agent@example.iam.gserviceaccount.com",
+        "token_uri": "https://oauth2.googleapis.com/token",
+        "private_key": private_key.private_bytes(
+            cryptography.hazmat.primitives.serialization.Encoding.PEM,
+            cryptography.hazmat.primitives.serialization.PrivateFormat.PKCS8,
+            cryptography.hazmat.primitives.serialization.NoEncryption()
+        ).decode(),
+    })
+
+
+class FakeAdapter(requests.adapters.BaseAdapter):
+    def __init__(self, statuses):
+        super().__init__()
+        self.statuses = list(statuses)
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        response = requests.Response()
+        response.status_code = self.statuses.pop(0)
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+class GetSessionTestCase(TestCase):
+    def setUp(self):
+        self.agent = models.Agent.objects.create(
+            brand=make_brand(), service_account_key=make_service_account_key(), subscription_name="test"
+        )
+        self.addCleanup(sessions.invalidate, self.agent.id)
+        expiry = timezone.now() + datetime.timedelta(hours=1)
+        self.get_token = mock.patch.object(
+            sessions.messaging.tokens, "get_token", side_effect=[("token-1", expiry), ("token-2", expiry)]
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_session_is_reused(self):
+        self.assertIs(sessions.get_session(self.agent), sessions.get_session(self.agent))
+        self.get_token.assert_called_once()
+
+    def test_changed_credentials_replace_the_session(self):
+        session = sessions.get_session(self.agent)
+        self.agent.service_account_key = make_service_account_key()
+        with mock.patch.object(session, "close") as close:
+            new_session = sessions.get_session(self.agent)
+
+        self.assertIsNot(new_session, session)
+        close.assert_called_once_with()
+        self.assertEqual(new_session.credentials.token, "token-2")
+
+    def test_saving_the_agent_evicts_the_session(self):
+        session = sessions.get_session(self.agent)
+        self.agent.save()
+        self.assertIsNot(sessions.get_session(self.agent), session)
+
+    def test_rejected_token_is_minted_again(self):
+        session = sessions.get_session(self.agent)
+        adapter = FakeAdapter([401, 200])
+        session.mount("https://rcsbusinessmessaging.googleapis.com", adapter)
+
+        r = session.get("https://rcsbusinessmessaging.googleapis.com/v1/phones/+447700900000/capabilities")
+
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.get_token.call_args[1]["rejected"], "token-1")
+        self.assertEqual(
+            [request.headers["Authorization"] for request in adapter.requests], ["Bearer token-1", "Bearer token-2"]
+        )
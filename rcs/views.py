@@ -2,12 +2,9 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.conf import settings
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
-from . import models, tasks
-import os.path
-import requests
-import mimetypes
+from django.db import transaction
+from . import capabilities, models
+import messaging.ingress
 import messaging.models
 import hmac
 import base64
@@ -44,7 +41,7 @@ def rcs_webhook(request):
 
     try:
         data_bytes = base64.b64decode(body_json["message"]["data"])
-        data_json = json.loads(data_bytes.decode())
+        json.loads(data_bytes.decode())
     except (binascii.Error, json.JSONDecodeError):
         return HttpResponseBadRequest()
 
@@ -52,6 +49,15 @@ def rcs_webhook(request):
     if not hmac.compare_digest(goog_sig, own_sig):
         return HttpResponseForbidden()
 
+    if settings.INGRESS_JOURNAL:
+        messaging.ingress.append(messaging.models.IngressEvent.SOURCE_RCS, body_json)
+        return HttpResponse(status=202)
+
+    return process_event(body_json)
+
+
+def process_event(body_json):
+    data_json = json.loads(base64.b64decode(body_json["message"]["data"]).decode())
     subscription_id = body_json.get("subscription")
     data_type = body_json["message"]["attributes"]["type"]
     agent_obj = models.Agent.objects.filter(subscription_name=subscription_id).first()
@@ -83,28 +89,28 @@ def rcs_webhook(request):
                     "msisdn.transport": "rcs"
                 }
             )
-            new_message.save()
-            messaging.tasks.process_message.delay(new_message.id)
+            messaging.tasks.save_and_route(new_message)
         elif data_json["eventType"] in ("DELIVERED", "READ"):
             ref_message = messaging.models.Message.objects.filter(
                 platform=messaging.models.Message.PLATFORM_MSISDN, id=data_json["messageId"]
             ).first()
             if ref_message:
                 if data_json["eventType"] == "DELIVERED":
-                    ref_message.state = messaging.models.Message.STATE_DELIVERED
-                if data_json["eventType"] == "READ":
-                    ref_message.state = messaging.models.Message.STATE_READ
-                ref_message.save()
-                messaging.tasks.send_message.delay(ref_message.id)
+                    new_state = messaging.models.Message.STATE_DELIVERED
+                else:
+                    new_state = messaging.models.Message.STATE_READ
+                with transaction.atomic():
+                    if ref_message.advance_state(new_state):
+                        messaging.tasks.queue_state_webhook(ref_message)
 
     elif data_type == "capabilities":
         msisdn, _ = models.MSISDN.objects.get_or_create(agent=agent_obj, msisdn=data_json["phoneNumber"])
         if "rbmEnabled" in data_json and data_json["rbmEnabled"]:
             msisdn.supports_rcs = True
-            tasks.update_msisdn_features(data_json["features"], msisdn)
+            capabilities.update_msisdn_features(data_json["features"], msisdn)
         else:
             msisdn.supports_rcs = False
-            tasks.update_msisdn_features([], msisdn)
+            capabilities.update_msisdn_features([], msisdn)
 
     elif data_type == "message":
         if messaging.models.Message.objects.filter(
@@ -133,21 +139,10 @@ def rcs_webhook(request):
             new_message.content = data_json["text"]
             new_message.media_type = "text"
         elif "userFile" in data_json:
-            file = requests.get(data_json["userFile"]["payload"]["fileUri"], stream=True)
-            file.raise_for_status()
-            file_name = data_json["userFile"]["payload"]["fileName"]
-            file_type = data_json["userFile"]["payload"]["mimeType"]
-            file_name_root, file_name_ext = os.path.splitext(file_name)
-            if not file_name_ext:
-                file_name_ext = mimetypes.guess_extension(file_type, strict=False)
-            file_name = file_name_root + file_name_ext
-            file_path = default_storage.save(file_name, ContentFile(file.content))
-            file_url = settings.MEDIA_URL + file_path
-            new_message.content = {
-                "url": file_url,
-                "media_type": file_type,
-                "title": None,
-                "text": None
+            new_message.pending_media = {
+                "url": data_json["userFile"]["payload"]["fileUri"],
+                "file_name": data_json["userFile"]["payload"]["fileName"],
+                "media_type": data_json["userFile"]["payload"]["mimeType"],
             }
             new_message.media_type = "file"
         elif "location" in data_json:
@@ -158,7 +153,6 @@ def rcs_webhook(request):
             new_message.media_type = "text"
             new_message.metadata["postback_data"] = data_json["suggestionResponse"]["postbackData"]
 
-        new_message.save()
-        messaging.tasks.process_message.delay(new_message.id)
+        messaging.tasks.save_and_route(new_message)
 
     return HttpResponse(status=202)
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+import twilio.rest
+import twilio.http.http_client
+import requests.adapters
+import threading
+import hashlib
+from . import models
+
+
+def credentials_fingerprint(account: models.TwilioAccount) -> str:
+    return hashlib.sha256(f"{account.account_sid}:{account.account_token}".encode()).hexdigest()
+
+
+class AccountClient:
+    def __init__(self, account: models.TwilioAccount, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.http_client = twilio.http.http_client.TwilioHttpClient(
+            pool_connections=True, timeout=settings.TWILIO_TIMEOUT
+        )
+        self.http_client.session.mount("https://", requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=settings.TWILIO_POOL_SIZE
+        ))
+        self.client = twilio.rest.Client(account.account_sid, account.account_token, http_client=self.http_client)
+
+    def close(self):
+        self.http_client.session.close()
+
+
+_lock = threading.Lock()
+_clients = {}
+
+
+def get_client(account: models.TwilioAccount) -> twilio.rest.Client:
+    fingerprint = credentials_fingerprint(account)
+    with _lock:
+        account_client = _clients.get(account.id)
+        if account_client is None or account_client.fingerprint != fingerprint:
+            if account_client is not None:
+                account_client.close()
+            account_client = AccountClient(account, fingerprint)
+            _clients[account.id] = account_client
+
+    return account_client.client
+
+
+def invalidate(account_id):
+    with _lock:
+        account_client = _clients.pop(account_id, None)
+    if account_client is not None:
+        account_client.close()
+
+
+@receiver(post_save, sender=models.TwilioAccount)
+@receiver(post_delete, sender=models.TwilioAccount)
+def account_changed(sender, instance: models.TwilioAccount, **kwargs):
+    invalidate(instance.id)
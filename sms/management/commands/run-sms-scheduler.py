@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import close_old_connections
+import sms.tasks
+import time
+
+
+class Command(BaseCommand):
+    help = "Release SMS sends waiting for a slot of their sender number once the slot comes up"
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            if sms.tasks.release_deferred_sends() < settings.SMS_SCHEDULER_BATCH_SIZE:
+                time.sleep(settings.SMS_SCHEDULER_INTERVAL)
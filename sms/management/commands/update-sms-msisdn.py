@@ -1,27 +1,10 @@
 from django.core.management.base import BaseCommand
-import sms.models
-import sms.tasks
+import sms.vsms
 
 
 class Command(BaseCommand):
-    def handle(self, *args, **options):
-        msisdns = list(sms.models.MSISDN.objects.all())
-        if msisdns:
-            r = sms.tasks.session.post(
-                "https://verifiedsms.googleapis.com/v1/enabledUserKeys:batchGet",
-                json={
-                    "phoneNumbers": list(map(lambda m: m.msisdn.as_e164, msisdns))
-                }
-            )
-            r.raise_for_status()
-            data = r.json()
+    help = "Refresh Verified SMS keys that are past their TTL"
 
-            for msisdn in msisdns:
-                vsms_data = next(filter(lambda u: u["phoneNumber"] == msisdn.msisdn.as_e164, data["userKeys"]), None) \
-                    if "userKeys" in data else None
-                if vsms_data:
-                    print(msisdn.vsms_public_key, vsms_data)
-                    msisdn.vsms_public_key = vsms_data["publicKey"]
-                else:
-                    msisdn.vsms_public_key = None
-                msisdn.save()
+    def handle(self, *args, **options):
+        refreshed = sms.vsms.refresh_keys()
+        self.stdout.write(f"Refreshed {refreshed} Verified SMS keys")
@@ -0,0 +1,39 @@
+# Generated by Django 3.1.6 on 2026-10-18 16:31
+
+import as207960_utils.models
+from django.db import migrations, models
+import django.db.models.deletion
+import phonenumber_field.modelfields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messaging', '0009_auto_20210204_1251'),
+        ('sms', '0004_auto_20210204_1759'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agent',
+            name='send_rate',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='SenderSchedule',
+            fields=[
+                ('id', as207960_utils.models.TypedUUIDField(data_type='messaging_smssenderschedule', primary_key=True, serialize=False)),
+                ('msisdn', phonenumber_field.modelfields.PhoneNumberField(max_length=128, region=None, unique=True)),
+                ('next_send_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DeferredSend',
+            fields=[
+                ('id', as207960_utils.models.TypedUUIDField(data_type='messaging_smsdeferredsend', primary_key=True, serialize=False)),
+                ('send_at', models.DateTimeField(db_index=True)),
+                ('prepared', models.BooleanField(blank=True, default=False)),
+                ('message', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='messaging.message')),
+            ],
+        ),
+    ]
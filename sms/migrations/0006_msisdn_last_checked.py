@@ -0,0 +1,18 @@
+# Generated by Django 3.1.6 on 2026-10-18 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sms', '0005_senderschedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='msisdn',
+            name='last_checked',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
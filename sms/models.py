@@ -20,15 +20,33 @@ class Agent(models.Model):
     twilio_account = models.ForeignKey(TwilioAccount, on_delete=models.PROTECT, related_name='sms_agents')
     vsms_agent_id = models.CharField(max_length=255, blank=True, null=True)
     vsms_private_key = models.TextField(blank=True, null=True)
+    send_rate = models.FloatField(blank=True, null=True)
 
     def __str__(self):
         return self.brand.name
 
 
+class SenderSchedule(models.Model):
+    id = as207960_utils.models.TypedUUIDField("messaging_smssenderschedule", primary_key=True)
+    msisdn = phonenumber_field.modelfields.PhoneNumberField(unique=True)
+    next_send_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return self.msisdn.as_e164
+
+
+class DeferredSend(models.Model):
+    id = as207960_utils.models.TypedUUIDField("messaging_smsdeferredsend", primary_key=True)
+    message = models.OneToOneField(messaging.models.Message, on_delete=models.CASCADE, related_name='+')
+    send_at = models.DateTimeField(db_index=True)
+    prepared = models.BooleanField(blank=True, default=False)
+
+
 class MSISDN(models.Model):
     id = as207960_utils.models.TypedUUIDField("messaging_vsmskey", primary_key=True)
     msisdn = phonenumber_field.modelfields.PhoneNumberField()
     vsms_public_key = models.TextField(blank=True, null=True)
+    last_checked = models.DateTimeField(blank=True, null=True)
 
     class Meta:
         verbose_name = "MSISDN"
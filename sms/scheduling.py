@@ -0,0 +1,21 @@
+from django.db import transaction
+from django.utils import timezone
+import datetime
+from . import models
+
+
+def reserve_slot(agent: models.Agent) -> datetime.datetime:
+    now = timezone.now()
+    if not agent.send_rate:
+        return now
+
+    # Each send takes the next free slot of its sender number, so excess messages queue up in order at the send rate
+    interval = datetime.timedelta(seconds=1 / agent.send_rate)
+    with transaction.atomic():
+        schedule, _ = models.SenderSchedule.objects.select_for_update().get_or_create(msisdn=agent.msisdn)
+        now = timezone.now()
+        send_at = max(schedule.next_send_at, now) if schedule.next_send_at else now
+        schedule.next_send_at = send_at + interval
+        schedule.save(update_fields=["next_send_at"])
+
+    return send_at
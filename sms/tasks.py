@@ -1,150 +1,133 @@
 from celery import shared_task
 from django.conf import settings
 from django.shortcuts import reverse
+from django.db import transaction
+from django.utils import timezone
+import messaging.links
 import messaging.models
+import messaging.outbox
 import messaging.tasks
 import phonenumbers
-import twilio.rest
 import twilio.base.exceptions
 import urllib.parse
-import google.oauth2.service_account
-import google.auth.transport.requests
+import dateutil.parser
+import time
+import datetime
 import base64
-import cryptography.hazmat.primitives.asymmetric.ec
 import cryptography.hazmat.primitives.kdf.hkdf
 import cryptography.hazmat.primitives.hashes
-import cryptography.hazmat.primitives.serialization
-from . import models
+from . import clients, models, scheduling, vsms
 
 VSMS_RATE_LIMIT_SALT = \
     "xELpwbCabRriJEkOYBagfJpHrrmNqlaZMTxsacBQjsLjUHtQexWNQCiMCkrxBzWEifExJkkOJwOziTQQJyRWVUbauuCHZrYlenSAiqtKtT"
 
-credentials = google.oauth2.service_account.Credentials.from_service_account_file(
-    settings.VSMS_SERVICE_ACCOUNT_FILE,
-    scopes=["https://www.googleapis.com/auth/verifiedsms"]
+
+@shared_task(
+    autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=None, default_retry_delay=3,
+    ignore_result=True
 )
-session = google.auth.transport.requests.AuthorizedSession(credentials)
-
-
-def get_vsms_key(msisdn):
-    msisdn_obj = models.MSISDN.objects.filter(msisdn=msisdn).first()
-    if not msisdn_obj:
-        r = session.post(
-            "https://verifiedsms.googleapis.com/v1/enabledUserKeys:batchGet",
-            json={
-                "phoneNumbers": [msisdn]
-            }
-        )
-        r.raise_for_status()
-        data = r.json()
-        if "userKeys" in data and len(data["userKeys"]):
-            msisdn_obj = models.MSISDN(
-                msisdn=data["userKeys"][0]["phoneNumber"], vsms_public_key=data["userKeys"][0]["publicKey"]
-            )
-        else:
-            msisdn_obj = models.MSISDN(
-                msisdn=msisdn, vsms_public_key=None
+def prefetch_vsms_keys(brand_id, msisdns):
+    agent_obj = models.Agent.objects.filter(brand_id=brand_id).first()
+    if not (agent_obj and agent_obj.vsms_agent_id and agent_obj.vsms_private_key):
+        return
+
+    numbers = []
+    for msisdn in msisdns:
+        try:
+            number = phonenumbers.parse(msisdn)
+        except phonenumbers.phonenumberutil.NumberParseException:
+            continue
+        numbers.append(phonenumbers.format_number(number, phonenumbers.PhoneNumberFormat.E164))
+
+    vsms.refresh_keys(numbers)
+
+
+def defer_send(message_id, send_at: datetime.datetime, prepared=False):
+    # Waits for a slot are kept in the database until the scheduler releases them, not as task ETAs
+    models.DeferredSend.objects.update_or_create(message_id=message_id, defaults={
+        "send_at": send_at,
+        "prepared": prepared,
+    })
+
+
+def release_deferred_sends() -> int:
+    now = timezone.now()
+    due = list(models.DeferredSend.objects.filter(
+        send_at__lte=now + datetime.timedelta(seconds=settings.SMS_SCHEDULER_INTERVAL)
+    ).order_by('send_at')[:settings.SMS_SCHEDULER_BATCH_SIZE])
+
+    released = 0
+    with transaction.atomic():
+        for deferred in due:
+            if not models.DeferredSend.objects.filter(id=deferred.id).delete()[0]:
+                continue
+            kwargs = {"send_at": deferred.send_at.isoformat()}
+            # A message that was already announced and registered with Verified SMS only needs sending
+            if deferred.prepared:
+                kwargs["prepared"] = True
+            messaging.outbox.enqueue(
+                send_message, deferred.message_id, countdown=max((deferred.send_at - now).total_seconds(), 0),
+                **kwargs
             )
-        msisdn_obj.save()
-    return msisdn_obj.vsms_public_key
+            released += 1
+    return released
 
 
 @shared_task(
     autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=None, default_retry_delay=3,
     ignore_result=True
 )
-def send_message(message_id):
+def send_message(message_id, send_at=None, prepared=False):
     message = messaging.models.Message.objects.get(id=message_id)
 
     try:
         number = phonenumbers.parse(message.platform_conversation_id)
     except phonenumbers.phonenumberutil.NumberParseException:
-        message.state = message.STATE_FAILED
-        message.error_description = "Invalid MSISDN"
-        message.save()
-        messaging.tasks.send_message.delay(message.id)
+        messaging.tasks.fail_message(message, "Invalid MSISDN")
         return
     e164_number = phonenumbers.format_number(number, phonenumbers.PhoneNumberFormat.E164)
 
     try:
         agent_obj = message.brand.sms_agent
     except models.Agent.DoesNotExist:
-        message.state = message.STATE_FAILED
-        message.error_description = "Brand does not support SMS"
-        message.save()
-        messaging.tasks.send_message.delay(message.id)
+        messaging.tasks.fail_message(message, "Brand does not support SMS")
         return
 
-    vsms_public_key = get_vsms_key(e164_number)
-    vsms_shared_key = None
-
-    if vsms_public_key:
-        message.metadata["msisdn.vsms"] = "user_enabled"
-    else:
-        message.metadata["msisdn.vsms"] = "user_disabled"
-    message.metadata["msisdn.transport"] = "sms"
-    message.save()
-    messaging.tasks.send_message.delay(message.id)
-
-    if agent_obj.vsms_private_key and vsms_public_key:
-        vsms_private_key = cryptography.hazmat.primitives.serialization.load_pem_private_key(
-            str(agent_obj.vsms_private_key).encode(), password=None
-        )
-        vsms_public_key = cryptography.hazmat.primitives.serialization.load_der_public_key(
-            base64.b64decode(vsms_public_key.encode())
-        )
-        vsms_shared_key = vsms_private_key.exchange(
-            cryptography.hazmat.primitives.asymmetric.ec.ECDH(),
-            vsms_public_key
-        )
-
-    twilio_client = twilio.rest.Client(agent_obj.twilio_account.account_sid, agent_obj.twilio_account.account_token)
-
     msg_body = None
     msg_other = {}
 
     if message.media_type == "chat_state":
-        return
+        pass
     else:
         if message.media_type == "text":
             msg_body = message.content
         elif message.media_type == "file":
             if not ("url" in message.content):
-                message.state = message.STATE_FAILED
-                message.error_description = "Invalid message"
-                message.save()
-                messaging.tasks.send_message.delay(message.id)
+                messaging.tasks.fail_message(message, "Invalid message")
                 return
 
             msg_body = ""
             msg_other["media_url"] = message.content["url"]
         elif message.media_type == "select":
             if not ("media_type" in message.content and "options" in message.content and "content" in message.content):
-                message.state = message.STATE_FAILED
-                message.error_description = "Invalid message"
-                message.save()
-                messaging.tasks.send_message.delay(message.id)
+                messaging.tasks.fail_message(message, "Invalid message")
                 return
 
             if message.content["media_type"] == "text":
                 msg_body = f'{message.content["content"]}\n'
             elif message.content["media_type"] == "file":
                 if not ("url" in message.content["content"]):
-                    message.state = message.STATE_FAILED
-                    message.error_description = "Invalid message"
-                    message.save()
-                    messaging.tasks.send_message.delay(message.id)
+                    messaging.tasks.fail_message(message, "Invalid message")
                     return
 
                 msg_body = ""
                 msg_other["media_url"] = message.content["content"]["url"]
 
+            # Links are shortened together after validating every option, with cache misses requested concurrently
+            option_lines = []
             for option in message.content["options"]:
                 if not ("media_type" in option and "content" in option):
-                    message.state = message.STATE_FAILED
-                    message.error_description = "Invalid message"
-                    message.save()
-                    messaging.tasks.send_message.delay(message.id)
+                    messaging.tasks.fail_message(message, "Invalid message")
                     return
 
                 if option["media_type"] == "text":
@@ -152,34 +135,21 @@ def send_message(message_id):
                 elif option["media_type"] == "url":
                     content = option["content"]
                     if not ("url" in content and "text" in content):
-                        message.state = message.STATE_FAILED
-                        message.error_description = "Invalid message"
-                        message.save()
-                        messaging.tasks.send_message.delay(message.id)
+                        messaging.tasks.fail_message(message, "Invalid message")
                         return
 
-                    fallback_url = messaging.tasks.shorten_link(
-                        agent_obj.brand, content["url"]
-                    )
-
-                    msg_body += f'\n{content["text"]}: {fallback_url}'
+                    option_lines.append((content["text"], {"link": content["url"]}))
                 elif option["media_type"] == "dial":
                     content = option["content"]
                     if not ("number" in content and "text" in content):
-                        message.state = message.STATE_FAILED
-                        message.error_description = "Invalid message"
-                        message.save()
-                        messaging.tasks.send_message.delay(message.id)
+                        messaging.tasks.fail_message(message, "Invalid message")
                         return
 
-                    msg_body += f'\n{content["text"]}: {content["number"]}'
+                    option_lines.append((content["text"], content["number"]))
                 elif option["media_type"] == "location":
                     content = option["content"]
                     if not ("lat_long" in content or "query" in content):
-                        message.state = message.STATE_FAILED
-                        message.error_description = "Invalid message"
-                        message.save()
-                        messaging.tasks.send_message.delay(message.id)
+                        messaging.tasks.fail_message(message, "Invalid message")
                         return
 
                     if "query" in content:
@@ -190,7 +160,7 @@ def send_message(message_id):
                         fallback_url = f"https://www.google.com/maps/search/?api=1&" \
                                        f"query={lat_long['latitude']},{lat_long['longitude']}"
 
-                    msg_body += f'\n{content["text"]}: {fallback_url}'
+                    option_lines.append((content["text"], fallback_url))
                 elif option["media_type"] == "share_location":
                     pass
                 elif option["media_type"] == "calendar_event":
@@ -199,20 +169,16 @@ def send_message(message_id):
                             "start_time" in content and "end_time" in content and
                             "title" in content and "description" in content
                     ):
-                        message.state = message.STATE_FAILED
-                        message.error_description = "Invalid message"
-                        message.save()
-                        messaging.tasks.send_message.delay(message.id)
+                        messaging.tasks.fail_message(message, "Invalid message")
                         return
 
-                    fallback_url = messaging.tasks.make_calendar_fallback(message, content)
-                    fallback_url = messaging.tasks.shorten_link(
-                        agent_obj.brand, fallback_url,
-                        title=content["title"],
-                        description=content["description"]
-                    )
-
-                    msg_body += f'\n{content["text"]}: {fallback_url}'
+                    if (fallback_url := messaging.tasks.make_calendar_fallback(message, content)) is None:
+                        return
+                    option_lines.append((content["text"], {
+                        "link": fallback_url,
+                        "title": content["title"],
+                        "description": content["description"],
+                    }))
                 # elif option["media_type"] == "login":
                 #     suggestion = {
                 #         "authenticationRequest": {
@@ -224,18 +190,49 @@ def send_message(message_id):
                 #         }
                 #     }
                 else:
-                    message.state = message.STATE_FAILED
-                    message.error_description = "Invalid message"
-                    message.save()
-                    messaging.tasks.send_message.delay(message.id)
+                    messaging.tasks.fail_message(message, "Invalid message")
                     return
 
+            short_links = iter(messaging.links.shorten_many(
+                agent_obj.brand, [value for _, value in option_lines if isinstance(value, dict)]
+            ))
+            for text, value in option_lines:
+                msg_body += f'\n{text}: {next(short_links) if isinstance(value, dict) else value}'
+
+        else:
+            messaging.tasks.fail_message(message, "Invalid message")
+            return
+
+    # Only a message that passed validation takes up sender throughput
+    if msg_body is not None:
+        if send_at is None:
+            send_at = scheduling.reserve_slot(agent_obj)
         else:
-            message.state = message.STATE_FAILED
-            message.error_description = "Invalid message"
-            message.save()
-            messaging.tasks.send_message.delay(message.id)
+            send_at = dateutil.parser.parse(send_at)
+        send_delay = (send_at - timezone.now()).total_seconds()
+        if send_delay > settings.SMS_SCHEDULE_MAX_SLEEP:
+            defer_send(message_id, send_at, prepared)
             return
+        elif send_delay > 0:
+            time.sleep(send_delay)
+
+    vsms_shared_key = None
+
+    if not prepared:
+        vsms_public_key = vsms.get_key(e164_number)
+
+        if vsms_public_key:
+            message.metadata["msisdn.vsms"] = "user_enabled"
+        else:
+            message.metadata["msisdn.vsms"] = "user_disabled"
+        message.metadata["msisdn.transport"] = "sms"
+        message.fallback_at = None
+        messaging.tasks.save_and_notify(message, ["metadata", "fallback_at"])
+
+        if agent_obj.vsms_private_key and vsms_public_key:
+            vsms_shared_key = vsms.get_shared_secret(str(agent_obj.vsms_private_key), vsms_public_key)
+
+    twilio_client = clients.get_client(agent_obj.twilio_account)
 
     if msg_body is not None:
         if vsms_shared_key:
@@ -253,18 +250,7 @@ def send_message(message_id):
             ).derive(vsms_shared_key)).decode()
             vsms_postback = base64.urlsafe_b64encode(str(message.id).encode()).decode()
 
-            r = session.post(
-                "https://verifiedsms.googleapis.com/v1/messages:batchCreate",
-                json={
-                    "messages": [{
-                        "agentId": agent_obj.vsms_agent_id,
-                        "hash": vsms_hash,
-                        "rateLimitToken": vsms_rate_limit_token,
-                        "postbackData": vsms_postback,
-                    }]
-                }
-            )
-            r.raise_for_status()
+            vsms.register_hash(agent_obj.vsms_agent_id, vsms_hash, vsms_rate_limit_token, vsms_postback)
 
         try:
             msg_resp = twilio_client.messages.create(
@@ -275,15 +261,19 @@ def send_message(message_id):
                 status_callback=settings.EXTERNAL_URL_BASE + reverse('sms:twilio_status_webhook'),
                 **msg_other
             )
-        except twilio.base.exceptions.TwilioException:
-            message.state = message.STATE_FAILED
-            message.error_description = "Message sending failed"
-            message.save()
-            message.save()
-            messaging.tasks.send_message.delay(message.id)
+        except twilio.base.exceptions.TwilioException as e:
+            # Over the carrier limit regardless, take a new slot at the back of the queue and give it time to clear
+            if isinstance(e, twilio.base.exceptions.TwilioRestException) and e.status == 429:
+                defer_send(message_id, max(
+                    scheduling.reserve_slot(agent_obj),
+                    timezone.now() + datetime.timedelta(seconds=settings.SMS_RATE_LIMITED_BACKOFF)
+                ), prepared=True)
+                return
+            messaging.tasks.fail_message(message, "Message sending failed")
             return
 
-        message.platform_message_id = msg_resp.sid
-        message.state = message.STATE_DISPATCHED
-        message.save()
-        messaging.tasks.send_message.delay(message.id)
+        with transaction.atomic():
+            message.platform_message_id = msg_resp.sid
+            message.save(update_fields=["platform_message_id"])
+            if message.advance_state(message.STATE_DISPATCHED):
+                messaging.tasks.queue_state_webhook(message)
@@ -1,3 +1,295 @@
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from unittest import mock
+import base64
+import cryptography.hazmat.primitives.asymmetric.ec
+import cryptography.hazmat.primitives.serialization
+import datetime
+import dateutil.parser
+import requests
+import threading
+import messaging.models
+import twilio.base.exceptions
+from messaging.testing import make_brand, make_message
+from . import clients, models, scheduling, tasks, vsms
 
-# Create your tests here.
+
+class ReserveSlotTestCase(TestCase):
+    def setUp(self):
+        self.brand = make_brand()
+        self.twilio_account = models.TwilioAccount.objects.create(account_sid="AC", account_token="token")
+        self.now = timezone.now()
+        patcher = mock.patch.object(scheduling.timezone, "now", return_value=self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_agent(self, send_rate=1.0, brand=None):
+        return models.Agent.objects.create(
+            msisdn="+447700900001", brand=brand or self.brand, twilio_account=self.twilio_account,
+            send_rate=send_rate
+        )
+
+    def test_first_send_is_immediate(self):
+        agent = self.make_agent()
+        self.assertEqual(scheduling.reserve_slot(agent), self.now)
+
+    def test_sends_are_spaced_at_the_send_rate(self):
+        agent = self.make_agent(send_rate=2)
+        slots = [scheduling.reserve_slot(agent) for _ in range(3)]
+        self.assertEqual(slots, [
+            self.now,
+            self.now + datetime.timedelta(seconds=0.5),
+            self.now + datetime.timedelta(seconds=1),
+        ])
+
+    def test_idle_sender_is_not_penalised(self):
+        agent = self.make_agent()
+        models.SenderSchedule.objects.create(
+            msisdn=agent.msisdn, next_send_at=self.now - datetime.timedelta(minutes=5)
+        )
+        self.assertEqual(scheduling.reserve_slot(agent), self.now)
+
+    def test_schedule_is_shared_by_sender_number(self):
+        other_brand = make_brand(name="Other")
+        agent = self.make_agent()
+        other_agent = self.make_agent(brand=other_brand)
+
+        self.assertEqual(scheduling.reserve_slot(agent), self.now)
+        self.assertEqual(scheduling.reserve_slot(other_agent), self.now + datetime.timedelta(seconds=1))
+
+    def test_unlimited_rate_skips_the_schedule(self):
+        agent = self.make_agent(send_rate=None)
+        self.assertEqual(scheduling.reserve_slot(agent), self.now)
+        self.assertFalse(models.SenderSchedule.objects.exists())
+
+
+@override_settings(SMS_SCHEDULE_MAX_SLEEP=1, SMS_SCHEDULER_INTERVAL=1, SMS_RATE_LIMITED_BACKOFF=5)
+class SendMessageTestCase(TestCase):
+    def setUp(self):
+        self.brand = make_brand()
+        self.agent = models.Agent.objects.create(
+            msisdn="+447700900001", brand=self.brand, send_rate=1,
+            twilio_account=models.TwilioAccount.objects.create(account_sid="AC", account_token="token")
+        )
+
+    def queued_sends(self):
+        return list(messaging.models.OutboxTask.objects.filter(task_name=tasks.send_message.name))
+
+    def test_invalid_message_takes_no_slot(self):
+        message = make_message(self.brand, media_type="file", content={})
+        tasks.send_message(message.id)
+
+        message.refresh_from_db()
+        self.assertEqual(message.state, messaging.models.Message.STATE_FAILED)
+        self.assertFalse(models.SenderSchedule.objects.exists())
+
+    def test_long_wait_is_kept_until_the_slot_comes_up(self):
+        send_at = timezone.now() + datetime.timedelta(hours=1)
+        models.SenderSchedule.objects.create(msisdn=self.agent.msisdn, next_send_at=send_at)
+        message = make_message(self.brand)
+        tasks.send_message(message.id)
+
+        deferred = models.DeferredSend.objects.get(message=message)
+        self.assertEqual(deferred.send_at, send_at)
+        self.assertFalse(deferred.prepared)
+        self.assertEqual(tasks.release_deferred_sends(), 0)
+        self.assertEqual(self.queued_sends(), [])
+
+    def test_due_send_is_released_once(self):
+        message = make_message(self.brand)
+        send_at = timezone.now() + datetime.timedelta(seconds=0.5)
+        tasks.defer_send(message.id, send_at, prepared=True)
+
+        self.assertEqual(tasks.release_deferred_sends(), 1)
+        self.assertEqual(tasks.release_deferred_sends(), 0)
+        queued = self.queued_sends()
+        self.assertEqual(len(queued), 1)
+        self.assertEqual(queued[0].args, [str(message.id)])
+        self.assertEqual(dateutil.parser.parse(queued[0].kwargs["send_at"]), send_at)
+        self.assertTrue(queued[0].kwargs["prepared"])
+        self.assertFalse(models.DeferredSend.objects.exists())
+
+    def test_unlimited_sender_sends_immediately(self):
+        self.agent.send_rate = None
+        self.agent.save()
+        client = mock.Mock()
+        client.messages.create.return_value.sid = "SM"
+        with mock.patch.object(tasks.vsms, "get_key", return_value=None), \
+                mock.patch.object(tasks.clients, "get_client", return_value=client):
+            tasks.send_message(make_message(self.brand).id)
+
+        client.messages.create.assert_called_once()
+        self.assertFalse(models.SenderSchedule.objects.exists())
+
+    def test_rate_limited_send_backs_off(self):
+        client = mock.Mock()
+        client.messages.create.side_effect = twilio.base.exceptions.TwilioRestException(429, "uri", "Too many requests")
+        with mock.patch.object(tasks.vsms, "get_key", return_value=None), \
+                mock.patch.object(tasks.clients, "get_client", return_value=client):
+            tasks.send_message(make_message(self.brand).id)
+
+        deferred = models.DeferredSend.objects.get()
+        self.assertGreater(deferred.send_at, timezone.now() + datetime.timedelta(seconds=4))
+        self.assertTrue(deferred.prepared)
+
+    def test_prepared_send_is_not_announced_again(self):
+        message = make_message(self.brand)
+        client = mock.Mock()
+        client.messages.create.return_value.sid = "SM"
+        with mock.patch.object(tasks.vsms, "get_key") as get_key, \
+                mock.patch.object(tasks.vsms, "register_hash") as register_hash, \
+                mock.patch.object(tasks.clients, "get_client", return_value=client):
+            tasks.send_message(message.id, send_at=timezone.now().isoformat(), prepared=True)
+
+        get_key.assert_not_called()
+        register_hash.assert_not_called()
+        client.messages.create.assert_called_once()
+        message.refresh_from_db()
+        self.assertEqual(message.state, messaging.models.Message.STATE_DISPATCHED)
+        self.assertNotIn("msisdn.transport", message.metadata)
+
+
+class GetClientTestCase(TestCase):
+    def setUp(self):
+        self.account = models.TwilioAccount.objects.create(account_sid="AC", account_token="token")
+        self.addCleanup(clients.invalidate, self.account.id)
+
+    def test_client_is_reused(self):
+        self.assertIs(clients.get_client(self.account), clients.get_client(self.account))
+
+    def test_changed_credentials_replace_the_client(self):
+        client = clients.get_client(self.account)
+        old_client = clients._clients[self.account.id]
+
+        self.account.account_token = "new-token"
+        with mock.patch.object(old_client, "close") as close:
+            new_client = clients.get_client(self.account)
+
+        self.assertIsNot(new_client, client)
+        close.assert_called_once_with()
+
+    def test_saving_the_account_evicts_the_client(self):
+        client = clients.get_client(self.account)
+        old_client = clients._clients[self.account.id]
+
+        with mock.patch.object(old_client, "close") as close:
+            self.account.save()
+
+        close.assert_called_once_with()
+        self.assertNotIn(self.account.id, clients._clients)
+        self.assertIsNot(clients.get_client(self.account), client)
+
+
+@override_settings(VSMS_KEY_TTL=3600)
+class GetKeyTestCase(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(vsms.session, "post")
+        self.post = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.post.return_value.json.return_value = {
+            "userKeys": [{"phoneNumber": "+447700900000", "publicKey": "new-key"}]
+        }
+
+    def test_fresh_key_is_served_from_the_database(self):
+        models.MSISDN.objects.create(msisdn="+447700900000", vsms_public_key="key", last_checked=timezone.now())
+        self.assertEqual(vsms.get_key("+447700900000"), "key")
+        self.post.assert_not_called()
+
+    def test_stale_key_is_fetched_again(self):
+        models.MSISDN.objects.create(
+            msisdn="+447700900000", vsms_public_key="key",
+            last_checked=timezone.now() - datetime.timedelta(hours=2)
+        )
+        self.assertEqual(vsms.get_key("+447700900000"), "new-key")
+
+        self.post.assert_called_once()
+        msisdn = models.MSISDN.objects.get()
+        self.assertEqual(msisdn.vsms_public_key, "new-key")
+        self.assertFalse(vsms.is_stale(msisdn))
+
+    def test_unknown_number_is_stored(self):
+        self.post.return_value.json.return_value = {}
+        self.assertIsNone(vsms.get_key("+447700900000"))
+        self.assertIsNotNone(models.MSISDN.objects.get().last_checked)
+
+
+class RegisterHashTestCase(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(vsms.session, "post")
+        self.post = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_concurrent_registrations_share_a_request(self):
+        hashes = [f"hash-{i}" for i in range(3)]
+        threads = [
+            threading.Thread(target=vsms.register_hash, args=("agent", vsms_hash, "token", "postback"))
+            for vsms_hash in hashes
+        ]
+        with mock.patch.object(vsms.hash_batcher, "max_wait", 1):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+
+        self.post.assert_called_once()
+        self.assertCountEqual(
+            [message["hash"] for message in self.post.call_args[1]["json"]["messages"]], hashes
+        )
+
+    def test_failed_registration_does_not_affect_the_next(self):
+        self.post.return_value.raise_for_status.side_effect = [requests.HTTPError("Server error"), None]
+        with self.assertRaises(requests.HTTPError):
+            vsms.register_hash("agent", "hash-1", "token", "postback")
+        vsms.register_hash("agent", "hash-2", "token", "postback")
+
+        self.assertEqual(self.post.call_count, 2)
+        self.assertEqual(self.post.call_args[1]["json"]["messages"][0]["hash"], "hash-2")
+
+
+def make_key_pair():
+    private_key = cryptography.hazmat.primitives.asymmetric.ec.generate_private_key(
+        cryptography.hazmat.primitives.asymmetric.ec.SECP384R1()
+    )
+    private_key_pem = private_key.private_bytes(
+        cryptography.hazmat.primitives.serialization.Encoding.PEM,
+        cryptography.hazmat.primitives.serialization.PrivateFormat.PKCS8,
+        cryptography.hazmat.primitives.serialization.NoEncryption()
+    ).decode()
+    public_key = base64.b64encode(private_key.public_key().public_bytes(
+        cryptography.hazmat.primitives.serialization.Encoding.DER,
+        cryptography.hazmat.primitives.serialization.PublicFormat.SubjectPublicKeyInfo
+    )).decode()
+    return private_key_pem, public_key
+
+
+class VsmsKeyCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.agent_key, _ = make_key_pair()
+        _, self.user_key = make_key_pair()
+        self.addCleanup(vsms.private_keys.clear)
+        self.addCleanup(vsms.shared_secrets.clear)
+        vsms.private_keys.clear()
+        vsms.shared_secrets.clear()
+
+    def test_private_key_is_parsed_once(self):
+        with mock.patch.object(
+                cryptography.hazmat.primitives.serialization, "load_pem_private_key",
+                wraps=cryptography.hazmat.primitives.serialization.load_pem_private_key
+        ) as load:
+            self.assertIs(vsms.get_private_key(self.agent_key), vsms.get_private_key(self.agent_key))
+        load.assert_called_once()
+
+    def test_shared_secret_is_exchanged_once(self):
+        secret = vsms.get_shared_secret(self.agent_key, self.user_key)
+        with mock.patch.object(vsms, "get_private_key") as get_private_key:
+            self.assertEqual(vsms.get_shared_secret(self.agent_key, self.user_key), secret)
+        get_private_key.assert_not_called()
+
+    def test_changed_keys_miss(self):
+        secret = vsms.get_shared_secret(self.agent_key, self.user_key)
+        new_agent_key, _ = make_key_pair()
+        _, new_user_key = make_key_pair()
+
+        self.assertNotEqual(vsms.get_shared_secret(new_agent_key, self.user_key), secret)
+        self.assertNotEqual(vsms.get_shared_secret(self.agent_key, new_user_key), secret)
+        self.assertEqual(vsms.private_keys.stats()["size"], 2)
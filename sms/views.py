@@ -2,10 +2,12 @@ from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbid
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.utils import timezone
+from django.db import transaction
 import twilio.request_validator
 import twilio.rest
 import twilio.twiml.messaging_response
 import messaging.models
+import messaging.outbox
 import messaging.tasks
 import rcs.tasks
 from . import models
@@ -47,7 +49,7 @@ def twilio_webhook(request):
     if not agent_obj:
         return HttpResponse(status=404)
 
-    rcs.tasks.attempt_update_msisdn.delay(agent_obj.brand.id, msg_from)
+    messaging.outbox.enqueue(rcs.tasks.attempt_update_msisdn, agent_obj.brand.id, msg_from)
 
     response = str(twilio.twiml.messaging_response.MessagingResponse())
 
@@ -71,8 +73,7 @@ def twilio_webhook(request):
         content=msg_body,
         media_type="text",
     )
-    new_message.save()
-    messaging.tasks.process_message.delay(new_message.id)
+    messaging.tasks.save_and_route(new_message)
 
     return HttpResponse(response)
 
@@ -91,16 +92,18 @@ def twilio_status_webhook(request):
     if not message:
         return HttpResponse(status=202)
 
-    if msg_status == "delivered":
-        message.state = message.STATE_DELIVERED
-    elif msg_status == "read":
-        message.state = message.STATE_READ
-    elif msg_status == "failed":
-        message.state = message.STATE_FAILED
-        message.error_description = "Message delivery failed"
-
-    message.save()
-    messaging.tasks.send_message.delay(message.id)
+    with transaction.atomic():
+        if msg_status == "delivered":
+            state_changed = message.advance_state(message.STATE_DELIVERED)
+        elif msg_status == "read":
+            state_changed = message.advance_state(message.STATE_READ)
+        elif msg_status == "failed":
+            state_changed = message.advance_state(message.STATE_FAILED, error_description="Message delivery failed")
+        else:
+            state_changed = False
+
+        if state_changed:
+            messaging.tasks.queue_state_webhook(message)
 
     return HttpResponse(status=202)
 
@@ -0,0 +1,145 @@
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+import google.auth.transport.requests
+import cryptography.hazmat.primitives.asymmetric.ec
+import cryptography.hazmat.primitives.serialization
+import messaging.batching
+import messaging.caching
+import messaging.tokens
+import datetime
+import hashlib
+import base64
+from . import models
+
+credentials = messaging.tokens.BrokeredCredentials.from_service_account_file(
+    settings.VSMS_SERVICE_ACCOUNT_FILE,
+    scopes=["https://www.googleapis.com/auth/verifiedsms"]
+)
+session = google.auth.transport.requests.AuthorizedSession(credentials)
+
+
+def stale_filter() -> Q:
+    return Q(last_checked__isnull=True) | Q(
+        last_checked__lt=timezone.now() - datetime.timedelta(seconds=settings.VSMS_KEY_TTL)
+    )
+
+
+def is_stale(msisdn: models.MSISDN) -> bool:
+    return msisdn.last_checked is None or \
+        timezone.now() - msisdn.last_checked > datetime.timedelta(seconds=settings.VSMS_KEY_TTL)
+
+
+def fetch_keys(msisdns) -> dict:
+    keys = {}
+    for i in range(0, len(msisdns), settings.VSMS_BATCH_SIZE):
+        r = session.post(
+            "https://verifiedsms.googleapis.com/v1/enabledUserKeys:batchGet",
+            json={
+                "phoneNumbers": msisdns[i:i + settings.VSMS_BATCH_SIZE]
+            }
+        )
+        r.raise_for_status()
+        for user_key in r.json().get("userKeys", []):
+            keys[user_key["phoneNumber"]] = user_key["publicKey"]
+
+    now = timezone.now()
+    existing = {}
+    for msisdn_obj in models.MSISDN.objects.filter(msisdn__in=msisdns):
+        existing.setdefault(msisdn_obj.msisdn.as_e164, []).append(msisdn_obj)
+
+    updated = []
+    created = []
+    for msisdn in msisdns:
+        if msisdn in existing:
+            for msisdn_obj in existing[msisdn]:
+                msisdn_obj.vsms_public_key = keys.get(msisdn)
+                msisdn_obj.last_checked = now
+                updated.append(msisdn_obj)
+        else:
+            created.append(models.MSISDN(msisdn=msisdn, vsms_public_key=keys.get(msisdn), last_checked=now))
+    models.MSISDN.objects.bulk_update(updated, ['vsms_public_key', 'last_checked'])
+    models.MSISDN.objects.bulk_create(created)
+
+    return {msisdn: keys.get(msisdn) for msisdn in msisdns}
+
+
+batcher = messaging.batching.Batcher(fetch_keys, settings.VSMS_BATCH_SIZE, settings.VSMS_BATCH_WAIT)
+
+
+def get_key(msisdn: str):
+    msisdn_obj = models.MSISDN.objects.filter(msisdn=msisdn).first()
+    if msisdn_obj and not is_stale(msisdn_obj):
+        return msisdn_obj.vsms_public_key
+    return batcher.get(msisdn)
+
+
+def refresh_keys(msisdns=None) -> int:
+    if msisdns is not None:
+        fresh = set(
+            str(msisdn) for msisdn in
+            models.MSISDN.objects.filter(msisdn__in=msisdns).exclude(stale_filter()).values_list('msisdn', flat=True)
+        )
+        pending = list(dict.fromkeys(msisdn for msisdn in msisdns if msisdn not in fresh))
+    else:
+        pending = list(dict.fromkeys(
+            str(msisdn) for msisdn in models.MSISDN.objects.filter(stale_filter()).values_list('msisdn', flat=True)
+        ))
+
+    if pending:
+        fetch_keys(pending)
+    return len(pending)
+
+
+def create_hashes(registrations) -> dict:
+    for i in range(0, len(registrations), settings.VSMS_BATCH_SIZE):
+        r = session.post(
+            "https://verifiedsms.googleapis.com/v1/messages:batchCreate",
+            json={
+                "messages": [{
+                    "agentId": agent_id,
+                    "hash": vsms_hash,
+                    "rateLimitToken": rate_limit_token,
+                    "postbackData": postback,
+                } for agent_id, vsms_hash, rate_limit_token, postback in registrations[i:i + settings.VSMS_BATCH_SIZE]]
+            }
+        )
+        r.raise_for_status()
+    return {registration: True for registration in registrations}
+
+
+hash_batcher = messaging.batching.Batcher(create_hashes, settings.VSMS_BATCH_SIZE, settings.VSMS_BATCH_WAIT)
+
+
+def register_hash(agent_id: str, vsms_hash: str, rate_limit_token: str, postback: str):
+    hash_batcher.get((agent_id, vsms_hash, rate_limit_token, postback))
+
+
+# Keyed by the key material itself, so changing either key simply misses
+private_keys = messaging.caching.LRUCache(
+    "VSMS private key", settings.VSMS_KEY_CACHE_SIZE, stats_interval=settings.CACHE_STATS_INTERVAL
+)
+shared_secrets = messaging.caching.LRUCache(
+    "VSMS shared secret", settings.VSMS_KEY_CACHE_SIZE, stats_interval=settings.CACHE_STATS_INTERVAL
+)
+
+
+def get_private_key(private_key_pem: str):
+    return private_keys.get_or_set(
+        hashlib.sha256(private_key_pem.encode()).digest(),
+        lambda: cryptography.hazmat.primitives.serialization.load_pem_private_key(
+            private_key_pem.encode(), password=None
+        )
+    )
+
+
+def get_shared_secret(private_key_pem: str, public_key: str) -> bytes:
+    def exchange():
+        return get_private_key(private_key_pem).exchange(
+            cryptography.hazmat.primitives.asymmetric.ec.ECDH(),
+            cryptography.hazmat.primitives.serialization.load_der_public_key(base64.b64decode(public_key.encode()))
+        )
+
+    return shared_secrets.get_or_set(
+        hashlib.sha256(private_key_pem.encode() + b"\0" + public_key.encode()).digest(), exchange
+    )